@@ -80,7 +80,7 @@ async def generate_answer(
             "PROMPT_SUFFIX": PROMPT_SUFFIX,
         },
     )
-    author_id = await create_author_if_not_exists(template, model)
+    author_id = await create_author_if_not_exists(template, model, "answer")
 
     attempts = 0
     while attempts < max_attempts:
@@ -1,6 +1,9 @@
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
-from fleecekmbackend.db.ctl import get_db, async_session
+from fleecekmbackend.db.ctl import get_db, async_session, read_session
+from fleecekmbackend.db.counters import get_counters, get_stage_progress
+from fleecekmbackend.db.timeseries import get_recent_counts, get_throughput
+from fleecekmbackend.db.sequences import assign_ids
 from fleecekmbackend.db.models import (
     Paragraph,
     Question,
@@ -8,15 +11,24 @@ from fleecekmbackend.db.models import (
     Author,
     Rating,
     Feedback,
+    hash_matches,
+)
+from fleecekmbackend.services.dataset.common import (
+    generate_fact_with_context,
+    load_question_contexts,
 )
-from fleecekmbackend.services.dataset.common import generate_fact_with_context
 from fleecekmbackend.services.dataset.ratings import generate_answer_rating
+from fleecekmbackend.services.dataset.votes import vote_accumulator
+from fleecekmbackend.core.config import (
+    THROUGHPUT_DEFAULT_BUCKET,
+    THROUGHPUT_DEFAULT_WINDOW,
+)
+from datetime import datetime, timedelta
 from sqlalchemy import func, select
 import logging
 import sys
 import random
 
-
 root = logging.getLogger()
 root.setLevel(logging.ERROR)
 
@@ -32,7 +44,7 @@ router = APIRouter()
 
 @router.get("/random-sample-r2l")
 async def random_sample_r2l(n: int):
-    async with async_session() as session:
+    async with read_session() as session:
         question = None
         while not question:
             max_offset = (
@@ -71,7 +83,7 @@ async def random_sample_r2l(n: int):
 
 @router.get("/sample-by-id")
 async def sample_by_id(paragraph_id: int):
-    async with async_session() as session:
+    async with read_session() as session:
         paragraph = (
             await session.execute(select(Paragraph).where(Paragraph.id == paragraph_id))
         ).scalar()
@@ -93,7 +105,7 @@ async def sample_by_id(paragraph_id: int):
 
 @router.get("/answer-generated")
 async def answer_generated(question_id: str):
-    async with async_session() as session:
+    async with read_session() as session:
         question = (
             await session.execute(select(Question).where(Question.id == question_id))
         ).scalar()
@@ -121,7 +133,12 @@ async def answer_generated(question_id: str):
 async def rate_answer(user_name: str, answer: str, question_id: str):
     async with async_session() as session:
         existing_author = (
-            await session.execute(select(Author).where(Author.username == user_name))
+            await session.execute(
+                select(Author).where(
+                    hash_matches(Author.username_hash, user_name),
+                    Author.username == user_name,
+                )
+            )
         ).scalar()
         if existing_author is None:
             author = Author(username=user_name, model="human")
@@ -144,6 +161,8 @@ async def rate_answer(user_name: str, answer: str, question_id: str):
                 select(Answer).where(
                     Answer.question_id == question_id,
                     Answer.author_id == author_id,
+                    # the hash narrows to an index probe, the text rules out collisions
+                    hash_matches(Answer.text_hash, answer),
                     Answer.text == answer,
                 )
             )
@@ -151,15 +170,21 @@ async def rate_answer(user_name: str, answer: str, question_id: str):
         if existing_answer is not None:
             return {"error": "answer already rated"}
 
+        question_context = (
+            await load_question_contexts(session, [existing_question.id])
+        )[existing_question.id]
         answer = Answer(
             question_id=question_id, author_id=author_id, setting="human", text=answer
         )
+        await assign_ids([answer])
         session.add(answer)
-        await session.flush()
-        await session.refresh(answer, ["id"])
         answer_id = answer.id
 
-        rating_id = await generate_answer_rating(session, answer_id)
+        rating_id = await generate_answer_rating(
+            session,
+            answer_id,
+            context=question_context.for_answer(answer, {}),
+        )
         await session.commit()
         rating = (
             await session.execute(select(Rating).where(Rating.id == rating_id))
@@ -175,7 +200,12 @@ async def question_feedback(request_body: dict):
     text = request_body.get("text")
     async with async_session() as session:
         existing_author = (
-            await session.execute(select(Author).where(Author.username == user_name))
+            await session.execute(
+                select(Author).where(
+                    hash_matches(Author.username_hash, user_name),
+                    Author.username == user_name,
+                )
+            )
         ).scalar()
         if existing_author is None:
             author = Author(username=user_name, model="human")
@@ -203,7 +233,7 @@ async def question_feedback(request_body: dict):
 
 @router.get("/question/feedback")
 async def get_question_feedback(question_id: str):
-    async with async_session() as session:
+    async with read_session() as session:
         feedbacks = (
             await session.execute(
                 select(Feedback).where(Feedback.question_id == question_id)
@@ -221,37 +251,66 @@ async def question_vote(
     question_id = vote_data.get("question_id")
     vote = vote_data.get("vote")
 
+    if vote not in ["up", "down"]:
+        return {"error": "invalid vote"}
+    # increments are batched and applied by the accumulator's periodic flush
+    if not await vote_accumulator.record(int(question_id), vote, user_name):
+        return {"error": "question not found"}
     async with async_session() as session:
-        if vote not in ["up", "down"]:
-            return {"error": "invalid vote"}
-        elif vote == "up":
-            await session.execute(
-                Question.__table__.update()
-                .where(Question.id == question_id)
-                .values(upvote=Question.upvote + 1)
-            )
-        elif vote == "down":
-            await session.execute(
-                Question.__table__.update()
-                .where(Question.id == question_id)
-                .values(downvote=Question.downvote + 1)
-            )
-        await session.commit()
-        return {"message": "vote successful"}
+        totals = await vote_accumulator.totals(session, int(question_id))
+    if totals is None:
+        return {"error": "question not found"}
+    return {"message": "vote successful", **totals}
 
 
-@router.get("/progress-accurate")
-async def get_progress_accurate(db: Session = Depends(get_db)):
+@router.get("/question/votes")
+async def get_question_votes(question_id: int):
     async with async_session() as session:
-        largest_processed = (
-            await session.execute(
-                select(func.count(Paragraph.id)).where(Paragraph.processed == True)
-            )
-        ).scalar()
-        total = (await session.execute(select(func.max(Paragraph.id)))).scalar()
+        totals = await vote_accumulator.totals(session, question_id)
+    if totals is None:
+        return {"error": "question not found"}
+    return totals
+
+
+@router.get("/progress-accurate")
+async def get_progress_accurate():
+    async with read_session() as session:
+        counters = await get_counters(session)
+        processed = counters["paragraph_processed"]
+        total = counters["paragraph_total"]
 
         return {
-            "progress": int(largest_processed),
-            "total": int(total),
-            "percentage": int(largest_processed) / int(total) * 100,
+            "progress": processed,
+            "total": total,
+            "percentage": processed / total * 100 if total else 0.0,
         }
+
+
+@router.get("/progress/stages")
+async def get_progress_stages():
+    async with read_session() as session:
+        return await get_stage_progress(session)
+
+
+@router.get("/progress/throughput")
+async def get_progress_throughput(
+    since: datetime = None,
+    until: datetime = None,
+    window_seconds: int = THROUGHPUT_DEFAULT_WINDOW,
+    bucket_seconds: int = THROUGHPUT_DEFAULT_BUCKET,
+):
+    until = until or datetime.now()
+    since = since or until - timedelta(seconds=window_seconds)
+    if bucket_seconds <= 0:
+        return {"error": "bucket_seconds must be positive"}
+    async with read_session() as session:
+        try:
+            return await get_throughput(session, since, until, bucket_seconds)
+        except ValueError as e:
+            return {"error": str(e)}
+
+
+@router.get("/progress/recent")
+async def get_progress_recent(window_seconds: int = THROUGHPUT_DEFAULT_WINDOW):
+    async with read_session() as session:
+        return await get_recent_counts(session, window_seconds)
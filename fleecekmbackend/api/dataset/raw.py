@@ -3,12 +3,12 @@ from fleecekmbackend.db.helpers import get_random_samples_raw
 from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from fleecekmbackend.db.models import Paragraph
-from fleecekmbackend.db.ctl import get_db
+from fleecekmbackend.db.ctl import get_read_db
 
 router = APIRouter()
 
 @router.get("/rand-sample")
-async def random_samples(n: int, db: AsyncSession = Depends(get_db)):
+async def random_samples(n: int, db: AsyncSession = Depends(get_read_db)):
     samples = await get_random_samples_raw(n, db)
     return samples
 
@@ -0,0 +1,291 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fleecekmbackend.core.config import METRICS_DIR
+
+# seconds; covers fast db queries up to slow LLM generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """(suffix, label pairs, value) for every series."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self._samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("counters only go up")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        """Sum over every label combination."""
+        return sum(self._values.values())
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "_total", list(zip(self.labelnames, key)), value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """Read the value from ``function`` whenever the gauge is rendered."""
+        self._values[self._key(labels)] = function
+
+    def value(self, **labels):
+        value = self._values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "", list(zip(self.labelnames, key)), (
+                value() if callable(value) else value
+            )
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield "_count", labels, cumulative
+            yield "_sum", labels, total
+
+
+class Registry:
+    """Process-wide metrics, rendered in the Prometheus text format.
+
+    Each process (the API server, every worker) keeps its own registry; the
+    server exposes it at ``/metrics`` and workers dump it to a file.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"{name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+    def dump(self, path):
+        """Write the current values to ``path``, replacing it atomically so a
+        reader (such as node_exporter's textfile collector) never sees half."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(f"# dumped at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+            file.write(self.render())
+        os.replace(temporary, path)
+
+
+REGISTRY = Registry()
+
+
+def run_dump_path(name, run_id=None):
+    """``METRICS_DIR/<run id>/<name>.prom``; one directory per run, so runs can
+    be compared afterwards."""
+    run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(METRICS_DIR, run_id, f"{name}.prom")
+
+
+async def run_metrics_dump(path, interval):
+    """Dump the registry to ``path`` every ``interval`` seconds and once more
+    when cancelled."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            REGISTRY.dump(path)
+    finally:
+        REGISTRY.dump(path)
+
+
+LLM_REQUESTS = REGISTRY.counter(
+    "llm_requests", "LLM requests by outcome", ("service", "model", "outcome")
+)
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+    "llm_request_seconds", "LLM request latency", ("service", "model")
+)
+LLM_CALLS_AVOIDED = REGISTRY.counter(
+    "llm_calls_avoided", "LLM calls skipped by reusing checkpointed results"
+)
+DB_SESSION_WAIT_SECONDS = REGISTRY.histogram(
+    "db_session_wait_seconds", "Time spent waiting for a db session permit"
+)
+DB_SESSIONS = REGISTRY.gauge(
+    "db_sessions", "Db sessions open or waiting for a permit", ("state",)
+)
+DB_POOL_CONNECTIONS = REGISTRY.gauge(
+    "db_pool_connections", "Primary engine connection pool", ("state",)
+)
+PIPELINE_ITEMS = REGISTRY.counter(
+    "pipeline_items", "Items finished by a pipeline stage", ("stage",)
+)
+PIPELINE_FAILURES = REGISTRY.counter(
+    "pipeline_failures", "Items a pipeline stage failed on", ("stage",)
+)
+PIPELINE_ITEM_SECONDS = REGISTRY.histogram(
+    "pipeline_item_seconds", "Time a pipeline stage spends on one item", ("stage",)
+)
+PIPELINE_ITEMS_PER_SECOND = REGISTRY.gauge(
+    "pipeline_items_per_second",
+    "Stage throughput over the last autoscaling interval",
+    ("stage",),
+)
+PIPELINE_QUEUE_DEPTH = REGISTRY.gauge(
+    "pipeline_queue_depth", "Items waiting in a stage's input queue", ("stage",)
+)
+PIPELINE_CONSUMERS = REGISTRY.gauge(
+    "pipeline_consumers", "Consumers currently serving a stage", ("stage",)
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "API request latency", ("method", "route", "status")
+)
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "loop_lag_seconds",
+    "How late the event loop heartbeat wakes up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_LAG = REGISTRY.gauge("loop_lag", "Event loop lag at the last heartbeat, seconds")
+LOOP_BLOCKS = REGISTRY.counter(
+    "loop_blocks", "Event loop stalls over the threshold", ("site",)
+)
+LOOP_BLOCKED_SECONDS = REGISTRY.counter(
+    "loop_blocked_seconds", "Time the event loop spent stalled", ("site",)
+)
+DEAD_LETTERED = REGISTRY.counter(
+    "dead_lettered", "Items moved to the dead-letter table", ("item_type",)
+)
+LLM_RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    "llm_rate_limit_wait_seconds",
+    "Time an LLM request waited for its target's rate limit",
+    ("service", "model"),
+)
+ANSWERABILITY_CHECKS = REGISTRY.counter(
+    "answerability_checks",
+    "Answerability checks by setting and what decided them",
+    ("setting", "decided_by"),
+)
+ANSWERABILITY_AGREEMENT = REGISTRY.counter(
+    "answerability_agreement",
+    "Classifier verdicts compared with the LLM's, on audited and escalated checks",
+    ("setting", "route", "outcome"),
+)
@@ -1,4 +1,5 @@
 import asyncio
+import contextvars
 import logging
 import random
 import aiohttp
@@ -6,10 +7,14 @@ import requests
 import time
 import together
 import json
+from functools import wraps
 from openai import OpenAI
 
 from dotenv import dotenv_values
 
+from fleecekmbackend.core.metrics import LLM_REQUESTS, LLM_REQUEST_SECONDS
+from fleecekmbackend.core.utils.ratelimit import target_limiter
+
 together.api_key = dotenv_values()["TOGETHER_API_KEY"]
 openai = OpenAI(api_key=dotenv_values()["OPENAI_API_KEY"])
 
@@ -22,10 +27,77 @@ TOP_K = 50
 REPETITION_PENALTY = 1.1
 
 
+# set per item by the pipelines; instrumented requests store their prompt in it
+_last_prompt = contextvars.ContextVar("last_prompt", default=None)
+
+
+def track_prompts():
+    """Record the prompts sent from now on by this task and the tasks it starts.
+
+    Returns a dict whose "prompt" key holds the latest one, so a failing item
+    can be stored with what was sent for it.
+    """
+    prompts = {}
+    _last_prompt.set(prompts)
+    return prompts
+
+
+def _remember_prompt(prompt):
+    prompts = _last_prompt.get()
+    if prompts is not None:
+        prompts["prompt"] = prompt
+
+
 def randwait(wait, offset=0):
     return random.random() * wait + offset
 
 
+def _record_request(service, model, outcome, start):
+    LLM_REQUESTS.inc(service=service, model=model, outcome=outcome)
+    LLM_REQUEST_SECONDS.observe(
+        time.perf_counter() - start, service=service, model=model
+    )
+
+
+def instrumented(request):
+    """Count calls, failures and latency of an LLM request function, and
+    remember its prompt for ``track_prompts``. Async requests first wait for
+    their (service, model) target's rate limit, which is not counted as
+    latency."""
+    if asyncio.iscoroutinefunction(request):
+
+        @wraps(request)
+        async def wrapper(prompt, model, *args, service="gpublaze", **kwargs):
+            _remember_prompt(prompt)
+            limiter = target_limiter(service, model)
+            async with limiter.slot(service=service, model=model):
+                start, outcome = time.perf_counter(), "error"
+                try:
+                    result = await request(
+                        prompt, model, *args, service=service, **kwargs
+                    )
+                    outcome = "ok"
+                    return result
+                finally:
+                    _record_request(service, model, outcome, start)
+
+    else:
+
+        @wraps(request)
+        def wrapper(prompt, model, *args, service="gpublaze", **kwargs):
+            _remember_prompt(prompt)
+            start, outcome = time.perf_counter(), "error"
+            try:
+                result = request(prompt, model, *args, service=service, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                _record_request(service, model, outcome, start)
+
+    return wrapper
+
+
+@instrumented
 def llm_safe_request(
     prompt,
     model,
@@ -281,6 +353,7 @@ def together_safe_request(
         )
 
 
+@instrumented
 async def llm_safe_request_async(
     prompt,
     model,
@@ -311,6 +384,25 @@ async def llm_safe_request_async(
             prompt_suffix,
             guided_choice,
         )
+    elif service in ("together", "openai"):
+        # no async clients for these; keep the blocking call off the loop
+        request = (
+            together_safe_request if service == "together" else openai_safe_request
+        )
+        return await asyncio.to_thread(
+            request,
+            prompt,
+            model,
+            stop,
+            max_tokens,
+            temperature,
+            top_p,
+            top_k,
+            repetition_penalty,
+            max_retries,
+            prompt_prefix,
+            prompt_suffix,
+        )
     else:
         raise Exception(f"Service {service} not supported")
 
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from fleecekmbackend.core.config import TARGET_DEFAULT_RATE_LIMIT, TARGET_RATE_LIMITS
+from fleecekmbackend.core.metrics import LLM_RATE_LIMIT_WAIT_SECONDS
+
+
+class RateLimiter:
+    """Bounds the requests in flight to one LLM target and spaces their
+    starts to at most ``requests_per_second``. Either bound may be None."""
+
+    def __init__(self, max_concurrency: int = None, requests_per_second: float = None):
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self._semaphore = (
+            asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        )
+        self._interval = 1 / requests_per_second if requests_per_second else 0.0
+        self._next_start = 0.0
+        self.in_flight = 0
+
+    @asynccontextmanager
+    async def slot(self, **labels):
+        start = time.monotonic()
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        try:
+            if self._interval:
+                now = time.monotonic()
+                # reserve the next free start time before sleeping, so
+                # concurrent waiters queue up behind each other
+                start_at = max(now, self._next_start)
+                self._next_start = start_at + self._interval
+                if start_at > now:
+                    await asyncio.sleep(start_at - now)
+            LLM_RATE_LIMIT_WAIT_SECONDS.observe(time.monotonic() - start, **labels)
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+
+# (service, model) -> limiter; targets without an entry in TARGET_RATE_LIMITS
+# fall back to the service's entry, then to TARGET_DEFAULT_RATE_LIMIT
+_limiters = {}
+
+
+def target_limiter(service: str, model: str) -> RateLimiter:
+    limiter = _limiters.get((service, model))
+    if limiter is None:
+        limits = TARGET_RATE_LIMITS.get(
+            (service, model),
+            TARGET_RATE_LIMITS.get(service, TARGET_DEFAULT_RATE_LIMIT),
+        )
+        limiter = _limiters[(service, model)] = RateLimiter(*limits)
+    return limiter
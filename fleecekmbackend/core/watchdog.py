@@ -0,0 +1,163 @@
+import asyncio
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from fleecekmbackend.core.config import (
+    LOOP_BLOCK_THRESHOLD,
+    LOOP_LAG_INTERVAL,
+    LOOP_REPORT_INTERVAL,
+)
+from fleecekmbackend.core.metrics import (
+    LOOP_BLOCKED_SECONDS,
+    LOOP_BLOCKS,
+    LOOP_LAG,
+    LOOP_LAG_SECONDS,
+)
+
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ROOT_DIR = os.path.dirname(_PACKAGE_DIR)
+
+
+def _call_site(frame):
+    """Where the loop got stuck: the innermost coroutine on the stack, which
+    is the async code that made a synchronous call. Falls back to the
+    innermost frame in this repository for plain callbacks."""
+    fallback = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_flags & inspect.CO_COROUTINE:
+            return _describe(frame)
+        if fallback is None and code.co_filename.startswith(_ROOT_DIR):
+            fallback = frame
+        frame = frame.f_back
+    return _describe(fallback) if fallback is not None else "unknown"
+
+
+def _describe(frame):
+    filename = frame.f_code.co_filename
+    if filename.startswith(_ROOT_DIR):
+        filename = os.path.relpath(filename, _ROOT_DIR)
+    return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+
+class LoopWatchdog:
+    """Measures event loop lag and finds the code that blocks the loop.
+
+    A heartbeat task sleeps ``interval`` seconds at a time; how late it wakes up
+    is the loop lag, recorded in the loop_lag_seconds histogram. A thread
+    checks the heartbeat every ``threshold / 2`` seconds. Once the loop has
+    been stuck for longer than ``threshold``, the thread takes the loop
+    thread's stack and files the stall under the call site that caused it. The
+    log gets the full stack the first time a site blocks, and a summary of
+    every site every ``report_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: float = LOOP_BLOCK_THRESHOLD,
+        interval: float = LOOP_LAG_INTERVAL,
+        report_interval: float = LOOP_REPORT_INTERVAL,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+        self.sites = {}  # call site -> {"count", "total_seconds", "max_seconds"}
+        self._loop_thread_id = None
+        self._last_tick = None
+        self._stall = None  # call site of the stall in progress
+        self._heartbeat = None
+        self._reporter = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat = asyncio.create_task(self._beat())
+        if self.report_interval:
+            self._reporter = asyncio.create_task(self._report_periodically())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    async def stop(self):
+        self._stopped.set()
+        for task in (self._heartbeat, self._reporter):
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(
+            *[t for t in (self._heartbeat, self._reporter) if t is not None],
+            return_exceptions=True,
+        )
+        self._thread.join()
+        self.log_report()
+
+    async def _beat(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - start - self.interval, 0.0)
+            self._last_tick = time.monotonic()
+            LOOP_LAG_SECONDS.observe(lag)
+            LOOP_LAG.set(lag)
+            site, self._stall = self._stall, None
+            if site is not None:
+                self._record(site, lag)
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            stuck = time.monotonic() - self._last_tick - self.interval
+            if stuck <= self.threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            site, frames = _call_site(frame), traceback.extract_stack(frame)
+            del frame
+            if time.monotonic() - self._last_tick - self.interval <= self.threshold:
+                continue  # the loop moved on while the stack was being read
+            if site not in self.sites:
+                logging.warning(
+                    f"Event loop blocked for over {self.threshold}s at {site}:\n"
+                    + "".join(traceback.format_list(frames))
+                )
+            self._stall = site
+
+    def _record(self, site, seconds):
+        stats = self.sites.setdefault(
+            site, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        )
+        stats["count"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        LOOP_BLOCKS.inc(site=site)
+        LOOP_BLOCKED_SECONDS.inc(seconds, site=site)
+
+    def report(self):
+        """Blocking call sites, the worst (most time blocked) first."""
+        return sorted(
+            ({"site": site, **stats} for site, stats in self.sites.items()),
+            key=lambda row: row["total_seconds"],
+            reverse=True,
+        )
+
+    def log_report(self):
+        for row in self.report():
+            logging.warning(
+                f"Event loop blocked {row['count']} times for "
+                f"{row['total_seconds']:.2f}s in total (max {row['max_seconds']:.2f}s) "
+                f"at {row['site']}"
+            )
+
+    async def _report_periodically(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.log_report()
@@ -0,0 +1,270 @@
+import asyncio
+import contextvars
+import logging
+
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import Session, attributes
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.models import (
+    Paragraph,
+    Question,
+    Answer,
+    Rating,
+    ProgressCounter,
+)
+from fleecekmbackend.core.config import (
+    COUNTER_FLUSH_DELAY,
+    COUNTER_RECONCILE_INTERVAL,
+)
+
+# counter name -> (model, flag column or None for the row total)
+COUNTERS = {
+    "paragraph_total": (Paragraph, None),
+    "paragraph_processed": (Paragraph, "processed"),
+    "question_total": (Question, None),
+    "question_filtered": (Question, "filtered"),
+    "question_rejected": (Question, "rejected"),
+    "question_processed": (Question, "processed"),
+    "answer_total": (Answer, None),
+    "answer_processed": (Answer, "processed"),
+    "rating_total": (Rating, None),
+}
+
+# stage name -> (done counter, total counter)
+STAGES = {
+    "generate_questions": ("paragraph_processed", "paragraph_total"),
+    "filter_questions": ("question_filtered", "question_total"),
+    "generate_answers": ("question_processed", "question_total"),
+    "generate_ratings": ("answer_processed", "answer_total"),
+}
+
+
+def _collect_deltas(session: Session):
+    deltas = {}
+
+    def bump(name, delta):
+        if delta:
+            deltas[name] = deltas.get(name, 0) + delta
+
+    for name, (model, flag) in COUNTERS.items():
+        for obj in session.new:
+            if isinstance(obj, model):
+                bump(name, 1 if flag is None else int(bool(getattr(obj, flag))))
+        for obj in session.deleted:
+            if isinstance(obj, model):
+                bump(name, -1 if flag is None else -int(bool(getattr(obj, flag))))
+        if flag is None:
+            continue
+        for obj in session.dirty:
+            if not isinstance(obj, model):
+                continue
+            history = attributes.get_history(obj, flag)
+            if not history.added:
+                continue
+            before = bool(history.deleted[0]) if history.deleted else False
+            bump(name, int(bool(history.added[0])) - int(before))
+    return deltas
+
+
+def row_deltas(model, rows, inserted: bool = True):
+    """Counter deltas for rows written with Core statements, which skip flush.
+
+    Updated rows are assumed to flip their flags from False to True, which is
+    the only direction the pipeline moves them.
+    """
+    deltas = {}
+    for name, (counter_model, flag) in COUNTERS.items():
+        if counter_model is not model:
+            continue
+        if flag is None:
+            delta = len(rows) if inserted else 0
+        else:
+            delta = sum(1 for row in rows if row.get(flag))
+        if delta:
+            deltas[name] = delta
+    return deltas
+
+
+# deltas committed by this process that are not in the counter rows yet
+_pending_deltas = {}
+_flusher = None
+
+
+def _merge(target, deltas):
+    for name, delta in deltas.items():
+        if delta:
+            target[name] = target.get(name, 0) + delta
+
+
+def _stage(session: Session, deltas):
+    _merge(session.info.setdefault("counter_deltas", {}), deltas)
+
+
+async def increment_counters(db: AsyncSession, deltas):
+    """Add ``deltas`` to the counters once ``db`` commits.
+
+    Nothing is written inside ``db``'s transaction: the counter rows are
+    shared by every writer, so updating them there would hold their locks
+    until commit and serialize all writers on a handful of rows.
+    """
+    _stage(db.sync_session, deltas)
+
+
+@event.listens_for(Session, "after_flush")
+def _stage_flushed_deltas(session, flush_context):
+    _stage(session, _collect_deltas(session))
+
+
+@event.listens_for(Session, "after_begin")
+def _clear_staged_deltas(session, transaction, connection):
+    session.info.pop("counter_deltas", None)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_staged_deltas(session):
+    session.info.pop("counter_deltas", None)
+
+
+@event.listens_for(Session, "after_commit")
+def _queue_committed_deltas(session):
+    global _flusher
+    deltas = session.info.pop("counter_deltas", None)
+    if not deltas:
+        return
+    _merge(_pending_deltas, deltas)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # no loop to flush on; the next flush_counters() picks them up
+    if _flusher is None or _flusher.done():
+        # created in a fresh context, so the flusher does not inherit the
+        # committing session's permit and counts as a top-level session
+        _flusher = contextvars.Context().run(loop.create_task, _run_flusher())
+
+
+async def _run_flusher():
+    while _pending_deltas:
+        await asyncio.sleep(COUNTER_FLUSH_DELAY)
+        await flush_counters()
+
+
+async def flush_counters():
+    """Apply the deltas this process has committed, in one short transaction.
+
+    Call before exiting: deltas still queued then are lost until the next
+    reconciliation.
+    """
+    global _pending_deltas
+    deltas, _pending_deltas = _pending_deltas, {}
+    if not deltas:
+        return
+    async with async_session() as db:
+        try:
+            # a fixed order, so concurrent flushers can't deadlock each other
+            for name in sorted(deltas):
+                await db.execute(
+                    update(ProgressCounter)
+                    .where(ProgressCounter.name == name)
+                    .values(value=ProgressCounter.value + deltas[name])
+                )
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            _merge(_pending_deltas, deltas)  # retried by the next flush
+            logging.error(f"Error flushing counters: {str(e)}")
+
+
+async def get_counters(db: AsyncSession):
+    result = await db.execute(select(ProgressCounter.name, ProgressCounter.value))
+    counters = {name: 0 for name in COUNTERS}
+    counters.update({name: int(value) for name, value in result.all()})
+    return counters
+
+
+async def get_counter(name: str):
+    async with async_session() as db:
+        try:
+            result = await db.execute(
+                select(ProgressCounter.value).where(ProgressCounter.name == name)
+            )
+            return int(result.scalar() or 0)
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error retrieving counter {name}: {str(e)}")
+            return -1
+
+
+async def get_stage_progress(db: AsyncSession):
+    counters = await get_counters(db)
+    progress = {}
+    for stage, (done_name, total_name) in STAGES.items():
+        done, total = counters[done_name], counters[total_name]
+        progress[stage] = {
+            "done": done,
+            "total": total,
+            "remaining": total - done,
+            "percentage": done / total * 100 if total else 0.0,
+        }
+    return progress
+
+
+async def reconcile_counters():
+    """Recompute every counter with COUNT(*) and overwrite the stored values.
+
+    Each counter is recounted under a lock on its row, so no delta can be
+    added between the count and the write. Other processes may still hold
+    deltas for rows the count already saw for up to ``COUNTER_FLUSH_DELAY``;
+    the next pass corrects the overcount they cause.
+    """
+    await flush_counters()
+    actual = {}
+    for name, (model, flag) in COUNTERS.items():
+        async with async_session() as db:
+            try:
+                stored = (
+                    await db.execute(
+                        select(ProgressCounter.value)
+                        .where(ProgressCounter.name == name)
+                        .with_for_update()
+                    )
+                ).scalar()
+                query = select(func.count(model.id))
+                if flag is not None:
+                    query = query.where(getattr(model, flag) == True)
+                value = actual[name] = (await db.execute(query)).scalar() or 0
+                if stored is None:
+                    db.add(ProgressCounter(name=name, value=value))
+                elif stored != value:
+                    logging.info(
+                        f"Counter {name} drifted: stored {stored}, actual {value}"
+                    )
+                    await db.execute(
+                        update(ProgressCounter)
+                        .where(ProgressCounter.name == name)
+                        .values(value=value)
+                    )
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error reconciling counter {name}: {str(e)}")
+                raise
+    return actual
+
+
+async def ensure_counters():
+    """Seed the counters table on first use; later runs keep the stored values."""
+    async with async_session() as db:
+        stored = (await db.execute(select(func.count(ProgressCounter.name)))).scalar()
+    if stored < len(COUNTERS):
+        await reconcile_counters()
+
+
+async def run_counter_reconciliation(interval: float = COUNTER_RECONCILE_INTERVAL):
+    while True:
+        try:
+            await reconcile_counters()
+        except Exception:
+            pass  # already logged, try again on the next tick
+        await asyncio.sleep(interval)
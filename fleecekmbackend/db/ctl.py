@@ -1,21 +1,276 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import event
-from fleecekmbackend.core.config import DATABASE_URL
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from fleecekmbackend.core.config import (
+    DATABASE_URL,
+    DATABASE_REPLICA_URLS,
+    REPLICA_MAX_LAG,
+    REPLICA_LAG_CHECK_INTERVAL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_MAX_SESSIONS,
+    DB_NESTED_SESSION_RESERVE,
+    SQLITE_BUSY_TIMEOUT,
+)
+from fleecekmbackend.core.metrics import (
+    DB_POOL_CONNECTIONS,
+    DB_SESSION_WAIT_SECONDS,
+    DB_SESSIONS,
+)
+
+
+def is_sqlite(url=DATABASE_URL):
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; NORMAL sync is safe
+    # with WAL and avoids an fsync per commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    cursor.close()
+
+
+def _create_engine(url):
+    if is_sqlite(url):
+        sqlite_engine = create_async_engine(
+            url,
+            connect_args={"timeout": SQLITE_BUSY_TIMEOUT},
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+        event.listen(sqlite_engine.sync_engine, "connect", _set_sqlite_pragmas)
+        return sqlite_engine
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=3600,
+    )
+
+
+# set while a task holds a session permit; tasks it spawns inherit it, which
+# marks their sessions as nested
+_under_session_permit = contextvars.ContextVar("under_session_permit", default=False)
+
+
+class SessionLimiter:
+    """Process-wide bound on concurrently open sessions.
+
+    Every session takes a permit, including sessions opened while the same
+    task or a parent task already holds one, so open sessions never exceed
+    ``limit``. Top-level sessions may only hold ``limit - reserve`` permits
+    between them; the rest are left to nested sessions (for example
+    create_author_if_not_exists inside a stage session, or tasks gathered
+    under one), so a parent never deadlocks waiting on its own children.
+    """
+
+    def __init__(
+        self, limit: int = DB_MAX_SESSIONS, reserve: int = DB_NESTED_SESSION_RESERVE
+    ):
+        self.limit = limit
+        self.reserve = min(reserve, limit - 1)
+        self._semaphore = asyncio.Semaphore(limit)
+        self._top_level = asyncio.Semaphore(limit - self.reserve)
+        self._holders = {}  # task -> permits it holds
+        self.active = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @asynccontextmanager
+    async def permit(self):
+        task = asyncio.current_task()
+        nested = _under_session_permit.get() or self._holders.get(task, 0) > 0
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            if not nested:
+                await self._top_level.acquire()
+            try:
+                await self._semaphore.acquire()
+            except BaseException:
+                if not nested:
+                    self._top_level.release()
+                raise
+        finally:
+            self.waiting -= 1
+        wait = time.perf_counter() - start
+        DB_SESSION_WAIT_SECONDS.observe(wait)
+        self.acquired += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.active += 1
+        self._holders[task] = self._holders.get(task, 0) + 1
+        token = _under_session_permit.set(True)
+        try:
+            yield
+        finally:
+            _under_session_permit.reset(token)
+            self._holders[task] -= 1
+            if not self._holders[task]:
+                del self._holders[task]
+            self.active -= 1
+            self._semaphore.release()
+            if not nested:
+                self._top_level.release()
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "wait_avg": self.wait_total / self.acquired if self.acquired else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+session_limiter = SessionLimiter()
+DB_SESSIONS.set_function(lambda: session_limiter.active, state="active")
+DB_SESSIONS.set_function(lambda: session_limiter.waiting, state="waiting")
+
+
+class BoundedSessionMaker:
+    """Drop-in for a sessionmaker whose sessions count against the limiter."""
+
+    def __init__(self, maker: sessionmaker, limiter: SessionLimiter = session_limiter):
+        self.maker = maker
+        self.limiter = limiter
+
+    @asynccontextmanager
+    async def __call__(self):
+        async with self.limiter.permit():
+            async with self.maker() as db:
+                yield db
 
-engine = create_async_engine(
-    DATABASE_URL, pool_size=4096, max_overflow=4096, pool_recycle=3600
+
+engine = _create_engine(DATABASE_URL)
+async_session = BoundedSessionMaker(
+    sessionmaker(engine, class_=AsyncSession, autoflush=True)
 )
-async_session = sessionmaker(engine, class_=AsyncSession, autoflush=True)
 Base = declarative_base()
 
 
+class Replica:
+    def __init__(self, url):
+        self.url = make_url(url).render_as_string(hide_password=True)
+        self.engine = _create_engine(url)
+        self.session = BoundedSessionMaker(
+            sessionmaker(self.engine, class_=AsyncSession, autoflush=True)
+        )
+        self.lag = None  # seconds behind the primary, None if unknown/broken
+        self.checked_at = 0.0
+
+    async def refresh_lag(self):
+        self.checked_at = time.monotonic()  # one probe at a time per interval
+        try:
+            async with self.engine.connect() as conn:
+                if conn.dialect.name != "mysql":
+                    self.lag = 0.0  # no replication protocol to ask
+                else:
+                    try:
+                        status = await conn.execute(text("SHOW REPLICA STATUS"))
+                    except Exception:  # MySQL < 8.0.22
+                        status = await conn.execute(text("SHOW SLAVE STATUS"))
+                    row = status.mappings().first()
+                    row = dict(row) if row is not None else {}
+                    lag = row.get(
+                        "Seconds_Behind_Source", row.get("Seconds_Behind_Master")
+                    )
+                    self.lag = float(lag) if lag is not None else None
+        except Exception as e:
+            logging.warning(f"Replica {self.url} unavailable: {str(e)}")
+            self.lag = None
+        return self.lag
+
+
+replicas = [Replica(url) for url in DATABASE_REPLICA_URLS]
+_replica_cycle = itertools.cycle(replicas) if replicas else None
+
+
+async def _pick_replica(max_lag: float):
+    for _ in range(len(replicas)):
+        replica = next(_replica_cycle)
+        if time.monotonic() - replica.checked_at > REPLICA_LAG_CHECK_INTERVAL:
+            await replica.refresh_lag()
+        if replica.lag is not None and replica.lag <= max_lag:
+            return replica
+    return None
+
+
+@asynccontextmanager
+async def read_session(max_lag: float = REPLICA_MAX_LAG):
+    """Session for read-only work: a replica within ``max_lag`` seconds of the
+    primary if one is available, otherwise the primary itself."""
+    replica = await _pick_replica(max_lag) if replicas else None
+    maker = replica.session if replica is not None else async_session
+    async with maker() as db:
+        yield db
+
+
+def pool_stats(pool_engine=engine):
+    pool = pool_engine.sync_engine.pool
+    stats = {"status": pool.status()}
+    for name in ["size", "checkedin", "checkedout", "overflow"]:
+        if hasattr(pool, name):  # NullPool/StaticPool do not track these
+            stats[name] = getattr(pool, name)()
+    return stats
+
+
+for _state in ["size", "checkedout", "overflow"]:
+    DB_POOL_CONNECTIONS.set_function(
+        lambda state=_state: pool_stats(engine).get(state, 0), state=_state
+    )
+
+
+def get_pool_stats():
+    return {
+        "sessions": session_limiter.stats(),
+        "primary": pool_stats(engine),
+        "replicas": {replica.url: pool_stats(replica.engine) for replica in replicas},
+    }
+
+
+async def log_pool_stats(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        stats = get_pool_stats()
+        sessions, primary = stats["sessions"], stats["primary"]
+        print(
+            f"DB pool: {primary.get('checkedout', '?')}/{primary.get('size', '?')} "
+            f"checked out, overflow {primary.get('overflow', '?')}; "
+            f"sessions {sessions['active']}/{sessions['limit']} active, "
+            f"{sessions['waiting']} waiting, wait avg {sessions['wait_avg'] * 1000:.1f}ms "
+            f"max {sessions['wait_max'] * 1000:.1f}ms"
+        )
+
+
 async def get_db():
     async with async_session() as db:
         yield db
 
 
+async def get_read_db():
+    async with read_session() as db:
+        yield db
+
+
 async def create_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,116 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import delete, exists, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.core.config import DEAD_LETTER_MAX_FAILURES
+from fleecekmbackend.core.metrics import DEAD_LETTERED
+from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.models import DeadLetter
+
+# errors are stored in full, but a huge one (say, a whole response) is cut here
+MAX_ERROR_LENGTH = 8192
+
+
+def not_dead_lettered(model, max_failures: int = DEAD_LETTER_MAX_FAILURES):
+    """Condition for claim queries: the row is not in the dead-letter table
+    with ``max_failures`` or more failures."""
+    return ~exists().where(
+        DeadLetter.item_type == model.__tablename__,
+        DeadLetter.item_id == model.id,
+        DeadLetter.attempts >= max_failures,
+    )
+
+
+async def record_failure(
+    model,
+    item_id: int,
+    error: Exception,
+    stage: str = None,
+    prompt: str = None,
+    max_failures: int = DEAD_LETTER_MAX_FAILURES,
+):
+    """Count a failed attempt at a row; at ``max_failures`` the row is
+    dead-lettered and claims skip it until it is replayed.
+
+    Uses its own session, so the caller's rolled back transaction does not
+    take the record with it. Returns the number of failures so far.
+    """
+    item_type = model.__tablename__
+    now = datetime.now()
+    values = {
+        "stage": stage,
+        "error_class": type(error).__name__,
+        "error": str(error)[:MAX_ERROR_LENGTH],
+        "last_failed_at": now,
+    }
+    if prompt is not None:
+        values["last_prompt"] = prompt
+    where = (DeadLetter.item_type == item_type, DeadLetter.item_id == item_id)
+    attempts = None
+    async with async_session() as db:
+        try:
+            for _ in range(2):
+                result = await db.execute(
+                    update(DeadLetter)
+                    .where(*where)
+                    .values(attempts=DeadLetter.attempts + 1, **values)
+                )
+                if result.rowcount == 0:
+                    try:
+                        await db.execute(
+                            insert(DeadLetter).values(
+                                item_type=item_type,
+                                item_id=item_id,
+                                attempts=1,
+                                first_failed_at=now,
+                                **values,
+                            )
+                        )
+                    except IntegrityError:
+                        # another worker recorded the first failure meanwhile
+                        await db.rollback()
+                        continue
+                attempts = await db.scalar(select(DeadLetter.attempts).where(*where))
+                await db.commit()
+                break
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error recording failure of {item_type} {item_id}: {str(e)}")
+            return None
+    if attempts == max_failures:
+        DEAD_LETTERED.inc(item_type=item_type)
+        logging.warning(
+            f"{item_type} {item_id} failed {attempts} times and was dead-lettered: "
+            f"{values['error_class']}: {values['error']}"
+        )
+    return attempts
+
+
+async def get_dead_letters(
+    db: AsyncSession,
+    item_type: str = None,
+    item_ids=None,
+    max_failures: int = DEAD_LETTER_MAX_FAILURES,
+):
+    query = select(DeadLetter).where(DeadLetter.attempts >= max_failures)
+    if item_type is not None:
+        query = query.where(DeadLetter.item_type == item_type)
+    if item_ids:
+        query = query.where(DeadLetter.item_id.in_(item_ids))
+    result = await db.execute(query.order_by(DeadLetter.last_failed_at))
+    return result.scalars().all()
+
+
+async def clear_dead_letters(db: AsyncSession, item_type: str = None, item_ids=None):
+    """Forget the failures of rows, so claims pick them up again. Rows that
+    failed fewer times than the limit are reset too. Returns the rows removed."""
+    query = delete(DeadLetter)
+    if item_type is not None:
+        query = query.where(DeadLetter.item_type == item_type)
+    if item_ids:
+        query = query.where(DeadLetter.item_id.in_(item_ids))
+    result = await db.execute(query)
+    return result.rowcount
@@ -2,16 +2,63 @@ import asyncio
 import random
 import hashlib
 
-from aiomysql import IntegrityError
 from fleecekmbackend.db.ctl import async_session, engine
-from fleecekmbackend.db.models import Paragraph, Author, Question, Answer
-from sqlalchemy import Column, Integer, func, select, text, update
-from sqlalchemy.dialects.mysql import insert
-from sqlalchemy.ext.asyncio import AsyncSession
+from fleecekmbackend.db.models import (
+    Paragraph,
+    Author,
+    Question,
+    Answer,
+    DEDUP_KEYS,
+    content_hash,
+    fill_derived_columns,
+)
+from fleecekmbackend.db.deadletter import not_dead_lettered
+from fleecekmbackend.db.counters import (
+    COUNTERS,
+    get_counters,
+    increment_counters,
+    reconcile_counters,
+)
+from collections import defaultdict
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import Column, Integer, func, insert, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
 import pandas as pd
 import logging
 from tqdm import tqdm
 
+from fleecekmbackend.core.config import PAGE_CLAIM_MAX_PARAGRAPHS
+
+
+async def truncate_table(conn: AsyncConnection, table_name: str):
+    if conn.dialect.name == "sqlite":
+        await conn.execute(text(f"DELETE FROM {table_name}"))
+    else:
+        await conn.execute(text(f"TRUNCATE TABLE {table_name}"))
+    await conn.commit()
+
+
+async def column_exists(conn: AsyncConnection, table_name: str, column_name: str):
+    columns = await conn.run_sync(
+        lambda sync_conn: inspect(sync_conn).get_columns(table_name)
+    )
+    return any(column["name"] == column_name for column in columns)
+
+
+async def allow_explicit_zero_ids(conn: AsyncConnection):
+    # MySQL replaces an explicit id of 0 with the next autoincrement value
+    # unless told otherwise; SQLite keeps explicit ids as they are
+    if conn.dialect.name == "mysql":
+        await conn.execute(text("SET SESSION sql_mode='NO_AUTO_VALUE_ON_ZERO'"))
+
+
+def add_paragraph_hashes(df: pd.DataFrame):
+    if "text_cleaned" in df.columns:
+        df["text_cleaned_hash"] = df["text_cleaned"].map(content_hash)
+    return df
+
 
 async def load_csv_data_rand_n(file, n, overwrite=False):
     async with async_session() as db:
@@ -24,9 +71,7 @@ async def load_csv_data_rand_n(file, n, overwrite=False):
                 )
 
                 if overwrite and table_exists:
-                    await conn.execute(
-                        text(f"TRUNCATE TABLE {Paragraph.__tablename__}")
-                    )
+                    await truncate_table(conn, Paragraph.__tablename__)
                     logging.info("Existing entries in the database have been removed.")
                 elif table_exists and not overwrite:
                     result = await conn.execute(
@@ -42,6 +87,7 @@ async def load_csv_data_rand_n(file, n, overwrite=False):
             df = pd.read_csv(file)
             df["within_page_order"] = df.groupby("page_name").cumcount()
             df = df.where(pd.notnull(df), None)
+            df = add_paragraph_hashes(df)
 
             # Rename 'id' to 'original_entry_id'
             df = df.rename(columns={"id": "original_entry_id"})
@@ -66,16 +112,9 @@ async def load_csv_data_rand_n(file, n, overwrite=False):
             else:
                 # Check if original_entry_id column exists, if not, add it
                 async with engine.begin() as conn:
-                    result = await conn.execute(
-                        text(
-                            f"SELECT COUNT(*) FROM information_schema.COLUMNS "
-                            f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{Paragraph.__tablename__}' "
-                            f"AND COLUMN_NAME = 'original_entry_id'"
-                        )
-                    )
-                    column_exists = result.scalar() > 0
-
-                    if not column_exists:
+                    if not await column_exists(
+                        conn, Paragraph.__tablename__, "original_entry_id"
+                    ):
                         await conn.execute(
                             text(
                                 f"ALTER TABLE {Paragraph.__tablename__} ADD COLUMN original_entry_id INTEGER"
@@ -87,6 +126,7 @@ async def load_csv_data_rand_n(file, n, overwrite=False):
                     await conn.execute(
                         Paragraph.__table__.insert().values(row.to_dict())
                     )
+            await reconcile_counters()
         except Exception as e:
             logging.error(f"Error loading CSV data: {str(e)}")
             await db.rollback()
@@ -117,18 +157,20 @@ async def load_csv_data_top_n(file, n):
             df = pd.read_csv(file)
             df["within_page_order"] = df.groupby("page_name").cumcount()
             df = df.where(pd.notnull(df), None)
+            df = add_paragraph_hashes(df)
             df = df.head(n)
 
             if not table_exists:
                 async with engine.begin() as conn:
                     await conn.run_sync(Paragraph.__table__.create)
             async with engine.begin() as conn:
-                await conn.execute(text("SET SESSION sql_mode='NO_AUTO_VALUE_ON_ZERO'"))
+                await allow_explicit_zero_ids(conn)
 
                 for _, row in tqdm(df.iterrows(), total=n, desc="Inserting data"):
                     await conn.execute(
                         Paragraph.__table__.insert().values(row.to_dict())
                     )
+            await reconcile_counters()
         except Exception as e:
             logging.error(f"Error loading CSV data: {str(e)}")
             await conn.rollback()
@@ -158,17 +200,19 @@ async def load_csv_data(file):
             df = pd.read_csv(file)
             df["within_page_order"] = df.groupby("page_name").cumcount()
             df = df.where(pd.notnull(df), None)
+            df = add_paragraph_hashes(df)
 
             if not table_exists:
                 async with engine.begin() as conn:
                     await conn.run_sync(Paragraph.__table__.create)
             async with engine.begin() as conn:
-                await conn.execute(text("SET SESSION sql_mode='NO_AUTO_VALUE_ON_ZERO'"))
+                await allow_explicit_zero_ids(conn)
 
                 for _, row in tqdm(df.iterrows(), total=len(df), desc="Inserting data"):
                     await conn.execute(
                         Paragraph.__table__.insert().values(row.to_dict())
                     )
+            await reconcile_counters()
         except Exception as e:
             logging.error(f"Error loading CSV data: {str(e)}")
             await conn.rollback()
@@ -187,9 +231,7 @@ async def load_csv_data_all(file, overwrite=False):
                 )
 
                 if overwrite and table_exists:
-                    await conn.execute(
-                        text(f"TRUNCATE TABLE {Paragraph.__tablename__}")
-                    )
+                    await truncate_table(conn, Paragraph.__tablename__)
                     logging.info("Existing entries in the database have been removed.")
                 elif table_exists and not overwrite:
                     result = await conn.execute(
@@ -205,14 +247,16 @@ async def load_csv_data_all(file, overwrite=False):
             df = pd.read_csv(file)
             df["within_page_order"] = df.groupby("page_name").cumcount()
             df = df.where(pd.notnull(df), None)
+            df = add_paragraph_hashes(df)
 
             # Rename 'id' to 'original_entry_id'
             df = df.rename(columns={"id": "original_entry_id"})
 
-            # Sort by length of 'text' column in reverse order
-            df["text_length"] = df["text"].str.len()
-            df = df.sort_values("text_length", ascending=False).drop(
-                "text_length", axis=1
+            # Keep each page's paragraphs next to each other and in page order,
+            # pages in the order they first appear, so ids follow pages
+            df["page_rank"] = pd.factorize(df["page_name"])[0]
+            df = df.sort_values(["page_rank", "within_page_order"], kind="stable").drop(
+                "page_rank", axis=1
             )
 
             if not table_exists:
@@ -225,16 +269,9 @@ async def load_csv_data_all(file, overwrite=False):
             else:
                 # Check if original_entry_id column exists, if not, add it
                 async with engine.begin() as conn:
-                    result = await conn.execute(
-                        text(
-                            f"SELECT COUNT(*) FROM information_schema.COLUMNS "
-                            f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{Paragraph.__tablename__}' "
-                            f"AND COLUMN_NAME = 'original_entry_id'"
-                        )
-                    )
-                    column_exists = result.scalar() > 0
-
-                    if not column_exists:
+                    if not await column_exists(
+                        conn, Paragraph.__tablename__, "original_entry_id"
+                    ):
                         await conn.execute(
                             text(
                                 f"ALTER TABLE {Paragraph.__tablename__} ADD COLUMN original_entry_id INTEGER"
@@ -251,6 +288,7 @@ async def load_csv_data_all(file, overwrite=False):
                         [row.to_dict() for _, row in chunk.iterrows()],
                     )
 
+            await reconcile_counters()
             logging.info(f"Successfully loaded {len(df)} entries into the database.")
 
         except Exception as e:
@@ -308,14 +346,14 @@ async def get_random_unprocessed_paragraphs(db: AsyncSession, n: int = 1):
         return -1
 
 
-async def get_next_unprocessed_paragraphs(db: AsyncSession, n: int = 1):
+async def get_next_unprocessed_paragraphs(db: AsyncSession, n: int = 1, exclude_ids=()):
     try:
-        query = (
-            select(Paragraph)
-            .filter(Paragraph.processed == False)
-            .limit(n)
-            .with_for_update(skip_locked=True)
+        query = select(Paragraph).filter(
+            Paragraph.processed == False, not_dead_lettered(Paragraph)
         )
+        if exclude_ids:
+            query = query.filter(Paragraph.id.not_in(exclude_ids))
+        query = query.limit(n).with_for_update(skip_locked=True)
         result = await db.execute(query)
         paragraphs = result.scalars().all()
         if not paragraphs:
@@ -328,27 +366,69 @@ async def get_next_unprocessed_paragraphs(db: AsyncSession, n: int = 1):
         return []
 
 
+async def claim_page_paragraphs(
+    db: AsyncSession,
+    page_name: str = None,
+    n: int = PAGE_CLAIM_MAX_PARAGRAPHS,
+    exclude_ids=(),
+):
+    """Lock up to ``n`` unprocessed paragraphs of one page, in page order.
+
+    Without ``page_name``, the page of the first unprocessed paragraph that no
+    other session holds is taken. Locks end with the transaction, so a worker
+    going through a page claims it again after each commit.
+    """
+    try:
+        if page_name is None:
+            query = select(Paragraph.page_name).filter(
+                Paragraph.processed == False, not_dead_lettered(Paragraph)
+            )
+            if exclude_ids:
+                query = query.filter(Paragraph.id.not_in(exclude_ids))
+            result = await db.execute(query.limit(1).with_for_update(skip_locked=True))
+            row = result.first()
+            if row is None:
+                return []
+            page_name = row.page_name
+        query = select(Paragraph).filter(
+            Paragraph.page_name == page_name,
+            Paragraph.processed == False,
+            not_dead_lettered(Paragraph),
+        )
+        if exclude_ids:
+            query = query.filter(Paragraph.id.not_in(exclude_ids))
+        result = await db.execute(
+            query.order_by(Paragraph.within_page_order, Paragraph.id)
+            .limit(n)
+            .with_for_update(skip_locked=True)
+        )
+        return result.scalars().all()
+
+    except Exception as e:
+        await db.rollback()
+        logging.error(f"Error claiming paragraphs of page {page_name}: {str(e)}")
+        return []
+
+
 async def get_unprocessed_paragraphs_count():
     async with async_session() as db:
         try:
-            query = select(func.count(Paragraph.id)).where(Paragraph.processed == False)
-            result = await db.execute(query)
-            count = result.scalar()
-            return count
+            counters = await get_counters(db)
+            return counters["paragraph_total"] - counters["paragraph_processed"]
         except Exception as e:
             await db.rollback()
             logging.error(f"Error retrieving unprocessed paragraphs count: {str(e)}")
             return -1
 
 
-async def get_next_unfiltered_questions(db: AsyncSession, n: int = 1):
+async def get_next_unfiltered_questions(db: AsyncSession, n: int = 1, exclude_ids=()):
     try:
-        query = (
-            select(Question)
-            .filter(Question.filtered == False)
-            .limit(n)
-            .with_for_update(skip_locked=True)
+        query = select(Question).filter(
+            Question.filtered == False, not_dead_lettered(Question)
         )
+        if exclude_ids:
+            query = query.filter(Question.id.not_in(exclude_ids))
+        query = query.limit(n).with_for_update(skip_locked=True)
         result = await db.execute(query)
         questions = result.scalars().all()
         if not questions:
@@ -364,24 +444,22 @@ async def get_next_unfiltered_questions(db: AsyncSession, n: int = 1):
 async def get_unfiltered_questions_count():
     async with async_session() as db:
         try:
-            query = select(func.count(Question.id)).where(Question.filtered == False)
-            result = await db.execute(query)
-            count = result.scalar()
-            return count
+            counters = await get_counters(db)
+            return counters["question_total"] - counters["question_filtered"]
         except Exception as e:
             await db.rollback()
             logging.error(f"Error retrieving unfiltered questions count: {str(e)}")
             return -1
 
 
-async def get_next_unprocessed_questions(db: AsyncSession, n: int = 1):
+async def get_next_unprocessed_questions(db: AsyncSession, n: int = 1, exclude_ids=()):
     try:
-        query = (
-            select(Question)
-            .filter(Question.processed == False)
-            .limit(n)
-            .with_for_update(skip_locked=True)
+        query = select(Question).filter(
+            Question.processed == False, not_dead_lettered(Question)
         )
+        if exclude_ids:
+            query = query.filter(Question.id.not_in(exclude_ids))
+        query = query.limit(n).with_for_update(skip_locked=True)
         result = await db.execute(query)
         questions = result.scalars().all()
         if not questions:
@@ -397,24 +475,22 @@ async def get_next_unprocessed_questions(db: AsyncSession, n: int = 1):
 async def get_unprocessed_questions_count():
     async with async_session() as db:
         try:
-            query = select(func.count(Question.id)).where(Question.processed == False)
-            result = await db.execute(query)
-            count = result.scalar()
-            return count
+            counters = await get_counters(db)
+            return counters["question_total"] - counters["question_processed"]
         except Exception as e:
             await db.rollback()
             logging.error(f"Error retrieving unprocessed questions count: {str(e)}")
             return -1
 
 
-async def get_next_unprocessed_answers(db: AsyncSession, n: int = 1):
+async def get_next_unprocessed_answers(db: AsyncSession, n: int = 1, exclude_ids=()):
     try:
-        query = (
-            select(Answer)
-            .filter(Answer.processed == False)
-            .limit(n)
-            .with_for_update(skip_locked=True)
+        query = select(Answer).filter(
+            Answer.processed == False, not_dead_lettered(Answer)
         )
+        if exclude_ids:
+            query = query.filter(Answer.id.not_in(exclude_ids))
+        query = query.limit(n).with_for_update(skip_locked=True)
         result = await db.execute(query)
         answers = result.scalars().all()
         if not answers:
@@ -430,16 +506,91 @@ async def get_next_unprocessed_answers(db: AsyncSession, n: int = 1):
 async def get_unprocessed_answers_count():
     async with async_session() as db:
         try:
-            query = select(func.count(Answer.id)).where(Answer.processed == False)
-            result = await db.execute(query)
-            count = result.scalar()
-            return count
+            counters = await get_counters(db)
+            return counters["answer_total"] - counters["answer_processed"]
         except Exception as e:
             await db.rollback()
             logging.error(f"Error retrieving unprocessed answers count: {str(e)}")
             return -1
 
 
+async def find_existing(model, dedup_key: str):
+    """Look up a row by its natural key before spending an LLM call on it.
+
+    Uses its own session: callers generate concurrently on a shared session,
+    which must not be used from several tasks at once.
+    """
+    async with async_session() as db:
+        result = await db.execute(select(model).where(model.dedup_key == dedup_key))
+        return result.scalars().first()
+
+
+async def find_existing_many(model, dedup_keys):
+    """find_existing for a whole batch in one query: the rows that exist among
+    ``dedup_keys``, by key."""
+    dedup_keys = set(dedup_keys)
+    if not dedup_keys:
+        return {}
+    async with async_session() as db:
+        result = await db.execute(select(model).where(model.dedup_key.in_(dedup_keys)))
+        return {row.dedup_key: row for row in result.scalars().all()}
+
+
+async def insert_ignore(db: AsyncSession, model, rows):
+    """INSERT rows, skipping those whose unique keys already exist.
+
+    Returns the number of rows actually inserted.
+    """
+    if not rows:
+        return 0
+    rows = [fill_derived_columns(model, dict(row)) for row in rows]
+    if db.bind.dialect.name == "sqlite":
+        stmt = sqlite_insert(model.__table__).on_conflict_do_nothing()
+    else:
+        stmt = mysql_insert(model.__table__).prefix_with("IGNORE")
+    connection = await db.connection()
+    result = await connection.execute(stmt, rows)
+    inserted = result.rowcount
+    # skipped rows are duplicates of rows already counted; new generated rows
+    # never carry a set flag, so only the totals move
+    await increment_counters(
+        db,
+        {
+            name: inserted
+            for name, (counter_model, flag) in COUNTERS.items()
+            if counter_model is model and flag is None and inserted
+        },
+    )
+    if inserted < len(rows):
+        logging.info(
+            f"Skipped {len(rows) - inserted} duplicate {model.__tablename__} rows"
+        )
+    return inserted
+
+
+def row_from_object(obj):
+    row = {}
+    for column in inspect(type(obj)).columns:
+        value = getattr(obj, column.key)
+        if value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        row[column.key] = value
+    return row
+
+
+async def add_idempotent(db: AsyncSession, objects):
+    """Add objects to the session; new rows of models with a natural key are
+    written with insert_ignore so retried or overlapping work is a no-op."""
+    rows = defaultdict(list)
+    for obj in objects:
+        if type(obj) in DEDUP_KEYS and inspect(obj).transient:
+            rows[type(obj)].append(row_from_object(obj))
+        else:
+            db.add(obj)
+    for model, model_rows in rows.items():
+        await insert_ignore(db, model, model_rows)
+
+
 async def get_page_raw(db: AsyncSession, index: int = -1):
     if (
         index == -1
@@ -468,10 +619,23 @@ def generate_hash(model: str, prompt: str) -> str:
     return hashlib.sha256(f"{model}:{prompt}".encode("utf-8")).hexdigest()
 
 
+# author rows are immutable once created, so their ids can be cached per process
+_author_ids = {}
+# one creation attempt per author at a time; concurrent callers (several
+# answer targets starting at once) wait for it and read the cache
+_author_locks = defaultdict(asyncio.Lock)
+
+
 async def create_author_if_not_exists(
-    prompt: str, model: str, max_retries: int = 3, initial_delay: float = 1.0
+    prompt: str,
+    model: str,
+    kind: str = None,
+    max_retries: int = 3,
+    initial_delay: float = 1.0,
 ):
     hash_value = generate_hash(model, prompt)
+    if hash_value in _author_ids:
+        return _author_ids[hash_value]
 
     async def attempt_create_author(db: AsyncSession):
         # Check if the author already exists
@@ -482,11 +646,13 @@ async def create_author_if_not_exists(
             existing_author = result.scalars().first()
 
             if existing_author:
+                if kind is not None and existing_author.kind is None:
+                    existing_author.kind = kind  # created before kinds existed
                 return existing_author.id
 
             # If the author does not exist, insert a new one
             insert_stmt = insert(Author).values(
-                model=model, prompt=prompt, hash=hash_value
+                model=model, prompt=prompt, hash=hash_value, kind=kind
             )
             try:
                 result = await db.execute(insert_stmt)
@@ -506,18 +672,25 @@ async def create_author_if_not_exists(
                     raise
 
     delay = initial_delay
-    for attempt in range(max_retries):
-        try:
-            async with async_session() as db:
-                return await attempt_create_author(db)
-        except Exception as e:
-            if attempt == max_retries - 1:
-                logging.error(f"Failed to create author after {max_retries} attempts.")
-                raise
-            logging.warning(
-                f"Attempt {attempt + 1} failed: {e}. Retrying in {delay} seconds..."
-            )
-            await asyncio.sleep(delay)
-            delay *= 2  # Exponential backoff
+    async with _author_locks[hash_value]:
+        if hash_value in _author_ids:
+            return _author_ids[hash_value]
+        for attempt in range(max_retries):
+            try:
+                async with async_session() as db:
+                    author_id = await attempt_create_author(db)
+                _author_ids[hash_value] = author_id
+                return author_id
+            except Exception as e:
+                if attempt == max_retries - 1:
+                    logging.error(
+                        f"Failed to create author after {max_retries} attempts."
+                    )
+                    raise
+                logging.warning(
+                    f"Attempt {attempt + 1} failed: {e}. Retrying in {delay} seconds..."
+                )
+                await asyncio.sleep(delay)
+                delay *= 2  # Exponential backoff
 
     raise Exception("Unexpected error: All retries failed but no exception was raised.")
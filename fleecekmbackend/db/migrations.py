@@ -0,0 +1,253 @@
+import logging
+
+from sqlalchemy import exists, func, inspect, or_, select, update
+from sqlalchemy.schema import CreateIndex
+
+from fleecekmbackend.db.ctl import Base, async_session, engine
+from fleecekmbackend.db.models import (
+    DEDUP_KEYS,
+    HASHED_COLUMNS,
+    TIMESTAMPED_MODELS,
+    Answer,
+    Author,
+    Paragraph,
+    Question,
+    Rating,
+    RejectedQuestion,
+    content_hash,
+    parse_timestamp,
+)
+
+
+def _missing_columns(sync_conn):
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # create_all takes care of new tables
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in present:
+                missing.append((table, column))
+    return missing
+
+
+def _missing_indexes(sync_conn):
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in present)
+    return missing
+
+
+async def add_missing_columns():
+    """Add columns and indexes declared on the models but absent from tables
+    created by an older version. create_all never alters tables."""
+    async with engine.begin() as conn:
+        missing = await conn.run_sync(_missing_columns)
+        for table, column in missing:
+            column_type = column.type.compile(dialect=conn.dialect)
+            await conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            )
+            logging.info(f"Added column {table.name}.{column.name}")
+        # includes the indexes of the columns just added
+        for index in await conn.run_sync(_missing_indexes):
+            logging.info(f"Creating index {index.name} on {index.table.name}")
+            await conn.execute(CreateIndex(index))
+    return [f"{table.name}.{column.name}" for table, column in missing]
+
+
+async def _backfill_column(model, source, target, transform, batch_size):
+    """Fill ``target`` from ``source`` for rows where it is still NULL.
+
+    Walks the table in primary key order so every batch is an index range scan,
+    and commits per batch to keep transactions short on large tables. Rows whose
+    value cannot be derived are skipped rather than revisited.
+    """
+    source_column = getattr(model, source)
+    target_column = getattr(model, target)
+    last_id = -1
+    filled = 0
+    while True:
+        async with async_session() as db:
+            try:
+                result = await db.execute(
+                    select(model.id, source_column)
+                    .where(model.id > last_id)
+                    .where(target_column.is_(None))
+                    .where(source_column.is_not(None))
+                    .order_by(model.id)
+                    .limit(batch_size)
+                )
+                rows = result.all()
+                if not rows:
+                    break
+                values = [
+                    {"id": row_id, target: transform(value)} for row_id, value in rows
+                ]
+                values = [row for row in values if row[target] is not None]
+                if values:
+                    await db.execute(update(model), values)
+                    await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(
+                    f"Error backfilling {model.__tablename__}.{target}: {str(e)}"
+                )
+                raise
+        last_id = rows[-1][0]
+        filled += len(values)
+    logging.info(f"Backfilled {filled} rows of {model.__tablename__}.{target}")
+    return filled
+
+
+async def backfill_content_hashes(batch_size: int = 1000):
+    """Fill hash columns left NULL by rows written before they existed."""
+    filled = {}
+    for model, (source, target) in HASHED_COLUMNS.items():
+        filled[f"{model.__tablename__}.{target}"] = await _backfill_column(
+            model, source, target, content_hash, batch_size
+        )
+    return filled
+
+
+async def backfill_timestamps(batch_size: int = 1000):
+    """Parse the legacy string timestamps into created_at, then estimate
+    Paragraph.processed_at from the newest question generated for it (the
+    paragraph is flagged in the same transaction that stores its questions)."""
+    filled = {}
+    for model in TIMESTAMPED_MODELS:
+        filled[f"{model.__tablename__}.created_at"] = await _backfill_column(
+            model, "timestamp", "created_at", parse_timestamp, batch_size
+        )
+
+    async with async_session() as db:
+        max_id = (await db.execute(select(func.max(Paragraph.id)))).scalar() or 0
+    newest_question = (
+        select(func.max(Question.created_at))
+        .where(Question.paragraph_id == Paragraph.id)
+        .scalar_subquery()
+    )
+    filled["paragraph.processed_at"] = 0
+    for start in range(-1, max_id, batch_size):
+        async with async_session() as db:
+            try:
+                result = await db.execute(
+                    update(Paragraph)
+                    .where(Paragraph.id > start, Paragraph.id <= start + batch_size)
+                    .where(Paragraph.processed == True)
+                    .where(Paragraph.processed_at.is_(None))
+                    .where(newest_question.is_not(None))
+                    .values(processed_at=newest_question)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                filled["paragraph.processed_at"] += result.rowcount
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error backfilling paragraph.processed_at: {str(e)}")
+                raise
+    return filled
+
+
+async def backfill_dedup_keys(batch_size: int = 1000):
+    """Give legacy answers and ratings their natural keys.
+
+    When older runs stored duplicates, the lowest id keeps the key and the later
+    copies are left NULL, which the unique index allows.
+    """
+    filled = {}
+    for model, build_key in DEDUP_KEYS.items():
+        columns = [column.key for column in model.__table__.columns]
+        last_id = -1
+        filled[model.__tablename__] = 0
+        duplicates = 0
+        while True:
+            async with async_session() as db:
+                try:
+                    result = await db.execute(
+                        select(model.__table__)
+                        .where(model.id > last_id)
+                        .where(model.dedup_key.is_(None))
+                        .order_by(model.id)
+                        .limit(batch_size)
+                    )
+                    rows = [dict(zip(columns, row)) for row in result.all()]
+                    if not rows:
+                        break
+                    keys = {}
+                    for row in rows:
+                        keys.setdefault(build_key(row), row["id"])
+                    taken = set(
+                        (
+                            await db.execute(
+                                select(model.dedup_key).where(
+                                    model.dedup_key.in_(list(keys))
+                                )
+                            )
+                        ).scalars()
+                    )
+                    values = [
+                        {"id": row_id, "dedup_key": key}
+                        for key, row_id in keys.items()
+                        if key not in taken
+                    ]
+                    if values:
+                        await db.execute(update(model), values)
+                        await db.commit()
+                except Exception as e:
+                    await db.rollback()
+                    logging.error(
+                        f"Error backfilling {model.__tablename__}.dedup_key: {str(e)}"
+                    )
+                    raise
+            last_id = rows[-1]["id"]
+            filled[model.__tablename__] += len(values)
+            duplicates += len(rows) - len(values)
+        logging.info(
+            f"Backfilled {filled[model.__tablename__]} keys of {model.__tablename__}, "
+            f"{duplicates} duplicate rows left without one"
+        )
+    return filled
+
+
+# author kind -> models whose rows the author writes
+AUTHOR_KIND_MODELS = {
+    "question": (Question, RejectedQuestion),
+    "answer": (Answer,),
+    "rating": (Rating,),
+}
+
+
+async def backfill_author_kinds():
+    """Set Author.kind for authors created before it existed, from the rows
+    they wrote. The author table is small and each check is an index probe on
+    the author_id columns."""
+    filled = {}
+    async with async_session() as db:
+        try:
+            for kind, models in AUTHOR_KIND_MODELS.items():
+                wrote = [
+                    exists().where(model.author_id == Author.id) for model in models
+                ]
+                result = await db.execute(
+                    update(Author)
+                    .where(Author.kind.is_(None), Author.model != "human")
+                    .where(or_(*wrote))
+                    .values(kind=kind)
+                    .execution_options(synchronize_session=False)
+                )
+                filled[kind] = result.rowcount
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error backfilling author.kind: {str(e)}")
+            raise
+    logging.info(f"Backfilled author kinds: {filled}")
+    return filled
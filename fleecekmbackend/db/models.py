@@ -1,6 +1,39 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, Enum, UniqueConstraint
+from sqlalchemy import (
+    Column,
+    Integer,
+    BigInteger,
+    String,
+    Text,
+    Boolean,
+    DateTime,
+    Enum,
+    Index,
+    UniqueConstraint,
+)
+from sqlalchemy import event, or_
+from sqlalchemy.orm.attributes import get_history
 from fleecekmbackend.db.ctl import Base
 import hashlib
+from datetime import datetime
+
+# format of the legacy string ``timestamp`` columns
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def content_hash(value):
+    """sha256 of a text column, stored next to it so equality lookups can use
+    an index instead of scanning the TEXT column."""
+    if value is None:
+        return None
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def hash_matches(hash_column, value):
+    """Predicate on a hash column for rows whose text may equal ``value``.
+    Rows written before the column existed have no hash until
+    scripts/backfill_hashes.py runs, so they match as well; pair it with an
+    equality on the text column itself."""
+    return or_(hash_column == content_hash(value), hash_column.is_(None))
 
 
 class Paragraph(Base):
@@ -13,13 +46,26 @@ class Paragraph(Base):
     text = Column(Text)
     section_hierarchy = Column(String(8191))
     text_cleaned = Column(Text)
+    text_cleaned_hash = Column(String(64), index=True)
     word_count = Column(Integer)  # use character count to estimate
     is_bad = Column(Boolean)  # change to llm_quality_check or similar
     within_page_order = Column(Integer)
 
     processed = Column(Boolean, default=False)
+    processed_at = Column(DateTime, index=True, nullable=True)
     original_entry_id = Column(Integer, nullable=True)
 
+    # page claims read a page's paragraphs in order; MySQL can only index a
+    # prefix of the long page_name
+    __table_args__ = (
+        Index(
+            "ix_paragraph_page",
+            "page_name",
+            "within_page_order",
+            mysql_length={"page_name": 255},
+        ),
+    )
+
 
 class Author(Base):
     __tablename__ = "author"
@@ -27,7 +73,12 @@ class Author(Base):
     model = Column(String(1023))  # can be human
     prompt = Column(Text, nullable=True)
     username = Column(String(1023), nullable=True)
+    username_hash = Column(String(64), index=True, nullable=True)
     hash = Column(String(64), unique=True)
+    # what the author writes: "question", "answer" or "rating"; None for people
+    kind = Column(String(63), index=True, nullable=True)
+    # the author whose rows replaced this one's, once they were all recomputed
+    superseded_by = Column(Integer, nullable=True)
 
     @staticmethod
     def generate_hash(model, prompt):
@@ -45,8 +96,10 @@ class Question(Base):
     scope = Column(String(1023))  # the scope of the question, e.g. "single-paragraph"
     context = Column(Text)  # the context of the question for a fair zeroshot evaluation
     text = Column(Text)
+    text_hash = Column(String(64), index=True)
     author_id = Column(Integer)
     timestamp = Column(String(255))
+    created_at = Column(DateTime, index=True)
     upvote = Column(Integer)
     downvote = Column(Integer)
     turns = Column(
@@ -65,10 +118,14 @@ class Answer(Base):
     __tablename__ = "answer"
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     question_id = Column(Integer)
-    author_id = Column(Integer)
+    author_id = Column(Integer, index=True)
     setting = Column(Enum("zs", "ic", "human"))
     timestamp = Column(String(255))
+    created_at = Column(DateTime, index=True)
     text = Column(Text)
+    text_hash = Column(String(64), index=True)
+    # natural key (question, author, setting[, text]) so retries cannot duplicate
+    dedup_key = Column(String(64), unique=True, index=True, nullable=True)
 
     processed = Column(Boolean, default=False)
 
@@ -79,8 +136,12 @@ class Rating(Base):
     text = Column(Text)  # rationale for the rating
     value = Column(Integer)  # score from 1 to 5
     answer_id = Column(Integer)
-    author_id = Column(Integer)
+    author_id = Column(Integer, index=True)
     timestamp = Column(String(255))
+    created_at = Column(DateTime, index=True)
+    dedup_key = Column(
+        String(64), unique=True, index=True, nullable=True
+    )  # (answer, author)
 
 
 class Metadata(Base):
@@ -99,6 +160,7 @@ class RejectedQuestion(Base):
     text = Column(Text)
     author_id = Column(Integer)
     timestamp = Column(String(255))
+    created_at = Column(DateTime, index=True)
     turns = Column(
         String(63), default="multi", index=True
     )  # multi, single, or followup
@@ -117,3 +179,145 @@ class Feedback(Base):
     question_id = Column(Integer)
     author_id = Column(Integer)
     timestamp = Column(String(255))
+    created_at = Column(DateTime, index=True)
+
+
+class ProgressCounter(Base):
+    __tablename__ = "progress_counter"
+    name = Column(String(63), primary_key=True)  # e.g. "paragraph_processed"
+    value = Column(BigInteger, default=0)
+
+
+class IdSequence(Base):
+    __tablename__ = "id_sequence"
+    name = Column(String(63), primary_key=True)  # table name
+    next_id = Column(BigInteger)  # first id not yet handed out to any worker
+
+
+class VoteLog(Base):
+    __tablename__ = "vote_log"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    question_id = Column(Integer, index=True)
+    username = Column(String(1023), nullable=True)
+    vote = Column(Enum("up", "down"))
+    timestamp = Column(String(255), index=True)
+    applied = Column(Boolean, default=False, index=True)  # folded into question
+
+
+class DeadLetter(Base):
+    __tablename__ = "dead_letter"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    item_type = Column(String(63))  # table of the failing row, e.g. "paragraph"
+    item_id = Column(Integer)
+    stage = Column(String(63), nullable=True)  # pipeline stage of the last failure
+    error_class = Column(String(255))
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0)
+    last_prompt = Column(Text, nullable=True)  # last LLM prompt sent for the item
+    first_failed_at = Column(DateTime)
+    last_failed_at = Column(DateTime, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("item_type", "item_id", name="uq_dead_letter_item"),
+    )
+
+
+# model -> (source column, hash column)
+HASHED_COLUMNS = {
+    Paragraph: ("text_cleaned", "text_cleaned_hash"),
+    Author: ("username", "username_hash"),
+    Question: ("text", "text_hash"),
+    Answer: ("text", "text_hash"),
+}
+
+# models whose legacy string timestamp is mirrored into created_at
+TIMESTAMPED_MODELS = (Question, Answer, Rating, RejectedQuestion, Feedback)
+
+
+def answer_dedup_key(question_id, author_id, setting, text=None):
+    key = f"{question_id}:{author_id}:{setting}"
+    if setting == "human":
+        # people may give several answers to one question, only exact repeats clash
+        key += f":{content_hash(text)}"
+    return content_hash(key)
+
+
+def rating_dedup_key(answer_id, author_id):
+    return content_hash(f"{answer_id}:{author_id}")
+
+
+# model -> dedup key built from a row's column values
+DEDUP_KEYS = {
+    Answer: lambda row: answer_dedup_key(
+        row.get("question_id"),
+        row.get("author_id"),
+        row.get("setting"),
+        row.get("text"),
+    ),
+    Rating: lambda row: rating_dedup_key(row.get("answer_id"), row.get("author_id")),
+}
+
+
+def parse_timestamp(value):
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def fill_derived_columns(model, row: dict, inserted: bool = True):
+    """Set hash and datetime columns on a plain row dict (Core statements skip
+    the mapper listeners below)."""
+    if model in HASHED_COLUMNS:
+        source, target = HASHED_COLUMNS[model]
+        if source in row:
+            row[target] = content_hash(row[source])
+    if inserted and model in TIMESTAMPED_MODELS and row.get("created_at") is None:
+        row["created_at"] = parse_timestamp(row.get("timestamp")) or datetime.now()
+    if inserted and model in DEDUP_KEYS and row.get("dedup_key") is None:
+        row["dedup_key"] = DEDUP_KEYS[model](row)
+    if model is Paragraph and row.get("processed") and "processed_at" not in row:
+        row["processed_at"] = datetime.now()
+    return row
+
+
+def _content_hash_listener(mapper, connection, target):
+    source, column = HASHED_COLUMNS[type(target)]
+    setattr(target, column, content_hash(getattr(target, source)))
+
+
+def _content_hash_update_listener(mapper, connection, target):
+    # only when the text itself changed: reading an expired text here would
+    # load it inside the flush, and flag updates need no rehash
+    source, column = HASHED_COLUMNS[type(target)]
+    if get_history(target, source).has_changes():
+        setattr(target, column, content_hash(getattr(target, source)))
+
+
+def _created_at_listener(mapper, connection, target):
+    if target.created_at is None:
+        target.created_at = parse_timestamp(target.timestamp) or datetime.now()
+
+
+def _dedup_key_listener(mapper, connection, target):
+    if target.dedup_key is None:
+        row = {attr.key: getattr(target, attr.key) for attr in mapper.column_attrs}
+        target.dedup_key = DEDUP_KEYS[type(target)](row)
+
+
+def _processed_at_listener(mapper, connection, target):
+    if target.processed and target.processed_at is None:
+        target.processed_at = datetime.now()
+
+
+for _model in HASHED_COLUMNS:
+    event.listen(_model, "before_insert", _content_hash_listener)
+    event.listen(_model, "before_update", _content_hash_update_listener)
+for _model in TIMESTAMPED_MODELS:
+    event.listen(_model, "before_insert", _created_at_listener)
+for _model in DEDUP_KEYS:
+    event.listen(_model, "before_insert", _dedup_key_listener)
+event.listen(Paragraph, "before_insert", _processed_at_listener)
+event.listen(Paragraph, "before_update", _processed_at_listener)
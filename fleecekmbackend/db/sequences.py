@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import List
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.models import IdSequence
+from fleecekmbackend.core.config import ID_BLOCK_SIZE
+
+
+class IdAllocator:
+    """Hands out primary keys from blocks reserved in the id_sequence table.
+
+    Each process reserves ``block_size`` ids per round trip, so new rows get
+    their id before they are written and can be inserted later in one
+    multi-row INSERT instead of a flush + refresh per row. Every writer of a
+    sequenced table has to go through the allocator; rows inserted with an
+    autoincrement id can collide with a block another worker still holds.
+    """
+
+    def __init__(self, block_size: int = ID_BLOCK_SIZE, max_retries: int = 3):
+        self.block_size = block_size
+        self.max_retries = max_retries
+        self._blocks = {}  # table name -> [next_id, end)
+        self._lock = asyncio.Lock()
+
+    async def _reserve_block(self, model, size: int):
+        name = model.__tablename__
+        for attempt in range(self.max_retries):
+            try:
+                async with async_session() as db:
+                    async with db.begin():
+                        # bump first so the row lock is taken before reading
+                        result = await db.execute(
+                            update(IdSequence)
+                            .where(IdSequence.name == name)
+                            .values(next_id=IdSequence.next_id + size)
+                        )
+                        if result.rowcount:
+                            end = (
+                                await db.execute(
+                                    select(IdSequence.next_id).where(
+                                        IdSequence.name == name
+                                    )
+                                )
+                            ).scalar()
+                            return end - size, end
+                        # first reservation for this table: start above existing rows
+                        start = (await db.execute(select(func.max(model.id)))).scalar()
+                        start = (start or 0) + 1
+                        db.add(IdSequence(name=name, next_id=start + size))
+                    return start, start + size
+            except IntegrityError:
+                # another worker seeded the sequence first, bump its row instead
+                logging.debug(f"Sequence {name} seeded concurrently, retrying")
+        raise Exception(f"Failed to reserve an id block for {name}")
+
+    async def allocate(self, model, n: int = 1) -> List[int]:
+        name = model.__tablename__
+        ids = []
+        async with self._lock:
+            while len(ids) < n:
+                next_id, end = self._blocks.get(name, (0, 0))
+                if next_id >= end:
+                    next_id, end = await self._reserve_block(
+                        model, max(self.block_size, n - len(ids))
+                    )
+                take = min(end - next_id, n - len(ids))
+                ids.extend(range(next_id, next_id + take))
+                self._blocks[name] = (next_id + take, end)
+        return ids
+
+    async def assign(self, objects):
+        """Set ``id`` on every object that does not have one yet."""
+        pending = defaultdict(list)
+        for obj in objects:
+            if obj is not None and obj.id is None:
+                pending[type(obj)].append(obj)
+        for model, objs in pending.items():
+            for obj, new_id in zip(objs, await self.allocate(model, len(objs))):
+                obj.id = new_id
+        return objects
+
+
+id_allocator = IdAllocator()
+
+
+async def assign_ids(objects):
+    return await id_allocator.assign(objects)
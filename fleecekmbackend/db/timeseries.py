@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import Integer, cast, func, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.db.models import (
+    Paragraph,
+    Question,
+    RejectedQuestion,
+    Answer,
+    Rating,
+)
+from fleecekmbackend.core.config import (
+    THROUGHPUT_DEFAULT_BUCKET,
+    THROUGHPUT_MAX_BUCKETS,
+)
+
+# series name -> indexed datetime column marking when a row reached that point
+THROUGHPUT_SERIES = {
+    "paragraphs_processed": Paragraph.processed_at,
+    "questions_generated": Question.created_at,
+    "questions_rejected": RejectedQuestion.created_at,
+    "answers_generated": Answer.created_at,
+    "ratings_generated": Rating.created_at,
+}
+
+
+def _epoch(value, dialect_name: str):
+    if dialect_name == "sqlite":
+        return cast(func.strftime("%s", value), Integer)
+    return func.unix_timestamp(value)
+
+
+async def count_between(db: AsyncSession, column, since: datetime, until: datetime):
+    result = await db.execute(
+        select(func.count()).where(column >= since, column < until)
+    )
+    return result.scalar() or 0
+
+
+async def get_throughput(
+    db: AsyncSession,
+    since: datetime,
+    until: datetime = None,
+    bucket_seconds: int = THROUGHPUT_DEFAULT_BUCKET,
+):
+    """Rows reaching each stage per time bucket in [since, until).
+
+    Each series is one GROUP BY over an index range scan of its datetime column.
+    Buckets are offsets from ``since`` computed by the database on both sides,
+    so the result does not depend on the server's time zone.
+    """
+    until = until or datetime.now()
+    if until <= since:
+        raise ValueError("until must be after since")
+    num_buckets = -(-int((until - since).total_seconds()) // bucket_seconds)
+    if num_buckets > THROUGHPUT_MAX_BUCKETS:
+        raise ValueError(
+            f"{num_buckets} buckets requested, at most {THROUGHPUT_MAX_BUCKETS} allowed"
+        )
+
+    dialect_name = db.bind.dialect.name
+    series = {}
+    for name, column in THROUGHPUT_SERIES.items():
+        offset = _epoch(column, dialect_name) - _epoch(literal(since), dialect_name)
+        bucket = ((offset - offset % bucket_seconds) / bucket_seconds).label("bucket")
+        result = await db.execute(
+            select(bucket, func.count())
+            .where(column >= since, column < until)
+            .group_by(bucket)
+        )
+        counts = [0] * num_buckets
+        for index, count in result.all():
+            if index is not None and 0 <= int(index) < num_buckets:
+                counts[int(index)] += count
+        series[name] = counts
+
+    window_seconds = (until - since).total_seconds()
+    return {
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "bucket_seconds": bucket_seconds,
+        "buckets": [
+            (since + timedelta(seconds=i * bucket_seconds)).isoformat()
+            for i in range(num_buckets)
+        ],
+        "series": series,
+        "totals": {name: sum(counts) for name, counts in series.items()},
+        "per_minute": {
+            name: sum(counts) / window_seconds * 60 for name, counts in series.items()
+        },
+    }
+
+
+async def get_recent_counts(db: AsyncSession, window_seconds: int):
+    """Totals per series over the last ``window_seconds``, without bucketing."""
+    until = datetime.now()
+    since = until - timedelta(seconds=window_seconds)
+    return {
+        name: await count_between(db, column, since, until)
+        for name, column in THROUGHPUT_SERIES.items()
+    }
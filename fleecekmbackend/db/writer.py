@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from sqlalchemy import insert, update
+from sqlalchemy import inspect as sa_inspect
+
+from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.counters import increment_counters, row_deltas
+from fleecekmbackend.db.helpers import add_idempotent, insert_ignore
+from fleecekmbackend.db.models import DEDUP_KEYS, fill_derived_columns
+from fleecekmbackend.core.config import (
+    BULK_WRITE_MAX_ROWS,
+    BULK_WRITE_MAX_LATENCY,
+    BULK_WRITE_MAX_PENDING,
+    BULK_WRITE_REPORT_INTERVAL,
+)
+
+_STOP = object()
+
+
+class _Barrier:
+    def __init__(self):
+        self.done = asyncio.get_running_loop().create_future()
+
+
+def _snapshot(obj):
+    """The write an ORM object stands for, as a plain ("insert"|"update",
+    model, row) item. Taken before the first attempt: rolling that attempt back
+    expires the object and discards its pending changes."""
+    state = sa_inspect(obj)
+    model = type(obj)
+    if state.transient or state.pending:
+        row = {}
+        for attr in state.mapper.column_attrs:
+            value = getattr(obj, attr.key)
+            if value is not None:
+                row[attr.key] = value
+        return ("insert", model, fill_derived_columns(model, row))
+    row = {
+        column.key: value
+        for column, value in zip(state.mapper.primary_key, state.identity or ())
+    }
+    for attr in state.mapper.column_attrs:
+        added = state.attrs[attr.key].history.added
+        if added:
+            row[attr.key] = added[0]
+    if len(row) == len(state.mapper.primary_key):
+        return None  # nothing changed
+    return ("update", model, fill_derived_columns(model, row, inserted=False))
+
+
+class BulkWriter:
+    """Write-behind buffer shared by the pipeline stages.
+
+    Stages hand over ORM objects (``add``/``add_all``) or plain rows
+    (``insert``/``update``) and carry on; a single background task coalesces
+    them into multi-row INSERT/UPDATE statements and commits once per batch.
+    A batch is written when it reaches ``max_rows`` or its oldest row has
+    waited ``max_latency`` seconds. The queue is bounded, so producers block
+    (backpressure) when the database falls behind.
+    """
+
+    def __init__(
+        self,
+        max_rows: int = BULK_WRITE_MAX_ROWS,
+        max_latency: float = BULK_WRITE_MAX_LATENCY,
+        max_pending: int = BULK_WRITE_MAX_PENDING,
+        report_interval: float = BULK_WRITE_REPORT_INTERVAL,
+    ):
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.report_interval = report_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._task = None
+        self.started_at = None
+        self.commits = 0
+        self.rows_inserted = 0
+        self.rows_updated = 0
+        self.objects_written = 0  # ORM objects, inserted or updated by the flush
+        self.failed_rows = 0
+        self.backpressure_wait = 0.0  # seconds producers spent blocked
+        self._last_report = 0.0
+        self._barriers = set()  # drain() calls not answered yet
+        self._error = None  # why the background task stopped, if it died
+
+    async def start(self):
+        if self._task is None:
+            self.started_at = self._last_report = time.time()
+            self._error = None
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._on_task_done)
+        return self
+
+    def _on_task_done(self, task):
+        """If the background task dies, nothing would answer the producers
+        and drain() calls waiting on it; fail them instead of hanging."""
+        if task.cancelled():
+            error = RuntimeError("BulkWriter task was cancelled")
+        elif task.exception() is not None:
+            error = RuntimeError(f"BulkWriter task died: {task.exception()}")
+        else:
+            error = RuntimeError("BulkWriter is closed")
+        self._error = error
+        if task.cancelled() or task.exception() is not None:
+            logging.error(f"{str(error)}; {self._queue.qsize()} queued rows lost")
+        # free the queue so blocked producers wake up and see the error
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        for barrier in self._barriers:
+            if not barrier.done.done():
+                barrier.done.set_exception(error)
+        self._barriers.clear()
+
+    def _check_running(self):
+        if self._error is not None:
+            raise self._error
+
+    async def _put(self, item):
+        self._check_running()
+        if self._queue.full():
+            start = time.time()
+            await self._queue.put(item)
+            self.backpressure_wait += time.time() - start
+        else:
+            self._queue.put_nowait(item)
+        # the task may have died while this producer was blocked
+        self._check_running()
+
+    async def add(self, obj):
+        await self._put(("orm", obj))
+
+    async def add_all(self, objs):
+        for obj in objs:
+            await self.add(obj)
+
+    async def insert(self, model, row: dict):
+        # Core rows bypass the mapper events that maintain the derived columns
+        await self._put(("insert", model, fill_derived_columns(model, row)))
+
+    async def update(self, model, row: dict):
+        """Queue an UPDATE by primary key; ``row`` must include the key."""
+        await self._put(
+            ("update", model, fill_derived_columns(model, row, inserted=False))
+        )
+
+    async def drain(self):
+        """Wait until everything queued so far has been committed."""
+        barrier = _Barrier()
+        self._barriers.add(barrier)
+        try:
+            await self._put(barrier)
+            await barrier.done
+        finally:
+            self._barriers.discard(barrier)
+
+    async def close(self):
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        self.report()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write_batch(batch)
+            if time.time() - self._last_report >= self.report_interval:
+                self.report()
+
+    async def _write_batch(self, batch):
+        barriers = [item for item in batch if isinstance(item, _Barrier)]
+        items = [item for item in batch if not isinstance(item, _Barrier)]
+        if items:
+            # plain rows to retry from; see _snapshot
+            rows = [_snapshot(item[1]) if item[0] == "orm" else item for item in items]
+            rows = [row for row in rows if row is not None]
+            try:
+                await self._write(items)
+            except Exception as e:
+                logging.error(
+                    f"Bulk write of {len(items)} rows failed, retrying row by row: {str(e)}"
+                )
+                for row in rows:
+                    try:
+                        await self._write([row])
+                    except Exception as e:
+                        self.failed_rows += 1
+                        logging.error(
+                            f"Dropping {row[0]} of {row[1].__name__} {row[2]}: {str(e)}"
+                        )
+        for barrier in barriers:
+            if not barrier.done.done():
+                barrier.done.set_result(None)
+
+    async def _write(self, items):
+        objects = []
+        inserts = defaultdict(list)
+        updates = defaultdict(list)
+        for kind, *payload in items:
+            if kind == "orm":
+                objects.append(payload[0])
+            elif kind == "insert":
+                inserts[payload[0]].append(payload[1])
+            else:
+                # rows of one executemany must share the same set of columns
+                model, row = payload
+                updates[(model, tuple(sorted(row)))].append(row)
+
+        async with async_session() as db:
+            try:
+                await add_idempotent(db, objects)
+                for model, rows in inserts.items():
+                    if model in DEDUP_KEYS:
+                        await insert_ignore(db, model, rows)
+                        continue
+                    await db.execute(insert(model), rows)
+                    await increment_counters(db, row_deltas(model, rows))
+                for (model, _), rows in updates.items():
+                    await db.execute(update(model), rows)
+                    await increment_counters(
+                        db, row_deltas(model, rows, inserted=False)
+                    )
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        self.commits += 1
+        self.rows_inserted += sum(len(rows) for rows in inserts.values())
+        self.rows_updated += sum(len(rows) for rows in updates.values())
+        self.objects_written += len(objects)
+
+    def stats(self):
+        elapsed = max(time.time() - (self.started_at or time.time()), 1e-9)
+        return {
+            "commits": self.commits,
+            "rows_inserted": self.rows_inserted,
+            "rows_updated": self.rows_updated,
+            "objects_written": self.objects_written,
+            "failed_rows": self.failed_rows,
+            "pending": self._queue.qsize(),
+            "commits_per_sec": self.commits / elapsed,
+            "rows_per_sec": (
+                self.rows_inserted + self.rows_updated + self.objects_written
+            )
+            / elapsed,
+            "backpressure_wait": self.backpressure_wait,
+        }
+
+    def report(self):
+        self._last_report = time.time()
+        stats = self.stats()
+        logging.info(
+            f"BulkWriter: {stats['commits']} commits ({stats['commits_per_sec']:.2f}/s), "
+            f"{stats['rows_inserted']} rows inserted, {stats['rows_updated']} updated, "
+            f"{stats['objects_written']} objects written "
+            f"({stats['rows_per_sec']:.1f} rows/s), {stats['pending']} pending, "
+            f"{stats['backpressure_wait']:.1f}s blocked on backpressure"
+        )
@@ -2,11 +2,24 @@ import asyncio
 import logging
 import time
 
-from fleecekmbackend.db.ctl import create_tables_if_not_exist
+from fleecekmbackend.db.ctl import create_tables_if_not_exist, log_pool_stats
+from fleecekmbackend.db.migrations import add_missing_columns
+from fleecekmbackend.db.counters import ensure_counters, flush_counters
 from fleecekmbackend.db.helpers import load_csv_data, load_csv_data_top_n
-from fleecekmbackend.core.config import DATASET_PATH, LOGGING_LEVEL
+from fleecekmbackend.core.metrics import run_dump_path, run_metrics_dump
+from fleecekmbackend.core.watchdog import LoopWatchdog
+from fleecekmbackend.core.config import (
+    DATASET_PATH,
+    LOGGING_LEVEL,
+    METRICS_DUMP_INTERVAL,
+    POOL_STATS_INTERVAL,
+)
+from fleecekmbackend.services.dataset.answerability import log_cascade_report
 from fleecekmbackend.services.generation.end2end import start_background_process_e2e
 from fleecekmbackend.services.generation.stage2stage import start_background_process_s2s
+from fleecekmbackend.services.generation.streaming import (
+    start_background_process_streaming,
+)
 
 load_csv_lock = asyncio.Lock()
 background_process_lock = asyncio.Lock()
@@ -16,8 +29,10 @@ logging.basicConfig(
 )
 
 
-async def main():
+async def startup():
+    """One-time database preparation before any worker starts generating."""
     await create_tables_if_not_exist()
+    await add_missing_columns()
 
     async with load_csv_lock:
         try:
@@ -29,14 +44,33 @@ async def main():
         except Exception as e:
             logging.error(f"Error loading CSV data: {str(e)}")
 
+    await ensure_counters()
+
+
+async def main():
+    await startup()
+
+    pool_reporter = asyncio.create_task(log_pool_stats(POOL_STATS_INTERVAL))
+    metrics_dumper = asyncio.create_task(
+        run_metrics_dump(run_dump_path("main"), METRICS_DUMP_INTERVAL)
+    )
+    watchdog = LoopWatchdog().start()
+
     async with background_process_lock:
         print("Starting background process")
-        # Choose between end2end and stage2stage processing
+        # Choose between end2end, stage2stage and streaming processing
         # start_time = time.time()
         # await start_background_process_s2s()
+        # await start_background_process_streaming()
         await start_background_process_e2e()
         # end_time = time.time()
         # print(f"Background process execution time: {end_time - start_time}")
+    await flush_counters()
+    log_cascade_report()
+    pool_reporter.cancel()
+    await watchdog.stop()
+    metrics_dumper.cancel()
+    await asyncio.gather(metrics_dumper, return_exceptions=True)
 
 
 if __name__ == "__main__":
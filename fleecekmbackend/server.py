@@ -1,13 +1,20 @@
 import logging
 import asyncio
+import time
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 
 from fleecekmbackend.api.dataset.raw import router as raw_dataset_router
 from fleecekmbackend.api.dataset.qa import router as qa_dataset_router
-from fleecekmbackend.db.ctl import create_tables_if_not_exist
+from fleecekmbackend.db.ctl import create_tables_if_not_exist, get_pool_stats
+from fleecekmbackend.db.migrations import add_missing_columns
+from fleecekmbackend.db.counters import flush_counters, run_counter_reconciliation
 from fleecekmbackend.db.helpers import load_csv_data, load_csv_data_top_n
+from fleecekmbackend.services.dataset.votes import vote_accumulator, replay_vote_log
+from fleecekmbackend.core.metrics import CONTENT_TYPE, HTTP_REQUEST_SECONDS, REGISTRY
+from fleecekmbackend.core.watchdog import LoopWatchdog
 from fleecekmbackend.core.config import DATASET_PATH
 
 load_csv_lock = asyncio.Lock()
@@ -18,6 +25,7 @@ logging.root.setLevel(logging.INFO)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_tables_if_not_exist()
+    await add_missing_columns()
 
     async with load_csv_lock:
         try:
@@ -29,7 +37,15 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logging.error(f"Error loading CSV data: {str(e)}")
 
+    await replay_vote_log()
+    vote_accumulator.start()
+    reconciliation = asyncio.create_task(run_counter_reconciliation())
+    watchdog = LoopWatchdog().start()
     yield
+    await watchdog.stop()
+    reconciliation.cancel()
+    await vote_accumulator.stop()
+    await flush_counters()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -39,6 +55,35 @@ app.include_router(raw_dataset_router, prefix="/raw", tags=["raw"])
 app.include_router(qa_dataset_router, prefix="/qa", tags=["qa"])
 
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the route template, so /qa/questions/1 and /qa/questions/2 share a series
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start_time,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status,
+        )
+
+
 @app.get("/")
 async def read_root():
     return {"message": "Welcome to the WikiText API!"}
+
+
+@app.get("/db/pool")
+async def read_pool_stats():
+    return get_pool_stats()
+
+
+@app.get("/metrics")
+async def read_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,365 @@
+import logging
+import os
+import random
+import re
+import zlib
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import exists, literal, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.core.config import (
+    ANSWERABILITY_AUDIT_RATE,
+    ANSWERABILITY_CASCADE,
+    ANSWERABILITY_FEATURES,
+    ANSWERABILITY_MODEL_PATH,
+    LOGGING_LEVEL,
+)
+from fleecekmbackend.core.metrics import ANSWERABILITY_AGREEMENT, ANSWERABILITY_CHECKS
+from fleecekmbackend.db.models import Answer, Question, RejectedQuestion
+from fleecekmbackend.services.dataset.common import (
+    generate_fact_with_context,
+    load_paragraphs,
+)
+
+logging.basicConfig(
+    level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+SETTINGS = ("ic", "zs")
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+# held-out checks a threshold must decide before its agreement is trusted
+MIN_DECIDED = 20
+
+
+def _tokens(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _features(question, fact=""):
+    """Binary features of a check: the question's words, word pairs, first
+    word and length, plus, in context, how much of the question the fact
+    covers and which of its words the fact lacks."""
+    words = _tokens(question)
+    features = {f"w:{word}" for word in words}
+    features.update(f"b:{a} {b}" for a, b in zip(words, words[1:]))
+    features.add(f"first:{words[0] if words else ''}")
+    features.add(f"len:{min(len(words) // 4, 8)}")
+    if fact:
+        fact_words = set(_tokens(fact))
+        content = [word for word in words if len(word) > 3]
+        covered = sum(word in fact_words for word in content)
+        features.add(f"cover:{int(10 * covered / len(content)) if content else -1}")
+        features.update(f"miss:{word}" for word in content if word not in fact_words)
+    return features
+
+
+def _indices(features, dims):
+    # crc32 rather than hash(): it is the same in every process
+    return np.unique([zlib.crc32(feature.encode()) % dims for feature in features])
+
+
+def _sigmoid(z):
+    return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+
+def _sparse(examples, dims):
+    """Row and column indices of the nonzero features of ``examples``, a list
+    of (question, fact) pairs."""
+    columns = [_indices(_features(q, fact), dims) for q, fact in examples]
+    rows = np.repeat(np.arange(len(columns)), [len(c) for c in columns])
+    return rows, np.concatenate(columns) if columns else np.array([], dtype=int)
+
+
+def _fit(rows, columns, labels, dims, epochs=300, l2=1e-4, learning_rate=0.1):
+    """Logistic regression by full-batch Adam over the sparse features."""
+    n = len(labels)
+    weights = np.zeros(dims)
+    prior = np.clip(labels.mean(), 1e-3, 1 - 1e-3)
+    bias = np.log(prior / (1 - prior))
+    moments = [np.zeros(dims), np.zeros(dims), 0.0, 0.0]
+    for step in range(1, epochs + 1):
+        z = np.bincount(rows, weights=weights[columns], minlength=n) + bias
+        error = _sigmoid(z) - labels
+        gradient = np.bincount(columns, weights=error[rows], minlength=dims) / n
+        gradient += l2 * weights
+        bias_gradient = error.mean()
+        moments[0] = 0.9 * moments[0] + 0.1 * gradient
+        moments[1] = 0.999 * moments[1] + 0.001 * gradient**2
+        moments[2] = 0.9 * moments[2] + 0.1 * bias_gradient
+        moments[3] = 0.999 * moments[3] + 0.001 * bias_gradient**2
+        scale = learning_rate * np.sqrt(1 - 0.999**step) / (1 - 0.9**step)
+        weights -= scale * moments[0] / (np.sqrt(moments[1]) + 1e-8)
+        bias -= scale * moments[2] / (np.sqrt(moments[3]) + 1e-8)
+    return weights, bias
+
+
+def _threshold(probabilities, labels, min_agreement, accept=True):
+    """The loosest threshold whose decisions still agree with ``labels`` at
+    least ``min_agreement`` of the time; inf (never decide) if none does.
+
+    The cut is made after a correct decision, halfway to the next distinct
+    probability, so examples close to it fall on the side they are ranked.
+    """
+    order = np.argsort(-probabilities if accept else probabilities)
+    ranked = probabilities[order]
+    correct = labels[order] if accept else 1 - labels[order]
+    decided = np.arange(1, len(order) + 1)
+    candidates = (
+        (decided >= MIN_DECIDED)
+        & (np.cumsum(correct) / decided >= min_agreement)
+        & (correct == 1)
+    )
+    candidates[:-1] &= ranked[:-1] != ranked[1:]
+    good = np.nonzero(candidates)[0]
+    if not len(good):
+        return np.inf if accept else -np.inf
+    last = good[-1]
+    if last == len(ranked) - 1:
+        return ranked[last]
+    return (ranked[last] + ranked[last + 1]) / 2
+
+
+class AnswerabilityClassifier:
+    """Logistic regression over hashed word features, one per setting ("ic":
+    answerable from the fact, "zs": answerable without it). Trains and runs
+    on CPU with numpy only."""
+
+    def __init__(self, dims: int = ANSWERABILITY_FEATURES):
+        self.dims = dims
+        self.weights = {}
+        self.bias = {}
+        # setting -> (accept at or above, reject at or below)
+        self.thresholds = {}
+        self.labels_until = None
+
+    def probability(self, question: str, fact: str = ""):
+        setting = "ic" if fact else "zs"
+        indices = _indices(_features(question, fact), self.dims)
+        return float(
+            _sigmoid(self.weights[setting][indices].sum() + self.bias[setting])
+        )
+
+    def decide(self, question: str, fact: str = ""):
+        """(verdict, probability); the verdict is None when the classifier is
+        not confident enough to stand in for the LLM."""
+        p = self.probability(question, fact)
+        accept, reject = self.thresholds["ic" if fact else "zs"]
+        if p >= accept:
+            return True, p
+        if p <= reject:
+            return False, p
+        return None, p
+
+    def train(self, setting, examples, labels, min_agreement, held_out=0.2, seed=0):
+        """Fit one setting on (question, fact) ``examples``, then pick its
+        thresholds on a held-out share of them and refit on all. Returns the
+        held-out evaluation."""
+        labels = np.asarray(labels, dtype=float)
+        order = np.random.default_rng(seed).permutation(len(labels))
+        split = int(len(order) * (1 - held_out))
+        train, test = order[:split], order[split:]
+        rows, columns = _sparse([examples[i] for i in train], self.dims)
+        weights, bias = _fit(rows, columns, labels[train], self.dims)
+        rows, columns = _sparse([examples[i] for i in test], self.dims)
+        p = _sigmoid(
+            np.bincount(rows, weights=weights[columns], minlength=len(test)) + bias
+        )
+        accept = _threshold(p, labels[test], min_agreement, accept=True)
+        reject = _threshold(p, labels[test], min_agreement, accept=False)
+        if reject > accept:
+            # both bounds overlap on a weak model; decide nothing
+            accept, reject = np.inf, -np.inf
+        decided = (p >= accept) | (p <= reject)
+        agree = (p >= accept) == labels[test].astype(bool)
+
+        rows, columns = _sparse(examples, self.dims)
+        self.weights[setting], self.bias[setting] = _fit(
+            rows, columns, labels, self.dims
+        )
+        self.thresholds[setting] = (float(accept), float(reject))
+        return {
+            "examples": len(labels),
+            "answerable": float(labels.mean()) if len(labels) else 0.0,
+            "held_out": len(test),
+            "accuracy": (
+                float(((p >= 0.5) == labels[test].astype(bool)).mean())
+                if len(test)
+                else 0.0
+            ),
+            "coverage": float(decided.mean()) if len(test) else 0.0,
+            "agreement": float(agree[decided].mean()) if decided.any() else None,
+            "accept_threshold": float(accept),
+            "reject_threshold": float(reject),
+        }
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays = {}
+        for setting in self.weights:
+            arrays[f"{setting}_weights"] = self.weights[setting]
+            arrays[f"{setting}_bias"] = self.bias[setting]
+            arrays[f"{setting}_thresholds"] = self.thresholds[setting]
+        temporary = f"{path}.tmp.npz"
+        np.savez_compressed(
+            temporary,
+            dims=self.dims,
+            labels_until=str(self.labels_until or ""),
+            **arrays,
+        )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            classifier = cls(int(data["dims"]))
+            for setting in SETTINGS:
+                classifier.weights[setting] = data[f"{setting}_weights"]
+                classifier.bias[setting] = float(data[f"{setting}_bias"])
+                classifier.thresholds[setting] = tuple(
+                    float(t) for t in data[f"{setting}_thresholds"]
+                )
+            labels_until = str(data["labels_until"])
+        classifier.labels_until = (
+            datetime.fromisoformat(labels_until) if labels_until else None
+        )
+        return classifier
+
+
+_classifier = None
+_classifier_loaded = False
+
+
+def get_classifier():
+    """The trained classifier at ANSWERABILITY_MODEL_PATH, loaded once; None
+    if the cascade is off or nothing was trained."""
+    global _classifier, _classifier_loaded
+    if not _classifier_loaded:
+        _classifier_loaded = True
+        if ANSWERABILITY_CASCADE:
+            try:
+                _classifier = AnswerabilityClassifier.load(ANSWERABILITY_MODEL_PATH)
+                logging.info(
+                    f"Answerability cascade thresholds: {_classifier.thresholds}"
+                )
+            except FileNotFoundError:
+                logging.info(
+                    f"No answerability classifier at {ANSWERABILITY_MODEL_PATH}; "
+                    "every check goes to the LLM"
+                )
+            except Exception as e:
+                logging.error(f"Error loading answerability classifier: {str(e)}")
+    return _classifier
+
+
+async def cascade_answerable(question, fact, llm_check):
+    """Whether ``question`` is answerable (from ``fact``, or without context
+    if it is empty). The classifier decides when it is confident; otherwise,
+    and for a random ANSWERABILITY_AUDIT_RATE of its decisions, the LLM
+    check ``llm_check(question, fact)`` does."""
+    setting = "ic" if fact else "zs"
+    classifier = get_classifier()
+    if classifier is None or not question.strip():
+        ANSWERABILITY_CHECKS.inc(setting=setting, decided_by="llm")
+        return await llm_check(question, fact)
+
+    verdict, p = classifier.decide(question, fact)
+    if verdict is not None and random.random() >= ANSWERABILITY_AUDIT_RATE:
+        ANSWERABILITY_CHECKS.inc(setting=setting, decided_by="classifier")
+        return verdict
+    route = "escalated" if verdict is None else "audit"
+    answerable = await llm_check(question, fact)
+    ANSWERABILITY_CHECKS.inc(setting=setting, decided_by=route)
+    # an audit checks the verdict the classifier would have returned; an
+    # escalated check has none, so its probability's lean is scored instead
+    lean = verdict if route == "audit" else p >= 0.5
+    outcome = "agree" if lean == answerable else "disagree"
+    ANSWERABILITY_AGREEMENT.inc(setting=setting, route=route, outcome=outcome)
+    return answerable
+
+
+def cascade_report():
+    """This process's answerability checks: what decided them, the LLM calls
+    the classifier saved, and how often it agreed with the LLM."""
+    report = {}
+    for setting in SETTINGS:
+        checks = {
+            decided_by: int(
+                ANSWERABILITY_CHECKS.value(setting=setting, decided_by=decided_by)
+            )
+            for decided_by in ("classifier", "audit", "escalated", "llm")
+        }
+        total = sum(checks.values())
+        if not total:
+            continue
+        row = {"checks": total, **checks, "llm_calls_saved": checks["classifier"]}
+        row["llm_calls_saved_share"] = checks["classifier"] / total
+        for route in ("audit", "escalated"):
+            agree, disagree = (
+                ANSWERABILITY_AGREEMENT.value(setting=setting, route=route, outcome=o)
+                for o in ("agree", "disagree")
+            )
+            row[f"{route}_agreement"] = (
+                agree / (agree + disagree) if agree + disagree else None
+            )
+        report[setting] = row
+    return report
+
+
+def log_cascade_report():
+    for setting, row in cascade_report().items():
+        audit = row["audit_agreement"]
+        logging.info(
+            f"Answerability ({setting}): {row['checks']} checks, "
+            f"{row['classifier']} decided by the classifier "
+            f"({row['llm_calls_saved_share']:.0%} of LLM calls saved), "
+            f"{row['escalated']} escalated, {row['audit']} audited"
+            + (f", {audit:.1%} audit agreement" if audit is not None else "")
+        )
+
+
+async def load_labelled_checks(db: AsyncSession, labels_until: datetime = None):
+    """(question, fact, answerable in context, answerable without) for every
+    question the LLM checked: rejected questions, filtered questions, and the
+    unfiltered ones that were answered, which the e2e pipeline only inserts
+    after checking them."""
+    answered = exists().where(Answer.question_id == Question.id)
+    queries = [
+        select(
+            Question.paragraph_id,
+            Question.text,
+            Question.rejected,
+            Question.is_answerable_ic,
+            Question.is_answerable_zs,
+        ).where(
+            or_(Question.filtered == True, answered),
+            *_created_until(Question, labels_until),
+        ),
+        select(
+            RejectedQuestion.paragraph_id,
+            RejectedQuestion.text,
+            literal(True),
+            RejectedQuestion.is_answerable_ic,
+            RejectedQuestion.is_answerable_zs,
+        ).where(*_created_until(RejectedQuestion, labels_until)),
+    ]
+    rows = []
+    for query in queries:
+        rows.extend((await db.execute(query)).all())
+    paragraphs = await load_paragraphs(db, [row[0] for row in rows])
+    checks = []
+    for paragraph_id, text, rejected, ic, zs in rows:
+        if paragraph_id not in paragraphs or not text:
+            continue
+        _, fact = generate_fact_with_context(paragraphs[paragraph_id])
+        if not rejected:
+            ic, zs = True, True
+        checks.append((text, fact, bool(ic), bool(zs)))
+    return checks
+
+
+def _created_until(model, labels_until):
+    if labels_until is None:
+        return []
+    return [or_(model.created_at == None, model.created_at <= labels_until)]
@@ -1,21 +1,33 @@
-import time
+import asyncio
 import logging
 from datetime import datetime
+from typing import Dict
 from sqlalchemy.ext.asyncio import AsyncSession
 from fleecekmbackend.db.models import (
     Paragraph,
     Question,
     Answer,
+    answer_dedup_key,
 )
-from fleecekmbackend.db.helpers import create_author_if_not_exists
+from fleecekmbackend.db.helpers import (
+    add_idempotent,
+    create_author_if_not_exists,
+    find_existing,
+    find_existing_many,
+)
+from fleecekmbackend.db.sequences import assign_ids
 from fleecekmbackend.core.utils.llm import (
     llm_safe_request,
     llm_safe_request_async,
     randwait,
     generate_prompts_from_template,
 )
-from fleecekmbackend.services.dataset.common import generate_fact_with_context
+from fleecekmbackend.services.dataset.common import (
+    QuestionContext,
+    generate_fact_with_context,
+)
 from fleecekmbackend.core.config import (
+    ANSWER_TARGETS,
     WAIT,
     MODEL,
     STOP,
@@ -29,6 +41,52 @@ logging.basicConfig(
     level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 
+# read by scripts/estimate.py as well
+ANSWER_TEMPLATE = "{PROMPT_PREFIX}{CONTEXT_PROMPT}Answer the following question in a succinct manner: {QUESTION}\n{PROMPT_SUFFIX}"
+ANSWER_CONTEXT_TEMPLATE = "Using this fact: {FACT} \n\n "  # "ic" setting only
+
+
+def answer_author_prompt():
+    """The prompt that answers generated from ANSWER_TEMPLATE are attributed to."""
+    _, template = generate_prompts_from_template(
+        ANSWER_TEMPLATE,
+        {
+            "CONTEXT_PROMPT": "",
+            "QUESTION": "",
+            "PROMPT_PREFIX": PROMPT_PREFIX,
+            "PROMPT_SUFFIX": PROMPT_SUFFIX,
+        },
+    )
+    return template
+
+
+async def load_existing_answers(
+    contexts: Dict[int, QuestionContext], targets=None
+) -> Dict[int, QuestionContext]:
+    """Look up the stored answers of a batch of questions with one query, for
+    every (service, model) in ``targets`` (ANSWER_TARGETS by default) and both
+    settings. generate_answer then skips its own lookup."""
+    targets = targets or ANSWER_TARGETS
+    if not contexts:
+        return contexts
+    author_ids = [
+        await create_author_if_not_exists(answer_author_prompt(), model, "answer")
+        for _, model in targets
+    ]
+    existing = await find_existing_many(
+        Answer,
+        [
+            answer_dedup_key(question_id, author_id, setting)
+            for question_id in contexts
+            for author_id in author_ids
+            for setting in ["zs", "ic"]
+        ],
+    )
+    return {
+        question_id: context._replace(existing=existing)
+        for question_id, context in contexts.items()
+    }
+
 
 async def generate_answer(
     db: AsyncSession,
@@ -38,17 +96,24 @@ async def generate_answer(
     model: str = MODEL,
     service: str = "gpublaze",
     flush: bool = True,
+    context: QuestionContext = None,
 ):
     try:
         # process prompt template
-        question = await db.get(Question, question_id)
+        if context is not None:
+            question = context.question
+        else:
+            question = await db.get(Question, question_id)
 
-        prompt_template = "{PROMPT_PREFIX}{CONTEXT_PROMPT}Answer the following question in a succinct manner: {QUESTION}\n{PROMPT_SUFFIX}"
+        prompt_template = ANSWER_TEMPLATE
 
         if setting == "ic":
-            paragraph = await db.get(Paragraph, question.paragraph_id)
-            _, fact = generate_fact_with_context(paragraph)
-            context_prompt = f"Using this fact: {fact} \n\n "
+            if context is not None:
+                fact = context.fact
+            else:
+                paragraph = await db.get(Paragraph, question.paragraph_id)
+                _, fact = generate_fact_with_context(paragraph)
+            context_prompt = ANSWER_CONTEXT_TEMPLATE.format(FACT=fact)
         elif setting == "zs":
             context_prompt = ""
         else:
@@ -63,13 +128,24 @@ async def generate_answer(
                 "PROMPT_SUFFIX": PROMPT_SUFFIX,
             },
         )
-        author_id = await create_author_if_not_exists(template, model)
+        author_id = await create_author_if_not_exists(template, model, "answer")
+
+        dedup_key = answer_dedup_key(question.id, author_id, setting)
+        if context is not None and context.existing is not None:
+            existing = context.existing.get(dedup_key)
+        else:
+            existing = await find_existing(Answer, dedup_key)
+        if existing is not None:
+            logging.info(
+                f"Answer ({setting}) to question {question.id} already exists: {existing.id}"
+            )
+            return existing.id if flush else existing
 
         # main loop
         attempts = 0
         while attempts < max_attempts:
             attempts += 1
-            time.sleep(randwait(WAIT))
+            await asyncio.sleep(randwait(WAIT))
             output = await llm_safe_request_async(prompt, model, STOP, service=service)
             answer_text = output["choices"][0]["message"]["content"].strip()
 
@@ -82,10 +158,9 @@ async def generate_answer(
                     text=answer_text,
                 )
                 logging.debug(f"Generated answer: {answer.text}")
+                await assign_ids([answer])
                 if flush:
-                    db.add(answer)
-                    await db.flush()
-                    await db.refresh(answer, ["id"])
+                    await add_idempotent(db, [answer])
                     return answer.id
                 else:
                     return answer
@@ -1,5 +1,11 @@
+from typing import Dict, List, NamedTuple, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fleecekmbackend.db.models import (
     Paragraph,
+    Question,
+    Answer,
+    Rating,
 )
 
 WAIT = 0.1
@@ -22,3 +28,70 @@ def generate_fact_with_context(paragraph: Paragraph):
     else:
         context = f"In an article about '{paragraph.page_name}', section '{paragraph.section_name}'"
     return context, f"{context} mentioned: \n {paragraph.text_cleaned}"
+
+
+class QuestionContext(NamedTuple):
+    question: Question
+    paragraph: Paragraph
+    fact: str  # fact with context, as returned by generate_fact_with_context
+    # stored answers by dedup key, see load_existing_answers; None if not looked up
+    existing: Optional[Dict[str, Answer]] = None
+
+    def for_answer(self, answer: Answer, existing=None) -> "AnswerContext":
+        return AnswerContext(answer, self.question, self.paragraph, self.fact, existing)
+
+
+class AnswerContext(NamedTuple):
+    answer: Answer
+    question: Question
+    paragraph: Paragraph
+    fact: str
+    # stored ratings by dedup key, see load_existing_ratings; None if not looked up
+    existing: Optional[Dict[str, Rating]] = None
+
+
+async def load_paragraphs(
+    db: AsyncSession, paragraph_ids: List[int]
+) -> Dict[int, Paragraph]:
+    if not paragraph_ids:
+        return {}
+    result = await db.execute(
+        select(Paragraph).where(Paragraph.id.in_(set(paragraph_ids)))
+    )
+    return {paragraph.id: paragraph for paragraph in result.scalars().all()}
+
+
+# resolve a whole work batch with one joined query instead of a db.get per row
+async def load_question_contexts(
+    db: AsyncSession, question_ids: List[int]
+) -> Dict[int, QuestionContext]:
+    if not question_ids:
+        return {}
+    result = await db.execute(
+        select(Question, Paragraph)
+        .join(Paragraph, Paragraph.id == Question.paragraph_id)
+        .where(Question.id.in_(set(question_ids)))
+    )
+    contexts = {}
+    for question, paragraph in result.all():
+        _, fact = generate_fact_with_context(paragraph)
+        contexts[question.id] = QuestionContext(question, paragraph, fact)
+    return contexts
+
+
+async def load_answer_contexts(
+    db: AsyncSession, answer_ids: List[int]
+) -> Dict[int, AnswerContext]:
+    if not answer_ids:
+        return {}
+    result = await db.execute(
+        select(Answer, Question, Paragraph)
+        .join(Question, Question.id == Answer.question_id)
+        .join(Paragraph, Paragraph.id == Question.paragraph_id)
+        .where(Answer.id.in_(set(answer_ids)))
+    )
+    contexts = {}
+    for answer, question, paragraph in result.all():
+        _, fact = generate_fact_with_context(paragraph)
+        contexts[answer.id] = AnswerContext(answer, question, paragraph, fact)
+    return contexts
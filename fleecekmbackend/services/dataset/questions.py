@@ -12,13 +12,18 @@ from fleecekmbackend.db.models import (
     RejectedQuestion,
 )
 from fleecekmbackend.db.helpers import create_author_if_not_exists
+from fleecekmbackend.db.sequences import assign_ids
 from fleecekmbackend.core.utils.llm import (
     llm_safe_request,
     llm_safe_request_async,
     randwait,
     generate_prompts_from_template,
 )
-from fleecekmbackend.services.dataset.common import generate_fact_with_context
+from fleecekmbackend.services.dataset.answerability import cascade_answerable
+from fleecekmbackend.services.dataset.common import (
+    generate_fact_with_context,
+    load_paragraphs,
+)
 from fleecekmbackend.core.config import (
     WAIT,
     MODEL,
@@ -34,6 +39,13 @@ logging.basicConfig(
     level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 
+# module-level so scripts/estimate.py prices the prompts that are actually sent
+QUESTIONS_TEMPLATE = "{PROMPT_PREFIX}Generate {NUM_QUESTIONS} short answer questions about the facts mentioned in the following paragraph. The questions should be self-contained; meaning you avoid using references such as 'it', 'the game', 'the person', etc., but should directly include the name of the referenced item instead. Remember to include relevant context in the question. \n\nParagraph: {PARAGRAPH}\n{PROMPT_SUFFIX}"
+QUESTIONS_RETRY_TEMPLATE = "{PROMPT_PREFIX}Generate {NUM_QUESTIONS} additional short answer (DO NOT INCLUDE CHOICES) questions about the facts mentioned in the following paragraph. The questions should be self-contained; meaning you avoid using references such as 'it', 'the game', 'the person', etc., but should directly include the name of the referenced item instead. Remember to include relevant context in the question. \n\nExisting questions:\n{EXISTING_QUESTIONS}\n\nParagraph: {PARAGRAPH}\n{PROMPT_SUFFIX}"
+# guided-choice answerability checks; sent with PROMPT_PREFIX and PROMPT_SUFFIX
+ANSWERABLE_IC_TEMPLATE = "Is the following question: \n\n {QUESTION} \n\n answerable using only the following fact? \n\n Fact: {FACT} \n\n Reply 'YES' and 'NO' only."
+ANSWERABLE_ZS_TEMPLATE = "Is the following question: \n\n {QUESTION} \n\n a valid question without additional context? \n\n Reply 'YES' and 'NO' only."
+
 
 ###################################################################################################
 #                                        Combined Functions                                       #
@@ -46,8 +58,8 @@ async def generate_n_filter_questions_with_retry(
 ):
     try:
         # process prompt template
-        time.sleep(randwait(WAIT))
-        prompt_template = "{PROMPT_PREFIX}Generate {NUM_QUESTIONS} additional short answer (DO NOT INCLUDE CHOICES) questions about the facts mentioned in the following paragraph. The questions should be self-contained; meaning you avoid using references such as 'it', 'the game', 'the person', etc., but should directly include the name of the referenced item instead. Remember to include relevant context in the question. \n\nExisting questions:\n{EXISTING_QUESTIONS}\n\nParagraph: {PARAGRAPH}\n{PROMPT_SUFFIX}"
+        await asyncio.sleep(randwait(WAIT))
+        prompt_template = QUESTIONS_RETRY_TEMPLATE
         context, fact = generate_fact_with_context(paragraph)
         _, template = generate_prompts_from_template(
             prompt_template,
@@ -60,12 +72,12 @@ async def generate_n_filter_questions_with_retry(
             },
         )
 
-        author_id = await create_author_if_not_exists(template, MODEL)
+        author_id = await create_author_if_not_exists(template, MODEL, "question")
 
         logging.info(f"Generating questions for paragraph: {paragraph.id}")
 
         # helper function to generate questions
-        def generate_or_regenerate_questions(existing_questions):
+        async def generate_or_regenerate_questions(existing_questions):
             existing = ""
             for i, q in enumerate(existing_questions):
                 existing += f"{i+1}. {q}\n"
@@ -80,8 +92,8 @@ async def generate_n_filter_questions_with_retry(
                 },
             )
             logging.info(f"Prompt: {prompt}")
-            time.sleep(randwait(WAIT))
-            output = llm_safe_request(prompt, MODEL, STOP)
+            await asyncio.sleep(randwait(WAIT))
+            output = await llm_safe_request_async(prompt, MODEL, STOP)
             logging.info(
                 f"Generated questions: {output['choices'][0]['message']['content']}"
             )
@@ -97,12 +109,16 @@ async def generate_n_filter_questions_with_retry(
         attempts = 0
         while len(good_questions) < k and attempts < max_attempts:
             attempts += 1
-            questions = generate_or_regenerate_questions(good_questions)
+            questions = await generate_or_regenerate_questions(good_questions)
             logging.info(f"Generated Questions {attempts}: {questions}")
             for q in questions:
                 logging.info(f"Checking if answerable: {q}")
-                q_is_answerable_ic = is_answerable(q, fact)
-                q_is_answerable_zs = is_answerable(q)
+                q_is_answerable_ic = await cascade_answerable(
+                    q, fact, is_answerable_in_thread
+                )
+                q_is_answerable_zs = await cascade_answerable(
+                    q, "", is_answerable_in_thread
+                )
                 logging.info(
                     f"Answerable in IC: {q_is_answerable_ic}, Answerable in ZS: {q_is_answerable_zs}"
                 )
@@ -116,10 +132,8 @@ async def generate_n_filter_questions_with_retry(
 
         logging.info(f"Good Questions: {good_questions}")
 
-        question_objs = []
-        # Add questions to the database
-        for q in good_questions:
-            question = Question(
+        questions_to_add = [
+            Question(
                 paragraph_id=paragraph.id,
                 scope="single-paragraph",
                 text=q,
@@ -129,12 +143,15 @@ async def generate_n_filter_questions_with_retry(
                 upvote=0,
                 downvote=0,
             )
+            for q in good_questions
+        ]
+        # Add questions to the database; ids come from the allocator so the
+        # rows can be written in one INSERT at commit time
+        await assign_ids(questions_to_add)
+        for question in questions_to_add:
             logging.info(f"Adding question: {question.text}")
-            db.add(question)
-            await db.flush()
-            await db.refresh(question, ["id"])
-            question_objs.append(question.id)
-        return question_objs
+        db.add_all(questions_to_add)
+        return [question.id for question in questions_to_add]
     except Exception as e:
         logging.error(str(e))
         raise
@@ -148,7 +165,7 @@ async def generate_n_filter_questions_single_turn(
     flush: bool = True,
 ):
     try:
-        prompt_template = "{PROMPT_PREFIX}Generate {NUM_QUESTIONS} short answer questions about the facts mentioned in the following paragraph. The questions should be self-contained; meaning you avoid using references such as 'it', 'the game', 'the person', etc., but should directly include the name of the referenced item instead. Remember to include relevant context in the question. \n\nParagraph: {PARAGRAPH}\n{PROMPT_SUFFIX}"
+        prompt_template = QUESTIONS_TEMPLATE
         context, fact = generate_fact_with_context(paragraph)
         prompt, template = generate_prompts_from_template(
             prompt_template,
@@ -160,12 +177,12 @@ async def generate_n_filter_questions_single_turn(
             },
         )
 
-        author_id = await create_author_if_not_exists(template, MODEL)
+        author_id = await create_author_if_not_exists(template, MODEL, "question")
 
         logging.debug(f"Generating questions for paragraph: {paragraph.id}")
 
         async def generate_and_reject_unanswerable_questions():
-            output = llm_safe_request(prompt, MODEL, STOP)
+            output = await llm_safe_request_async(prompt, MODEL, STOP)
             logging.debug(
                 f"Generated questions: {output['choices'][0]['message']['content']}"
             )
@@ -179,8 +196,8 @@ async def generate_n_filter_questions_single_turn(
 
             async def check_question(q):
                 logging.debug(f"Checking if answerable: {q}")
-                q_is_answerable_ic = await is_answerable_guided_choice(q, fact)
-                q_is_answerable_zs = await is_answerable_guided_choice(q)
+                q_is_answerable_ic = await check_answerable(q, fact)
+                q_is_answerable_zs = await check_answerable(q)
                 logging.debug(
                     f"Answerable in IC: {q_is_answerable_ic}, Answerable in ZS: {q_is_answerable_zs}"
                 )
@@ -205,7 +222,6 @@ async def generate_n_filter_questions_single_turn(
 
             if flush:
                 db.add_all(rejected_questions)
-                await db.flush()
                 return good_questions, None
             else:
                 return good_questions, rejected_questions
@@ -230,9 +246,9 @@ async def generate_n_filter_questions_single_turn(
             )
             for q in good_questions
         ]
+        await assign_ids(questions_to_add)
         if flush:
             db.add_all(questions_to_add)
-            await db.flush()
             question_objs = [question.id for question in questions_to_add]
             return question_objs
         else:
@@ -252,7 +268,7 @@ async def generate_questions_single_turn(
     k: int = NUMQUESTIONS,
 ) -> List[Question]:
     try:
-        prompt_template = "{PROMPT_PREFIX}Generate {NUM_QUESTIONS} short answer questions about the facts mentioned in the following paragraph. The questions should be self-contained; meaning you avoid using references such as 'it', 'the game', 'the person', etc., but should directly include the name of the referenced item instead. Remember to include relevant context in the question. \n\nParagraph: {PARAGRAPH}\n{PROMPT_SUFFIX}"
+        prompt_template = QUESTIONS_TEMPLATE
         context, fact = generate_fact_with_context(paragraph)
         prompt, template = generate_prompts_from_template(
             prompt_template,
@@ -264,7 +280,7 @@ async def generate_questions_single_turn(
             },
         )
 
-        author_id = await create_author_if_not_exists(template, MODEL)
+        author_id = await create_author_if_not_exists(template, MODEL, "question")
 
         logging.debug(f"Generating questions for paragraph: {paragraph.id}")
 
@@ -292,6 +308,7 @@ async def generate_questions_single_turn(
             )
             for q in new_questions
         ]
+        await assign_ids(question_objects)
         return question_objects
 
     except Exception as e:
@@ -312,14 +329,16 @@ async def filter_questions(
             questions_by_paragraph[q.paragraph_id] = []
         questions_by_paragraph[q.paragraph_id].append(q)
 
+    paragraphs = await load_paragraphs(db, list(questions_by_paragraph))
+
     async def check_questions_for_paragraph(paragraph_id, questions):
-        paragraph = await db.get(Paragraph, paragraph_id)
+        paragraph = paragraphs[paragraph_id]
         context, fact = generate_fact_with_context(paragraph)
 
         for q in questions:
             logging.debug(f"Checking if answerable: {q.text}")
-            q_is_answerable_ic = await is_answerable_guided_choice(q.text, fact)
-            q_is_answerable_zs = await is_answerable_guided_choice(q.text)
+            q_is_answerable_ic = await check_answerable(q.text, fact)
+            q_is_answerable_zs = await check_answerable(q.text)
             logging.debug(
                 f"Answerable in IC: {q_is_answerable_ic}, Answerable in ZS: {q_is_answerable_zs}"
             )
@@ -368,15 +387,26 @@ def is_answerable(question, fact=""):
     return False
 
 
+# is_answerable makes a blocking request; keep it off the loop
+async def is_answerable_in_thread(question, fact=""):
+    return await asyncio.to_thread(is_answerable, question, fact)
+
+
+async def check_answerable(question, fact=""):
+    """Answerability through the cascade: the local classifier when it is
+    confident, the guided-choice LLM check otherwise."""
+    return await cascade_answerable(question, fact, is_answerable_guided_choice)
+
+
 async def is_answerable_guided_choice(question, fact=""):
     if not question.strip():
         logging.debug("No question seen in is_answerable: ", question.strip())
         return False
-    time.sleep(randwait(WAIT))
+    await asyncio.sleep(randwait(WAIT))
     if not fact:
-        prompt = f"Is the following question: \n\n {question} \n\n a valid question without additional context? \n\n Reply 'YES' and 'NO' only."
+        prompt = ANSWERABLE_ZS_TEMPLATE.format(QUESTION=question)
     else:
-        prompt = f"Is the following question: \n\n {question} \n\n answerable using only the following fact? \n\n Fact: {fact} \n\n Reply 'YES' and 'NO' only."
+        prompt = ANSWERABLE_IC_TEMPLATE.format(QUESTION=question, FACT=fact)
 
     output = await llm_safe_request_async(
         prompt,
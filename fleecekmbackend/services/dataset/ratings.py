@@ -1,23 +1,35 @@
 import re
-import time
+import asyncio
 import logging
 from datetime import datetime
+from typing import Dict
 from sqlalchemy.ext.asyncio import AsyncSession
 from fleecekmbackend.db.models import (
     Paragraph,
     Question,
     Answer,
     Rating,
+    rating_dedup_key,
 )
-from fleecekmbackend.db.helpers import create_author_if_not_exists
+from fleecekmbackend.db.helpers import (
+    add_idempotent,
+    create_author_if_not_exists,
+    find_existing,
+    find_existing_many,
+)
+from fleecekmbackend.db.sequences import assign_ids
 from fleecekmbackend.core.utils.llm import (
     llm_safe_request,
     llm_safe_request_async,
     randwait,
     generate_prompts_from_template,
 )
-from fleecekmbackend.services.dataset.common import generate_fact_with_context
+from fleecekmbackend.services.dataset.common import (
+    AnswerContext,
+    generate_fact_with_context,
+)
 from fleecekmbackend.core.config import (
+    RATING_TARGETS,
     WAIT,
     MODEL,
     STOP,
@@ -31,6 +43,51 @@ logging.basicConfig(
     level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 
+# read by scripts/estimate.py as well
+RATING_TEMPLATE = "{PROMPT_PREFIX}Based on this fact: \n\n `{REFERENCE}` \n\n Rate the following answer to the question - Question: `{QUESTION}` \n\n Answer: `{ANSWER}`; give a number from 0-5 where 0 is 'No answer or completely irrelevant', 1 is 'Significantly incorrect or incomplete', 2 is 'Partially correct; major inaccuracies or omissions', 3 is 'Correct but lacks depth; minimal detail', 4 is 'Mostly correct; minor errors, includes relevant details', 5 is 'Fully accurate and detailed; clear and comprehensive'. Your answer should follow the form `Answer:<number> \n Rationale:<justify your judgment in a paragraph>`. \n{PROMPT_SUFFIX}"
+
+
+def rating_author_prompt():
+    """The prompt that ratings generated from RATING_TEMPLATE are attributed to."""
+    _, template = generate_prompts_from_template(
+        RATING_TEMPLATE,
+        {
+            "REFERENCE": "",
+            "QUESTION": "",
+            "ANSWER": "",
+            "PROMPT_PREFIX": PROMPT_PREFIX,
+            "PROMPT_SUFFIX": PROMPT_SUFFIX,
+        },
+    )
+    return template
+
+
+async def load_existing_ratings(
+    contexts: Dict[int, AnswerContext], judges=None
+) -> Dict[int, AnswerContext]:
+    """Look up the stored ratings of a batch of answers with one query, for
+    every (service, model) in ``judges`` (RATING_TARGETS by default).
+    generate_answer_rating then skips its own lookup."""
+    judges = judges or RATING_TARGETS
+    if not contexts:
+        return contexts
+    author_ids = [
+        await create_author_if_not_exists(rating_author_prompt(), model, "rating")
+        for _, model in judges
+    ]
+    existing = await find_existing_many(
+        Rating,
+        [
+            rating_dedup_key(answer_id, author_id)
+            for answer_id in contexts
+            for author_id in author_ids
+        ],
+    )
+    return {
+        answer_id: context._replace(existing=existing)
+        for answer_id, context in contexts.items()
+    }
+
 
 async def generate_answer_rating(
     db: AsyncSession,
@@ -39,15 +96,22 @@ async def generate_answer_rating(
     model: str = MODEL,
     service: str = "gpublaze",
     flush: bool = True,
+    context: AnswerContext = None,
 ):
     try:
-        prompt_template = "{PROMPT_PREFIX}Based on this fact: \n\n `{REFERENCE}` \n\n Rate the following answer to the question - Question: `{QUESTION}` \n\n Answer: `{ANSWER}`; give a number from 0-5 where 0 is 'No answer or completely irrelevant', 1 is 'Significantly incorrect or incomplete', 2 is 'Partially correct; major inaccuracies or omissions', 3 is 'Correct but lacks depth; minimal detail', 4 is 'Mostly correct; minor errors, includes relevant details', 5 is 'Fully accurate and detailed; clear and comprehensive'. Your answer should follow the form `Answer:<number> \n Rationale:<justify your judgment in a paragraph>`. \n{PROMPT_SUFFIX}"
+        prompt_template = RATING_TEMPLATE
 
-        answer = await db.get(Answer, answer_id)
-        question = await db.get(Question, answer.question_id)
-        paragraph = await db.get(Paragraph, question.paragraph_id)
-
-        _, reference = generate_fact_with_context(paragraph)
+        if context is not None:
+            answer, question, reference = (
+                context.answer,
+                context.question,
+                context.fact,
+            )
+        else:
+            answer = await db.get(Answer, answer_id)
+            question = await db.get(Question, answer.question_id)
+            paragraph = await db.get(Paragraph, question.paragraph_id)
+            _, reference = generate_fact_with_context(paragraph)
 
         prompt, template = generate_prompts_from_template(
             prompt_template,
@@ -60,15 +124,24 @@ async def generate_answer_rating(
             },
         )
 
-        author_id = await create_author_if_not_exists(template, model)
+        author_id = await create_author_if_not_exists(template, model, "rating")
 
         logging.debug(f"Author ID: {author_id}")
 
+        dedup_key = rating_dedup_key(answer_id, author_id)
+        if context is not None and context.existing is not None:
+            existing = context.existing.get(dedup_key)
+        else:
+            existing = await find_existing(Rating, dedup_key)
+        if existing is not None:
+            logging.info(f"Rating of answer {answer_id} already exists: {existing.id}")
+            return existing.id if flush else existing
+
         # main loop
         attempts = 0
         while attempts < max_attempts:
             attempts += 1
-            time.sleep(randwait(WAIT))
+            await asyncio.sleep(randwait(WAIT))
             output = await llm_safe_request_async(prompt, model, STOP, service=service)
             rating_raw = output["choices"][0]["message"]["content"].strip()
 
@@ -90,10 +163,9 @@ async def generate_answer_rating(
                 logging.debug(
                     f"Generated rating: {rating.value} for answer: {answer.text} with rationale: {rating.text}"
                 )
+                await assign_ids([rating])
                 if flush:
-                    db.add(rating)
-                    await db.flush()
-                    await db.refresh(rating, ["id"])
+                    await add_idempotent(db, [rating])
                     logging.debug(
                         f"Generated rating: {rating.value} for answer: {answer.text} with rationale: {rating.text}, id: {rating.id}"
                     )
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.models import TIMESTAMP_FORMAT, Question, VoteLog
+from fleecekmbackend.core.config import (
+    VOTE_FLUSH_INTERVAL,
+    VOTE_LOG_ENABLED,
+    VOTE_REPLAY_INTERVAL,
+)
+
+
+def _vote_increments(deltas, column: int):
+    whens = {qid: delta[column] for qid, delta in deltas.items() if delta[column]}
+    if not whens:
+        return 0
+    return case(whens, value=Question.id, else_=0)
+
+
+async def _apply_deltas(db: AsyncSession, deltas):
+    # one UPDATE for every question voted on since the last flush
+    await db.execute(
+        update(Question)
+        .where(Question.id.in_(list(deltas)))
+        .values(
+            upvote=func.coalesce(Question.upvote, 0) + _vote_increments(deltas, 0),
+            downvote=func.coalesce(Question.downvote, 0) + _vote_increments(deltas, 1),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def _apply_logged_votes(db: AsyncSession, *conditions):
+    """Fold the unapplied vote_log rows matching ``conditions`` into the
+    question totals and mark them applied.
+
+    Flushes and replays may reach for the same rows; whichever marks them
+    first applies them, the other raises and rolls back.
+    """
+    rows = (
+        await db.execute(
+            select(VoteLog.id, VoteLog.question_id, VoteLog.vote)
+            .where(VoteLog.applied == False, *conditions)
+            .with_for_update()
+        )
+    ).all()
+    if not rows:
+        return 0
+    result = await db.execute(
+        update(VoteLog)
+        .where(VoteLog.id.in_([row[0] for row in rows]), VoteLog.applied == False)
+        .values(applied=True)
+    )
+    if result.rowcount != len(rows):
+        raise Exception("vote log rows were applied concurrently")
+    deltas = defaultdict(lambda: [0, 0])
+    for _, question_id, vote in rows:
+        deltas[question_id][0 if vote == "up" else 1] += 1
+    await _apply_deltas(db, deltas)
+    return len(rows)
+
+
+class VoteAccumulator:
+    """Batches question votes in memory and applies them periodically.
+
+    Popular questions would otherwise serialize every click on one row lock.
+    With ``durable`` set, each vote is first appended to ``vote_log`` (inserts
+    do not contend), and the periodic flush marks the log rows applied in the
+    same transaction as the counter update. Every ``replay_interval`` seconds
+    it also applies votes logged by processes that died before flushing.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = VOTE_FLUSH_INTERVAL,
+        durable: bool = VOTE_LOG_ENABLED,
+        replay_interval: float = VOTE_REPLAY_INTERVAL,
+    ):
+        self.flush_interval = flush_interval
+        self.durable = durable
+        self.replay_interval = replay_interval
+        self._pending = defaultdict(lambda: [0, 0])  # question id -> [up, down]
+        self._pending_log_ids = []
+        self._in_flight = []  # deltas of flushes that have not committed yet
+        self._task = None
+
+    async def record(self, question_id: int, vote: str, user_name: str = None):
+        """Buffer a vote. Returns False, logging nothing, if the question does
+        not exist."""
+        async with async_session() as db:
+            exists = await db.scalar(
+                select(Question.id).where(Question.id == question_id)
+            )
+            if exists is None:
+                return False
+            if self.durable:
+                entry = VoteLog(
+                    question_id=question_id,
+                    username=user_name,
+                    vote=vote,
+                    timestamp=datetime.now().strftime(TIMESTAMP_FORMAT),
+                )
+                db.add(entry)
+                await db.flush()
+                log_id = entry.id
+                await db.commit()
+                self._pending_log_ids.append(log_id)
+        self._pending[question_id][0 if vote == "up" else 1] += 1
+        return True
+
+    def pending(self, question_id: int):
+        up, down = self._pending.get(question_id, (0, 0))
+        for deltas in self._in_flight:
+            in_flight_up, in_flight_down = deltas.get(question_id, (0, 0))
+            up, down = up + in_flight_up, down + in_flight_down
+        return up, down
+
+    async def totals(self, db: AsyncSession, question_id: int):
+        """Stored totals plus votes not flushed yet (read-your-writes)."""
+        row = (
+            await db.execute(
+                select(Question.upvote, Question.downvote).where(
+                    Question.id == question_id
+                )
+            )
+        ).first()
+        if row is None:
+            return None
+        up, down = self.pending(question_id)
+        return {"upvote": (row[0] or 0) + up, "downvote": (row[1] or 0) + down}
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        # swap the buffers before awaiting so new votes go to the next batch;
+        # the swapped out ones count as pending until they are committed
+        deltas, self._pending = self._pending, defaultdict(lambda: [0, 0])
+        log_ids, self._pending_log_ids = self._pending_log_ids, []
+        self._in_flight.append(deltas)
+        try:
+            async with async_session() as db:
+                try:
+                    if self.durable:
+                        # a replay may have applied some of them already
+                        await _apply_logged_votes(db, VoteLog.id.in_(log_ids))
+                    else:
+                        await _apply_deltas(db, deltas)
+                    await db.commit()
+                except Exception as e:
+                    await db.rollback()
+                    logging.error(f"Error flushing votes: {str(e)}")
+                    for question_id, (up, down) in deltas.items():
+                        self._pending[question_id][0] += up
+                        self._pending[question_id][1] += down
+                    self._pending_log_ids.extend(log_ids)
+                    return 0
+        finally:
+            self._in_flight.remove(deltas)
+        return sum(up + down for up, down in deltas.values())
+
+    async def run(self):
+        last_replay = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self.durable and time.monotonic() - last_replay >= self.replay_interval:
+                last_replay = time.monotonic()
+                await replay_vote_log()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+async def replay_vote_log(grace_seconds: float = 60):
+    """Apply votes logged by a process that died before flushing them.
+
+    Only rows older than ``grace_seconds`` are replayed, so votes a live
+    process is about to flush are normally left to it; should both reach for
+    the same rows, only one applies them.
+    """
+    cutoff = (datetime.now() - timedelta(seconds=grace_seconds)).strftime(
+        TIMESTAMP_FORMAT
+    )
+    async with async_session() as db:
+        try:
+            replayed = await _apply_logged_votes(db, VoteLog.timestamp < cutoff)
+            if not replayed:
+                return 0
+            await db.commit()
+            logging.info(f"Replayed {replayed} unapplied votes from the vote log")
+            return replayed
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error replaying vote log: {str(e)}")
+            return 0
+
+
+vote_accumulator = VoteAccumulator()
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import math
+import time
+
+from fleecekmbackend.core.metrics import (
+    PIPELINE_CONSUMERS,
+    PIPELINE_FAILURES,
+    PIPELINE_ITEM_SECONDS,
+    PIPELINE_ITEMS,
+    PIPELINE_ITEMS_PER_SECOND,
+    PIPELINE_QUEUE_DEPTH,
+)
+from fleecekmbackend.core.config import (
+    AUTOSCALE_DRAIN_SECONDS,
+    AUTOSCALE_INTERVAL,
+    AUTOSCALE_LOW_UTILIZATION,
+)
+
+_STOP = object()
+
+
+class ConsumerPool:
+    """Workers draining a queue, resized between ``min_workers`` and
+    ``max_workers`` from the queue depth and the observed item latency.
+
+    Every ``interval`` seconds the pool sizes itself to clear the backlog within
+    ``drain_seconds``: it grows straight to that size, and shrinks one worker at
+    a time while utilization stays below ``low_utilization``. Retired workers
+    finish their current item first.
+    """
+
+    def __init__(
+        self,
+        name,
+        queue: asyncio.Queue,
+        handle,
+        min_workers: int = 1,
+        max_workers: int = 8,
+        interval: float = AUTOSCALE_INTERVAL,
+        drain_seconds: float = AUTOSCALE_DRAIN_SECONDS,
+        low_utilization: float = AUTOSCALE_LOW_UTILIZATION,
+    ):
+        self.name = name
+        self.queue = queue
+        self.handle = handle
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.interval = interval
+        self.drain_seconds = drain_seconds
+        self.low_utilization = low_utilization
+        self._workers = set()
+        self._retire = 0
+        self._scaler = None
+        self.latency = None  # moving average of seconds per item
+        self.items = 0
+        self.busy_time = 0.0
+        self.worker_seconds = 0.0
+        self.peak_workers = 0
+        self.scale_events = 0
+        self.started_at = None
+        self._last_sample = None
+        self._running = {}  # item start times, for utilization mid-item
+        self._window_busy = 0.0
+        self._window_items = 0
+
+    @property
+    def size(self):
+        return len(self._workers) - self._retire
+
+    def start(self):
+        self.started_at = self._last_sample = time.time()
+        PIPELINE_QUEUE_DEPTH.set_function(self.queue.qsize, stage=self.name)
+        PIPELINE_CONSUMERS.set_function(lambda: self.size, stage=self.name)
+        self._spawn(self.min_workers)
+        self._scaler = asyncio.create_task(self._autoscale())
+        return self
+
+    def _spawn(self, n):
+        for _ in range(n):
+            task = asyncio.create_task(self._worker())
+            self._workers.add(task)
+            task.add_done_callback(self._workers.discard)
+        self.peak_workers = max(self.peak_workers, len(self._workers))
+
+    async def _worker(self):
+        while True:
+            entry = await self.queue.get()
+            if entry is _STOP:
+                self.queue.task_done()
+                return
+            start_time = time.time()
+            token = object()
+            self._running[token] = start_time
+            try:
+                await self.handle(entry)
+            except Exception as e:
+                PIPELINE_FAILURES.inc(stage=self.name)
+                logging.error(f"{self.name}: unhandled error in consumer: {str(e)}")
+            finally:
+                del self._running[token]
+                end_time = time.time()
+                elapsed = end_time - start_time
+                self._window_busy += end_time - max(start_time, self._last_sample)
+                self.items += 1
+                self._window_items += 1
+                PIPELINE_ITEMS.inc(stage=self.name)
+                PIPELINE_ITEM_SECONDS.observe(elapsed, stage=self.name)
+                self.busy_time += elapsed
+                self.latency = (
+                    elapsed
+                    if self.latency is None
+                    else 0.8 * self.latency + 0.2 * elapsed
+                )
+                self.queue.task_done()
+            if self._retire > 0:
+                self._retire -= 1
+                return
+
+    def _resize(self, target, reason):
+        target = min(max(target, self.min_workers), self.max_workers)
+        if target == self.size:
+            return
+        logging.info(
+            f"{self.name}: scaling consumers {self.size} -> {target} ({reason})"
+        )
+        self.scale_events += 1
+        if target > self.size:
+            cancelled = min(self._retire, target - self.size)
+            self._retire -= cancelled
+            self._spawn(target - self.size)
+        else:
+            self._retire += self.size - target
+
+    def _sample(self):
+        now = time.time()
+        elapsed = max(now - self._last_sample, 1e-9)
+        workers = len(self._workers)
+        self.worker_seconds += workers * elapsed
+        busy = self._window_busy + sum(
+            now - max(start, self._last_sample) for start in self._running.values()
+        )
+        PIPELINE_ITEMS_PER_SECOND.set(self._window_items / elapsed, stage=self.name)
+        self._last_sample, self._window_busy, self._window_items = now, 0.0, 0
+        return min(busy / (workers * elapsed), 1.0) if workers else 0.0
+
+    async def _autoscale(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            utilization = self._sample()
+            depth = self.queue.qsize()
+            if self.queue.full():
+                # a full bounded queue hides the real backlog; every worker is busy
+                self._resize(self.size * 2, f"queue full at {depth}")
+                continue
+            if self.latency is None:
+                if depth > self.size:
+                    # nothing finished yet, so every worker is still busy
+                    self._resize(self.size * 2, f"queue depth {depth}, no latency yet")
+                continue
+            wanted = math.ceil(depth * self.latency / self.drain_seconds)
+            reason = (
+                f"queue depth {depth}, latency {self.latency:.2f}s, "
+                f"utilization {utilization:.0%}"
+            )
+            if wanted > self.size:
+                self._resize(wanted, reason)
+            elif wanted < self.size and utilization < self.low_utilization:
+                self._resize(self.size - 1, reason)
+
+    async def close(self):
+        """Wait for the queue to empty, then stop every worker."""
+        await self.queue.join()
+        self._scaler.cancel()
+        self._sample()
+        workers = list(self._workers)
+        for _ in workers:
+            await self.queue.put(_STOP)
+        await asyncio.gather(*workers)
+        PIPELINE_QUEUE_DEPTH.set(0, stage=self.name)
+        PIPELINE_CONSUMERS.set(0, stage=self.name)
+
+    def report(self):
+        elapsed = max(time.time() - (self.started_at or time.time()), 1e-9)
+        return {
+            "items": self.items,
+            "avg_latency": self.busy_time / self.items if self.items else 0.0,
+            "avg_workers": self.worker_seconds / elapsed,
+            "peak_workers": self.peak_workers,
+            "utilization": (
+                self.busy_time / self.worker_seconds if self.worker_seconds else 0.0
+            ),
+            "scale_events": self.scale_events,
+        }
+
+
+def log_utilization_report(pools):
+    for pool in pools:
+        stats = pool.report()
+        logging.info(
+            f"{pool.name}: {stats['items']} items, {stats['avg_latency']:.2f}s avg latency, "
+            f"{stats['avg_workers']:.1f} avg / {stats['peak_workers']} peak consumers, "
+            f"{stats['utilization']:.0%} utilization, {stats['scale_events']} scaling decisions"
+        )
@@ -1,27 +1,61 @@
 import asyncio
 import logging
-from sqlalchemy import func, select, update
+import time
+from collections import defaultdict
+from sqlalchemy import func, select
+from sqlalchemy import inspect as sa_inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Tuple
 
-from fleecekmbackend.core.utils.llm import randwait
+from fleecekmbackend.core.utils.llm import randwait, track_prompts
 from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.deadletter import not_dead_lettered, record_failure
 from fleecekmbackend.db.helpers import (
+    claim_page_paragraphs,
+    find_existing_many,
     get_next_unprocessed_paragraphs,
+    insert_ignore,
+    row_from_object,
 )
 from fleecekmbackend.db.models import (
     Paragraph,
     Question,
+    RejectedQuestion,
     Answer,
     Rating,
+    answer_dedup_key,
 )
 from fleecekmbackend.services.dataset.questions import (
     generate_n_filter_questions_with_retry,
     generate_n_filter_questions_single_turn,
 )
-from fleecekmbackend.services.dataset.answers import generate_answer
-from fleecekmbackend.services.dataset.ratings import generate_answer_rating
-from fleecekmbackend.core.config import WAIT, LOGGING_LEVEL
+from fleecekmbackend.services.dataset.common import (
+    AnswerContext,
+    QuestionContext,
+    generate_fact_with_context,
+)
+from fleecekmbackend.services.dataset.answers import (
+    generate_answer,
+    load_existing_answers,
+)
+from fleecekmbackend.services.dataset.ratings import (
+    generate_answer_rating,
+    load_existing_ratings,
+)
+from fleecekmbackend.services.generation.sharding import ShardTable, shard_query
+from fleecekmbackend.core.metrics import (
+    LLM_CALLS_AVOIDED,
+    PIPELINE_FAILURES,
+    PIPELINE_ITEM_SECONDS,
+    PIPELINE_ITEMS,
+)
+from fleecekmbackend.core.config import (
+    ANSWER_TARGETS,
+    E2E_SCHEDULING,
+    LOGGING_LEVEL,
+    RATING_TARGETS,
+    WAIT,
+)
 
 logging.basicConfig(
     level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -60,9 +94,7 @@ async def process_paragraph_e2e(
                 logging.error(f"Error processing question: {question_id}")
                 logging.error(str(e))
                 raise
-        await db.execute(
-            update(Paragraph).where(Paragraph.id == paragraph_id).values(processed=1)
-        )
+        paragraph.processed = True
         await db.commit()
         logging.info(f"Processed paragraph: {paragraph_id}")
 
@@ -73,12 +105,26 @@ async def process_paragraph_e2e(
     return generated_question_ids, generated_answer_ids, generated_rating_ids
 
 
-async def generate_answers_for_question(db: AsyncSession, question_id: int):
-    answers = []
+async def generate_answers_for_question(
+    db: AsyncSession, question_id: int, context: QuestionContext = None, targets=None
+):
+    targets = targets or ANSWER_TARGETS
     try:
-        for setting in ["zs", "ic"]:
-            answer = await generate_answer(db, question_id, setting, flush=False)
-            answers.append(answer)
+        answers = await asyncio.gather(
+            *[
+                generate_answer(
+                    db,
+                    question_id,
+                    setting,
+                    model=model,
+                    service=service,
+                    flush=False,
+                    context=context,
+                )
+                for service, model in targets
+                for setting in ["zs", "ic"]
+            ]
+        )
     except Exception as e:
         logging.error(f"Error generating answers for question: {question_id}")
         logging.error(str(e))
@@ -86,65 +132,228 @@ async def generate_answers_for_question(db: AsyncSession, question_id: int):
     return answers
 
 
-async def generate_ratings_for_answer(db: AsyncSession, answer_id: int):
+async def generate_ratings_for_answer(
+    db: AsyncSession, answer_id: int, context: AnswerContext = None, judges=None
+):
+    judges = judges or RATING_TARGETS
     try:
-        rating = await generate_answer_rating(db, answer_id, flush=False)
-        return rating
+        return await asyncio.gather(
+            *[
+                generate_answer_rating(
+                    db,
+                    answer_id,
+                    model=model,
+                    service=service,
+                    flush=False,
+                    context=context,
+                )
+                for service, model in judges
+            ]
+        )
     except Exception as e:
         logging.error(f"Error generating rating for answer: {answer_id}")
         logging.error(str(e))
         raise
 
 
+async def checkpoint(objects):
+    """Commit finished work right away, so a retry or a later run reuses it.
+
+    Uses its own session: committing the caller's session would release the
+    paragraph claim. Rows go through Core inserts, leaving the objects usable.
+    Returns how many rows were inserted; duplicates of stored rows are skipped.
+    """
+    rows = defaultdict(list)
+    for obj in objects:
+        rows[type(obj)].append(row_from_object(obj))
+    if not rows:
+        return 0
+    async with async_session() as checkpoint_db:
+        try:
+            inserted = 0
+            for model, model_rows in rows.items():
+                inserted += await insert_ignore(checkpoint_db, model, model_rows)
+            await checkpoint_db.commit()
+            return inserted
+        except Exception as e:
+            await checkpoint_db.rollback()
+            logging.error(f"Error committing checkpoint: {str(e)}")
+            raise
+
+
+async def keep_stored_answers(answers, new_answers):
+    """Swap the new answers insert_ignore skipped as duplicates for the rows
+    stored in their place, so ratings point at an answer that exists."""
+    keys = {
+        answer_dedup_key(a.question_id, a.author_id, a.setting, a.text): a
+        for a in new_answers
+    }
+    stored = await find_existing_many(Answer, keys)
+    skipped = {
+        a.id: stored[key]
+        for key, a in keys.items()
+        if key in stored and stored[key].id != a.id
+    }
+    if skipped:
+        logging.info(f"Rating stored answers {[a.id for a in skipped.values()]}")
+    return [skipped.get(a.id, a) for a in answers]
+
+
+async def load_checkpointed_questions(db: AsyncSession, paragraph_id: int):
+    """Questions an earlier attempt committed for the paragraph, or None."""
+    questions = (
+        (
+            await db.execute(
+                select(Question).where(Question.paragraph_id == paragraph_id)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    rejected_count = await db.scalar(
+        select(func.count(RejectedQuestion.id)).where(
+            RejectedQuestion.paragraph_id == paragraph_id
+        )
+    )
+    if not questions and not rejected_count:
+        return None
+    return questions, rejected_count
+
+
 async def process_paragraph_e2e_with_retry(
-    db: AsyncSession, paragraph: Paragraph
+    db: AsyncSession, paragraph: Paragraph, stats=None
 ) -> Tuple[List[Question], List[Answer], List[Rating]]:
+    """Generate questions, answers and ratings for a paragraph.
+
+    Each step is committed as soon as it finishes, so a retry resumes from the
+    step that failed: committed questions are loaded back, and committed
+    answers and ratings are found by their dedup keys instead of regenerated.
+    The LLM calls saved that way are logged and added to
+    ``stats["llm_calls_avoided"]``. Running out of retries counts as one
+    failure towards dead-lettering the paragraph.
+    """
     max_retries = 3
     retry_delay = 5
     paragraph_id = paragraph.id
+    stats = stats if stats is not None else {}
+    stats.setdefault("llm_calls_avoided", 0)
+    start_time = time.perf_counter()
+    prompts = track_prompts()
 
     for attempt in range(max_retries):
         try:
             generated_question_ids = []
             generated_answer_ids = []
             generated_rating_ids = []
+            reused = {"questions": 0, "answers": 0, "ratings": 0}
+            calls_avoided = 0
 
             logging.info(f"Processing paragraph: {paragraph_id}")
-
-            question_ids = await generate_n_filter_questions_single_turn(db, paragraph)
+            if attempt > 0:
+                await db.refresh(paragraph)  # expired by the rollback
+
+            # Nothing is flushed on db until the final commit, so no write
+            # transaction stays open across LLM calls (SQLite allows only one
+            # writer at a time); checkpoints commit on their own sessions.
+            checkpointed = await load_checkpointed_questions(db, paragraph_id)
+            if checkpointed is not None:
+                questions, rejected_count = checkpointed
+                reused["questions"] = len(questions)
+                # one generation call plus two answerability checks per question
+                calls_avoided += 1 + 2 * (len(questions) + rejected_count)
+            else:
+                questions, rejected_questions = (
+                    await generate_n_filter_questions_single_turn(
+                        db, paragraph, flush=False
+                    )
+                )
+                await checkpoint(questions + rejected_questions)
+            question_ids = [q.id for q in questions]
             logging.debug(f"generated_questions: {question_ids}")
             generated_question_ids.extend(question_ids)
+            _, fact = generate_fact_with_context(paragraph)
+            # questions generated just now have no answers to look up
+            question_contexts = {
+                q.id: QuestionContext(q, paragraph, fact, existing={})
+                for q in questions
+            }
+            if checkpointed is not None:
+                question_contexts = await load_existing_answers(question_contexts)
 
             # Stage 1: Generate answers for all questions
             all_answers = await asyncio.gather(
-                *[generate_answers_for_question(db, q_id) for q_id in question_ids]
+                *[
+                    generate_answers_for_question(db, q_id, question_contexts[q_id])
+                    for q_id in question_ids
+                ]
             )
             all_answers_flat = [a for answers in all_answers for a in answers]
-            db.add_all(all_answers_flat)
-            await db.flush()
+            done_answers = [a for a in all_answers_flat if a is not None]
+            new_answers = [a for a in done_answers if sa_inspect(a).transient]
+            reused["answers"] = len(done_answers) - len(new_answers)
+            inserted = await checkpoint(new_answers)
+            if len(done_answers) < len(all_answers_flat):
+                raise Exception(
+                    f"{len(all_answers_flat) - len(done_answers)} answers failed"
+                )
+            if inserted < len(new_answers):
+                all_answers_flat = await keep_stored_answers(
+                    all_answers_flat, new_answers
+                )
             generated_answer_ids.extend([a.id for a in all_answers_flat])
             logging.debug(f"generated_answer_ids: {generated_answer_ids}")
 
-            # Stage 2: Generate ratings for all answers
+            # Stage 2: Generate ratings for all answers, by every judge; only
+            # answers stored before this attempt can have ratings already
+            new_answer_ids = {a.id for a in new_answers}
+            answer_contexts = {
+                a.id: question_contexts[a.question_id].for_answer(
+                    a, {} if a.id in new_answer_ids else None
+                )
+                for a in all_answers_flat
+            }
+            answer_contexts.update(
+                await load_existing_ratings(
+                    {
+                        answer_id: context
+                        for answer_id, context in answer_contexts.items()
+                        if context.existing is None
+                    }
+                )
+            )
             all_ratings = await asyncio.gather(
                 *[
-                    generate_ratings_for_answer(db, a_id)
-                    for a_id in generated_answer_ids
+                    generate_ratings_for_answer(db, a.id, answer_contexts[a.id])
+                    for a in all_answers_flat
                 ]
             )
-            db.add_all(all_ratings)
-            await db.flush()
+            all_ratings = [r for ratings in all_ratings for r in ratings]
+            done_ratings = [r for r in all_ratings if r is not None]
+            reused["ratings"] = sum(not sa_inspect(r).transient for r in done_ratings)
+            await checkpoint([r for r in done_ratings if sa_inspect(r).transient])
+            if len(done_ratings) < len(all_ratings):
+                raise Exception(
+                    f"{len(all_ratings) - len(done_ratings)} ratings failed"
+                )
             generated_rating_ids.extend([r.id for r in all_ratings])
             logging.debug(f"generated_rating_ids: {generated_rating_ids}")
 
-            await db.execute(
-                update(Paragraph)
-                .where(Paragraph.id == paragraph_id)
-                .values(processed=True)
-            )
+            paragraph.processed = True
             await db.commit()
             logging.info(f"Processed paragraph: {paragraph_id}")
 
+            PIPELINE_ITEMS.inc(stage="e2e")
+            PIPELINE_ITEM_SECONDS.observe(time.perf_counter() - start_time, stage="e2e")
+            calls_avoided += reused["answers"] + reused["ratings"]
+            if calls_avoided:
+                stats["llm_calls_avoided"] += calls_avoided
+                LLM_CALLS_AVOIDED.inc(calls_avoided)
+                logging.info(
+                    f"Paragraph {paragraph_id} resumed from checkpoint: reused "
+                    f"{reused['questions']} questions, {reused['answers']} answers, "
+                    f"{reused['ratings']} ratings ({calls_avoided} LLM calls avoided)"
+                )
+
             return generated_question_ids, generated_answer_ids, generated_rating_ids
 
         except Exception as e:
@@ -157,6 +366,10 @@ async def process_paragraph_e2e_with_retry(
                 logging.error(
                     f"Max retries reached for paragraph: {paragraph_id}. Skipping."
                 )
+                PIPELINE_FAILURES.inc(stage="e2e")
+                await record_failure(
+                    Paragraph, paragraph_id, e, "e2e", prompts.get("prompt")
+                )
                 raise
 
 
@@ -165,7 +378,9 @@ async def process_all_pages_e2e():
         async with async_session() as db:
             # Check if there are any unprocessed paragraphs
             unprocessed_paragraph_exists = await db.scalar(
-                select(Paragraph.id).where(Paragraph.processed == False).limit(1)
+                select(Paragraph.id)
+                .where(Paragraph.processed == False, not_dead_lettered(Paragraph))
+                .limit(1)
             )
 
             if not unprocessed_paragraph_exists:
@@ -203,11 +418,24 @@ async def process_all_pages_e2e():
                 await asyncio.sleep(randwait(WAIT))
 
 
-async def process_all_pages_e2e_parallel(batch_size=5):
+async def process_all_pages_e2e_parallel(batch_size=5, stop_event=None, stats=None):
+    """Process paragraphs until none are left or ``stop_event`` is set.
+
+    A stop request only prevents claiming new paragraphs; the batch in flight is
+    finished and committed. ``stats`` collects processed/failed paragraph counts.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("paragraphs_processed", 0)
+    stats.setdefault("paragraphs_failed", 0)
     while True:
+        if stop_event is not None and stop_event.is_set():
+            logging.info("Stop requested. Not claiming more paragraphs.")
+            break
         async with async_session() as db:
             unprocessed_paragraph_exists = await db.scalar(
-                select(Paragraph.id).where(Paragraph.processed == False).limit(1)
+                select(Paragraph.id)
+                .where(Paragraph.processed == False, not_dead_lettered(Paragraph))
+                .limit(1)
             )
 
             if unprocessed_paragraph_exists is None:
@@ -227,20 +455,114 @@ async def process_all_pages_e2e_parallel(batch_size=5):
                 tasks = []
                 for paragraph in paragraphs:
                     task = asyncio.create_task(
-                        process_paragraph_e2e_with_retry(db, paragraph)
+                        process_paragraph_e2e_with_retry(db, paragraph, stats)
                     )
                     tasks.append(task)
 
-                await asyncio.gather(*tasks)
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                failures = [r for r in results if isinstance(r, Exception)]
+                stats["paragraphs_processed"] += len(results) - len(failures)
+                stats["paragraphs_failed"] += len(failures)
+                if failures:
+                    raise failures[0]
 
             except Exception as e:
                 logging.error(f"Error occurred in process_all_pages_parallel: {str(e)}")
                 await asyncio.sleep(randwait(WAIT))
 
 
-async def start_background_process_e2e():
+async def process_pages_e2e(stop_event=None, stats=None):
+    """Process paragraphs one page at a time, in page order, until none are
+    left or ``stop_event`` is set.
+
+    Consecutive prompts then share the page's context and the rows read sit
+    next to each other. Committing a paragraph releases the page's row locks,
+    so the rest of the page is claimed again right away; a paragraph another
+    worker took in between is skipped. Failed paragraphs are left unprocessed.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("paragraphs_processed", 0)
+    stats.setdefault("paragraphs_failed", 0)
+    failed_ids = set()
+    while stop_event is None or not stop_event.is_set():
+        async with async_session() as db:
+            paragraphs = await claim_page_paragraphs(db, exclude_ids=failed_ids)
+            if not paragraphs:
+                logging.info(
+                    "All paragraphs have been processed. Stopping the process."
+                )
+                break
+            page_name = paragraphs[0].page_name
+            logging.info(f"Processing page {page_name}")
+            while paragraphs:
+                if stop_event is not None and stop_event.is_set():
+                    logging.info("Stop requested. Not claiming more paragraphs.")
+                    break
+                paragraph_id = paragraphs[0].id
+                try:
+                    await process_paragraph_e2e_with_retry(db, paragraphs[0], stats)
+                    stats["paragraphs_processed"] += 1
+                except Exception as e:
+                    failed_ids.add(paragraph_id)
+                    stats["paragraphs_failed"] += 1
+                    logging.error(f"Error processing paragraph {paragraph_id}: {e}")
+                paragraphs = await claim_page_paragraphs(
+                    db, page_name, exclude_ids=failed_ids
+                )
+
+
+async def process_shard_e2e(
+    shards: ShardTable, index: int, batch_size=5, stop_event=None, stats=None
+):
+    """Process the paragraphs of one shard in id order, with no claim queries.
+
+    Once the shard is done, the worker takes over half of the largest shard
+    left, until none is worth splitting. Failed paragraphs are left
+    unprocessed for a later run.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("paragraphs_processed", 0)
+    stats.setdefault("paragraphs_failed", 0)
+    shards.restart(index)
+    while stop_event is None or not stop_event.is_set():
+        try:
+            async with async_session() as db:
+                result = await db.execute(shard_query(shards.get(index), batch_size))
+                paragraph_ids = result.scalars().all()
+        except Exception as e:
+            logging.error(f"Error reading shard {index}: {str(e)}")
+            await asyncio.sleep(randwait(WAIT))
+            continue
+        if not paragraph_ids:
+            if shards.steal(index):
+                continue
+            logging.info(f"Shard {index} has no paragraphs left. Stopping.")
+            break
+        for paragraph_id in paragraph_ids:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if not shards.advance(index, paragraph_id):
+                break  # the rest of the batch was handed to another shard
+            async with async_session() as db:
+                try:
+                    paragraph = await db.get(Paragraph, paragraph_id)
+                    await process_paragraph_e2e_with_retry(db, paragraph, stats)
+                    stats["paragraphs_processed"] += 1
+                except Exception as e:
+                    stats["paragraphs_failed"] += 1
+                    logging.error(f"Error processing paragraph {paragraph_id}: {e}")
+
+
+async def start_background_process_e2e(
+    stop_event=None, stats=None, shards=None, index=0
+):
     try:
-        await process_all_pages_e2e_parallel(1)
+        if shards is not None:
+            await process_shard_e2e(shards, index, stop_event=stop_event, stats=stats)
+        elif E2E_SCHEDULING == "page":
+            await process_pages_e2e(stop_event=stop_event, stats=stats)
+        else:
+            await process_all_pages_e2e_parallel(1, stop_event=stop_event, stats=stats)
     except Exception as e:
         logging.error("Error in background process:")
         logging.error(str(e))
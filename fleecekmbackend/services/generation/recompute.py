@@ -0,0 +1,252 @@
+import asyncio
+import logging
+
+from sqlalchemy import func, select, update
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.db.counters import increment_counters
+from fleecekmbackend.db.ctl import async_session
+from fleecekmbackend.db.helpers import add_idempotent, create_author_if_not_exists
+from fleecekmbackend.db.models import Answer, Author, Rating
+from fleecekmbackend.services.dataset.answers import (
+    answer_author_prompt,
+    generate_answer,
+    load_existing_answers,
+)
+from fleecekmbackend.services.dataset.common import (
+    load_answer_contexts,
+    load_question_contexts,
+)
+from fleecekmbackend.services.dataset.ratings import (
+    generate_answer_rating,
+    load_existing_ratings,
+    rating_author_prompt,
+)
+from fleecekmbackend.core.config import LOGGING_LEVEL, MODEL, RECOMPUTE_BATCH_SIZE
+
+logging.basicConfig(
+    level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+# author kind -> (model of the rows it writes, prompt of the current author)
+RECOMPUTABLE = {
+    "answer": (Answer, answer_author_prompt),
+    "rating": (Rating, rating_author_prompt),
+}
+# LLM calls to regenerate one row: a new answer is rated as well
+CALLS_PER_ROW = {"answer": 2, "rating": 1}
+
+
+async def find_superseded_authors(
+    db: AsyncSession,
+    kind: str,
+    model: str = MODEL,
+    from_model: str = None,
+    include_done: bool = False,
+):
+    """Authors of ``kind`` whose rows the current template and ``model`` would
+    not have written.
+
+    Without ``from_model`` these are the authors of ``model`` with another
+    prompt, i.e. older templates. With it, every author of ``from_model``.
+    Authors whose rows were all recomputed already are left out unless
+    ``include_done``.
+    """
+    current_hash = Author.generate_hash(model, RECOMPUTABLE[kind][1]())
+    query = select(Author).where(
+        Author.kind == kind,
+        Author.hash != current_hash,
+        Author.model == (from_model or model),
+    )
+    if not include_done:
+        query = query.where(Author.superseded_by.is_(None))
+    result = await db.execute(query.order_by(Author.id))
+    return result.scalars().all()
+
+
+async def count_rows_by_author(db: AsyncSession, kind: str, author_ids):
+    row_model = RECOMPUTABLE[kind][0]
+    if not author_ids:
+        return {}
+    result = await db.execute(
+        select(row_model.author_id, func.count(row_model.id))
+        .where(row_model.author_id.in_(author_ids))
+        .group_by(row_model.author_id)
+    )
+    return dict(result.all())
+
+
+async def _regenerate_answer(row, context, model, service):
+    """A new answer to the old one's question and setting, rated by the
+    current rating author. Either may come back from an earlier run."""
+    if context is None:
+        return None
+    answer = await generate_answer(
+        None,
+        row.question_id,
+        row.setting,
+        model=model,
+        service=service,
+        flush=False,
+        context=context,
+    )
+    if answer is None:
+        return None
+    # a new answer has no rating to look up
+    existing = {} if sa_inspect(answer).transient else None
+    rating = await generate_answer_rating(
+        None, answer.id, flush=False, context=context.for_answer(answer, existing)
+    )
+    return [answer, rating] if rating is not None else [answer]
+
+
+async def _regenerate_rating(row, context, model, service):
+    if context is None:
+        return None
+    rating = await generate_answer_rating(
+        None, row.answer_id, model=model, service=service, flush=False, context=context
+    )
+    return [rating] if rating is not None else None
+
+
+async def _read_batch(
+    kind: str, author_id: int, last_id: int, batch_size: int, targets
+):
+    async with async_session() as db:
+        if kind == "answer":
+            result = await db.execute(
+                select(Answer.id, Answer.question_id, Answer.setting)
+                .where(Answer.author_id == author_id, Answer.id > last_id)
+                .order_by(Answer.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            contexts = await load_existing_answers(
+                await load_question_contexts(db, [row.question_id for row in rows]),
+                targets,
+            )
+            return rows, [contexts.get(row.question_id) for row in rows]
+        result = await db.execute(
+            select(Rating.id, Rating.answer_id)
+            .where(Rating.author_id == author_id, Rating.id > last_id)
+            .order_by(Rating.id)
+            .limit(batch_size)
+        )
+        rows = result.all()
+        contexts = await load_existing_ratings(
+            await load_answer_contexts(db, [row.answer_id for row in rows]), targets
+        )
+        return rows, [contexts.get(row.answer_id) for row in rows]
+
+
+async def _write_batch(objects):
+    """Insert the new rows and flag the new answers that were rated."""
+    rated_answer_ids = [obj.answer_id for obj in objects if isinstance(obj, Rating)]
+    async with async_session() as db:
+        try:
+            await add_idempotent(
+                db, [obj for obj in objects if sa_inspect(obj).transient]
+            )
+            if rated_answer_ids:
+                result = await db.execute(
+                    update(Answer)
+                    .where(Answer.id.in_(rated_answer_ids), Answer.processed == False)
+                    .values(processed=True)
+                    .execution_options(synchronize_session=False)
+                )
+                await increment_counters(db, {"answer_processed": result.rowcount})
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logging.error(f"Error writing recomputed rows: {str(e)}")
+            raise
+
+
+async def recompute_author(
+    kind: str,
+    author_id: int,
+    model: str = MODEL,
+    service: str = "gpublaze",
+    batch_size: int = RECOMPUTE_BATCH_SIZE,
+    stats=None,
+    stop_event=None,
+):
+    """Regenerate every row the author wrote with the current template and
+    ``model``, ``batch_size`` rows at a time, in id order.
+
+    The old rows are kept. New rows are keyed like any other, so rows an
+    earlier, interrupted recompute already wrote are found instead of
+    regenerated. Once all rows are done, the author is marked superseded by
+    the current one. Returns False if any row failed.
+    """
+    regenerate = _regenerate_answer if kind == "answer" else _regenerate_rating
+    stats = stats if stats is not None else {}
+    for key in ("rows", "regenerated", "reused", "failed"):
+        stats.setdefault(key, 0)
+    failed = 0
+    last_id = -1
+    while True:
+        if stop_event is not None and stop_event.is_set():
+            logging.info(f"Stop requested. Author {author_id} is left part way.")
+            return False
+        rows, contexts = await _read_batch(
+            kind, author_id, last_id, batch_size, [(service, model)]
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        results = await asyncio.gather(
+            *[
+                regenerate(row, context, model, service)
+                for row, context in zip(rows, contexts)
+            ]
+        )
+        objects = [obj for result in results if result for obj in result]
+        regenerated = sum(sa_inspect(obj).transient for obj in objects)
+        await _write_batch(objects)
+        batch_failed = sum(result is None for result in results)
+        failed += batch_failed
+        stats["rows"] += len(rows)
+        stats["failed"] += batch_failed
+        stats["regenerated"] += regenerated
+        stats["reused"] += len(objects) - regenerated
+        logging.info(f"Recomputing {kind}s of author {author_id}: {stats}")
+
+    if failed:
+        logging.warning(
+            f"{failed} {kind}s of author {author_id} failed; run again to retry them"
+        )
+        return False
+    current_id = await create_author_if_not_exists(RECOMPUTABLE[kind][1](), model, kind)
+    async with async_session() as db:
+        await db.execute(
+            update(Author)
+            .where(Author.id == author_id)
+            .values(superseded_by=current_id)
+        )
+        await db.commit()
+    logging.info(f"Author {author_id} is superseded by author {current_id}")
+    return True
+
+
+async def recompute(
+    kind: str,
+    author_ids,
+    model: str = MODEL,
+    service: str = "gpublaze",
+    batch_size: int = RECOMPUTE_BATCH_SIZE,
+    stop_event=None,
+):
+    """Recompute the rows of several superseded authors; returns the stats of
+    each."""
+    if kind not in RECOMPUTABLE:
+        raise ValueError(f"kind must be one of {tuple(RECOMPUTABLE)}")
+    results = {}
+    for author_id in author_ids:
+        stats = {}
+        stats["done"] = await recompute_author(
+            kind, author_id, model, service, batch_size, stats, stop_event
+        )
+        results[author_id] = stats
+    return results
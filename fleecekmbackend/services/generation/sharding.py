@@ -0,0 +1,121 @@
+import logging
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fleecekmbackend.db.deadletter import not_dead_lettered
+from fleecekmbackend.db.models import Paragraph
+from fleecekmbackend.core.config import SHARD_MIN_SPLIT
+
+SHARD_MODES = ("modulo", "range")
+
+# per-shard slots in the shared array
+_MODULUS, _REMAINDER, _LO, _HI, _CURSOR = range(5)
+_FIELDS = 5
+
+
+def plan_shards(num_shards: int, mode: str, min_id: int, max_id: int):
+    """Split paragraph ids [min_id, max_id] into (modulus, remainder, lo, hi)
+    shards; a shard owns the ids in [lo, hi) with id % modulus == remainder."""
+    if mode not in SHARD_MODES:
+        raise ValueError(f"mode must be one of {SHARD_MODES}")
+    if mode == "modulo":
+        return [(num_shards, i, min_id, max_id + 1) for i in range(num_shards)]
+    span = max_id + 1 - min_id
+    bounds = [min_id + span * i // num_shards for i in range(num_shards + 1)]
+    return [(1, 0, bounds[i], bounds[i + 1]) for i in range(num_shards)]
+
+
+async def get_unprocessed_id_bounds(db: AsyncSession):
+    result = await db.execute(
+        select(func.min(Paragraph.id), func.max(Paragraph.id)).where(
+            Paragraph.processed == False, not_dead_lettered(Paragraph)
+        )
+    )
+    return result.one()
+
+
+class ShardTable:
+    """Shard assignments shared by the supervisor and its worker processes.
+
+    Workers walk their shard in id order with no claim queries, since no two
+    shards overlap. A worker whose shard runs dry splits the largest remaining
+    shard at the midpoint of what its owner has not reached yet, and takes the
+    upper half. The owner notices its new bound on its next ``advance``; both
+    happen under one lock, so an id is never handed out twice.
+    """
+
+    def __init__(self, context, shards):
+        self._array = context.Array("q", len(shards) * _FIELDS)
+        for index, (modulus, remainder, lo, hi) in enumerate(shards):
+            self._set(index, modulus, remainder, lo, hi, lo - 1)
+
+    def __len__(self):
+        return len(self._array) // _FIELDS
+
+    def _get(self, index):
+        offset = index * _FIELDS
+        return list(self._array[offset : offset + _FIELDS])
+
+    def _set(self, index, *values):
+        offset = index * _FIELDS
+        self._array[offset : offset + _FIELDS] = list(values)
+
+    def get(self, index):
+        with self._array.get_lock():
+            return self._get(index)
+
+    def restart(self, index):
+        """Rewind a restarted worker's cursor; processed rows are skipped anyway
+        and the paragraph it crashed on is retried."""
+        with self._array.get_lock():
+            modulus, remainder, lo, hi, _ = self._get(index)
+            self._set(index, modulus, remainder, lo, hi, lo - 1)
+
+    def advance(self, index, paragraph_id):
+        """Move the cursor to ``paragraph_id`` if it is still in the shard."""
+        with self._array.get_lock():
+            shard = self._get(index)
+            if paragraph_id >= shard[_HI]:
+                return False
+            shard[_CURSOR] = paragraph_id
+            self._set(index, *shard)
+            return True
+
+    def steal(self, index, min_split: int = SHARD_MIN_SPLIT):
+        """Give shard ``index`` the upper half of the largest remaining shard."""
+        with self._array.get_lock():
+            victim, remaining = None, 0
+            for other in range(len(self)):
+                if other == index:
+                    continue
+                modulus, _, _, hi, cursor = self._get(other)
+                other_remaining = (hi - cursor - 1) // modulus
+                if other_remaining > remaining:
+                    victim, remaining = other, other_remaining
+            if victim is None or remaining < min_split:
+                return False
+            modulus, remainder, lo, hi, cursor = self._get(victim)
+            mid = cursor + 1 + (hi - cursor - 1) // 2
+            self._set(victim, modulus, remainder, lo, mid, cursor)
+            self._set(index, modulus, remainder, mid, hi, mid - 1)
+        logging.info(
+            f"Shard {index} took ids [{mid}, {hi}) (mod {modulus} = {remainder}) "
+            f"from shard {victim}"
+        )
+        return True
+
+
+def shard_query(shard, batch_size: int):
+    """Ids of the next unprocessed paragraphs of a shard after its cursor,
+    read without locks."""
+    modulus, remainder, lo, hi, cursor = shard
+    query = select(Paragraph.id).where(
+        Paragraph.processed == False,
+        not_dead_lettered(Paragraph),
+        Paragraph.id > max(cursor, lo - 1),
+        Paragraph.id < hi,
+    )
+    if modulus > 1:
+        query = query.where(Paragraph.id % modulus == remainder)
+    return query.order_by(Paragraph.id).limit(batch_size)
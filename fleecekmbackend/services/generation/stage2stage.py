@@ -9,7 +9,10 @@ from collections import deque
 from contextlib import asynccontextmanager
 
 from fleecekmbackend.db.ctl import async_session, create_tables_if_not_exist
+from fleecekmbackend.db.migrations import add_missing_columns
+from fleecekmbackend.db.counters import ensure_counters
 from fleecekmbackend.db.helpers import (
+    add_idempotent,
     get_next_unfiltered_questions,
     get_next_unprocessed_paragraphs,
     get_next_unprocessed_questions,
@@ -22,14 +25,37 @@ from fleecekmbackend.db.helpers import (
     load_csv_data_rand_n,
     load_csv_data_top_n,
 )
+from fleecekmbackend.db.writer import BulkWriter
 from fleecekmbackend.db.models import Paragraph, Question, Answer, Rating
 from fleecekmbackend.services.dataset.questions import (
     filter_questions,
     generate_questions_single_turn,
 )
-from fleecekmbackend.services.dataset.answers import generate_answer
-from fleecekmbackend.services.dataset.ratings import generate_answer_rating
-from fleecekmbackend.core.config import DATASET_PATH, LOGGING_LEVEL
+from fleecekmbackend.services.dataset.common import (
+    AnswerContext,
+    QuestionContext,
+    load_answer_contexts,
+    load_question_contexts,
+)
+from fleecekmbackend.services.dataset.answers import (
+    generate_answer,
+    load_existing_answers,
+)
+from fleecekmbackend.services.dataset.ratings import (
+    generate_answer_rating,
+    load_existing_ratings,
+)
+from fleecekmbackend.services.generation.autoscale import (
+    ConsumerPool,
+    log_utilization_report,
+)
+from fleecekmbackend.core.config import (
+    ANSWER_TARGETS,
+    DATASET_PATH,
+    LOGGING_LEVEL,
+    RATING_TARGETS,
+    STAGE_CONSUMER_BOUNDS,
+)
 
 logging.basicConfig(
     level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -58,32 +84,90 @@ async def filter_questions_stage(questions: List[Question]) -> List[Question]:
             raise
 
 
-async def generate_answers_stage(question: Question) -> List[Answer]:
-    objects2update = []
-    async with async_session() as db:
-        try:
-            for setting in ["zs", "ic"]:
-                answer = await generate_answer(db, question.id, setting, flush=False)
-                objects2update.append(answer)
+async def load_answering_contexts(db: AsyncSession, question_ids: List[int]):
+    """load_question_contexts, with the batch's stored answers looked up."""
+    return await load_existing_answers(await load_question_contexts(db, question_ids))
+
+
+async def load_rating_contexts(db: AsyncSession, answer_ids: List[int]):
+    """load_answer_contexts, with the batch's stored ratings looked up."""
+    return await load_existing_ratings(await load_answer_contexts(db, answer_ids))
+
+
+async def generate_answers_stage(
+    question: Question, context: QuestionContext = None, targets=None
+) -> List[Answer]:
+    """Answer the question in both settings with every (service, model) in
+    ``targets`` (ANSWER_TARGETS by default), all at once; each target waits
+    for its own rate limit. The context is loaded once for all of them.
+    Returns the answers, None for failed ones, followed by the question.
+
+    The question is marked processed only if every answer succeeded. Otherwise
+    it stays unprocessed, and a retry finds the answers that did succeed by
+    their dedup keys once the caller has stored them."""
+    targets = targets or ANSWER_TARGETS
+    try:
+        if context is None:
+            async with async_session() as db:
+                contexts = await load_answering_contexts(db, [question.id])
+            context = contexts[question.id]
+        answers = await asyncio.gather(
+            *[
+                generate_answer(
+                    None,
+                    question.id,
+                    setting,
+                    model=model,
+                    service=service,
+                    flush=False,
+                    context=context,
+                )
+                for service, model in targets
+                for setting in ["zs", "ic"]
+            ]
+        )
+        if all(answer is not None for answer in answers):
             question.processed = True
-            objects2update.append(question)
-            return objects2update
-        except Exception as e:
-            logging.error(f"Error generating answers for question: {question.id}")
-            logging.error(str(e))
-            raise
+        return list(answers) + [question]
+    except Exception as e:
+        logging.error(f"Error generating answers for question: {question.id}")
+        logging.error(str(e))
+        raise
 
 
-async def generate_ratings_stage(answer: Answer) -> Rating:
-    async with async_session() as db:
-        try:
-            rating = await generate_answer_rating(db, answer.id, flush=False)
+async def generate_ratings_stage(
+    answer: Answer, context: AnswerContext = None, judges=None
+) -> List[Rating]:
+    """Rate the answer with every (service, model) in ``judges``
+    (RATING_TARGETS by default), all at once. Returns the ratings, None for
+    failed ones, followed by the answer, which is marked processed only if
+    every judge succeeded (see generate_answers_stage)."""
+    judges = judges or RATING_TARGETS
+    try:
+        if context is None:
+            async with async_session() as db:
+                contexts = await load_rating_contexts(db, [answer.id])
+            context = contexts[answer.id]
+        ratings = await asyncio.gather(
+            *[
+                generate_answer_rating(
+                    None,
+                    answer.id,
+                    model=model,
+                    service=service,
+                    flush=False,
+                    context=context,
+                )
+                for service, model in judges
+            ]
+        )
+        if all(rating is not None for rating in ratings):
             answer.processed = True
-            return [rating, answer]
-        except Exception as e:
-            logging.error(f"Error generating rating for answer: {answer.id}")
-            logging.error(str(e))
-            raise
+        return list(ratings) + [answer]
+    except Exception as e:
+        logging.error(f"Error generating rating for answer: {answer.id}")
+        logging.error(str(e))
+        raise
 
 
 async def process_all_paragraphs_s2s(batch_size=5):
@@ -139,21 +223,45 @@ async def process_all_paragraphs_s2s(batch_size=5):
     logging.info("Starting stage 3: Generate Answers")
     stage_3_start_time = time.time()
     total_questions = await get_unprocessed_questions_count()
+    skipped = set()  # left unprocessed, so they must not be claimed again this run
     with tqdm(total=total_questions, desc="Stage 3: Generate Answers") as pbar:
         while True:
             async with async_session() as db:
-                questions = await get_next_unprocessed_questions(db, batch_size)
+                questions = await get_next_unprocessed_questions(
+                    db, batch_size, exclude_ids=skipped
+                )
                 if not questions:
                     logging.info(
                         "No unprocessed questions found. Moving to next stage."
                     )
                     break
+                contexts = await load_answering_contexts(
+                    db, [question.id for question in questions]
+                )
+                missing = [q.id for q in questions if q.id not in contexts]
+                if missing:
+                    # the join drops questions whose paragraph is gone
+                    logging.error(f"No paragraph for questions {missing}, skipping")
+                    skipped.update(missing)
                 all_answers = await tqdm_asyncio.gather(
-                    *[generate_answers_stage(question) for question in questions],
+                    *[
+                        generate_answers_stage(question, contexts[question.id])
+                        for question in questions
+                        if question.id in contexts
+                    ],
                     desc="Processing questions",
                 )
-                all_answers = [a for answers in all_answers for a in answers]
-                db.add_all(all_answers)
+                # failed answers come back as None, already logged; the others
+                # are stored, and their question is left for the next run
+                skipped.update(
+                    answers[-1].id
+                    for answers in all_answers
+                    if not answers[-1].processed
+                )
+                all_answers = [
+                    a for answers in all_answers for a in answers if a is not None
+                ]
+                await add_idempotent(db, all_answers)
                 await db.flush()
                 await db.commit()
                 pbar.update(len(questions))
@@ -163,19 +271,42 @@ async def process_all_paragraphs_s2s(batch_size=5):
     logging.info("Starting stage 4: Generate Ratings")
     stage_4_start_time = time.time()
     total_answers = await get_unprocessed_answers_count()
+    skipped = set()
     with tqdm(total=total_answers, desc="Stage 4: Generate Ratings") as pbar:
         while True:
             async with async_session() as db:
-                answers = await get_next_unprocessed_answers(db, batch_size)
+                answers = await get_next_unprocessed_answers(
+                    db, batch_size, exclude_ids=skipped
+                )
                 if not answers:
                     logging.info("No unprocessed answers found. Finishing process.")
                     break
+                contexts = await load_rating_contexts(
+                    db, [answer.id for answer in answers]
+                )
+                missing = [a.id for a in answers if a.id not in contexts]
+                if missing:
+                    logging.error(
+                        f"No question or paragraph for answers {missing}, skipping"
+                    )
+                    skipped.update(missing)
                 all_ratings = await tqdm_asyncio.gather(
-                    *[generate_ratings_stage(answer) for answer in answers],
+                    *[
+                        generate_ratings_stage(answer, contexts[answer.id])
+                        for answer in answers
+                        if answer.id in contexts
+                    ],
                     desc="Processing answers",
                 )
-                all_ratings = [r for ratings in all_ratings for r in ratings]
-                db.add_all(all_ratings)
+                skipped.update(
+                    ratings[-1].id
+                    for ratings in all_ratings
+                    if not ratings[-1].processed
+                )
+                all_ratings = [
+                    r for ratings in all_ratings for r in ratings if r is not None
+                ]
+                await add_idempotent(db, all_ratings)
                 await db.flush()
                 await db.commit()
                 pbar.update(len(answers))
@@ -191,29 +322,52 @@ async def process_all_paragraphs_s2s(batch_size=5):
     return times
 
 
-async def process_all_paragraphs_s2s_optimized(batch_size=5):
-    async def producer(queue, get_items_func):
+async def process_all_paragraphs_s2s_optimized(batch_size=5, consumer_bounds=None):
+    writer = await BulkWriter().start()
+    consumer_bounds = {**STAGE_CONSUMER_BOUNDS, **(consumer_bounds or {})}
+
+    async def producer(
+        queue, get_items_func, load_contexts_func, failed, max_in_flight
+    ):
+        # items stay unprocessed in the db until the writer commits them, so
+        # skip the ones already handed out instead of claiming them again
+        in_flight = set()
         while True:
             async with async_session() as db:
-                items = await get_items_func(db, batch_size)
-                if not items:
-                    break
+                items = await get_items_func(
+                    db, batch_size, exclude_ids=in_flight | failed
+                )
+                contexts = {}
+                if items and load_contexts_func is not None:
+                    contexts = await load_contexts_func(db, [i.id for i in items])
                 for item in items:
-                    await queue.put(item)
+                    in_flight.add(item.id)
+                    await queue.put((item, contexts.get(item.id)))
+            if not items and not in_flight:
+                break
+            if not items or len(in_flight) >= max_in_flight:
+                await queue.join()
+                await writer.drain()
+                in_flight.clear()
             await asyncio.sleep(0)  # Allow other coroutines to run
-        # Signal end of production
-        await queue.put(None)
 
-    async def consumer(queue, process_func, commit_func):
-        while True:
-            item = await queue.get()
-            if item is None:
-                queue.task_done()
-                break
-            result = await process_func(item)
-            async with async_session() as db:
-                await commit_func(db, result)
-            queue.task_done()
+    def make_consumer(process_func, commit_func, failed):
+        async def consume(entry):
+            item, context = entry
+            try:
+                if context is None:
+                    result = await process_func(item)
+                else:
+                    result = await process_func(item, context)
+                await commit_func(result)
+                if isinstance(result, list) and any(r is None for r in result):
+                    # what succeeded is written, the item stays unprocessed
+                    # for the next run to finish
+                    failed.add(item.id)
+            except Exception:
+                failed.add(item.id)  # already logged by the stage
+
+        return consume
 
     @asynccontextmanager
     async def stage_context(name):
@@ -226,45 +380,79 @@ async def process_all_paragraphs_s2s_optimized(batch_size=5):
             logging.info(f"{name} completed in {end_time - start_time:.2f} seconds")
 
     async def run_stage(
-        name, get_items_func, process_func, commit_func, num_consumers=3
+        name,
+        bounds_key,
+        get_items_func,
+        process_func,
+        load_contexts_func,
+        commit_func,
     ):
-        queue = asyncio.Queue(maxsize=batch_size * 2)
+        min_consumers, max_consumers = consumer_bounds[bounds_key]
+        # room for every consumer to have an item queued and one in hand
+        queue = asyncio.Queue(maxsize=max(batch_size * 2, max_consumers))
+        max_in_flight = max(batch_size * 4, max_consumers * 2)
+        failed = set()
         async with stage_context(name):
-            producer_task = asyncio.create_task(producer(queue, get_items_func))
-            consumer_tasks = [
-                asyncio.create_task(consumer(queue, process_func, commit_func))
-                for _ in range(num_consumers)
-            ]
-
-            await producer_task
-            await queue.join()
-            for _ in range(num_consumers):
-                await queue.put(None)
-            await asyncio.gather(*consumer_tasks)
-
-    async def commit_results(db, results):
+            pool = ConsumerPool(
+                name,
+                queue,
+                make_consumer(process_func, commit_func, failed),
+                min_consumers,
+                max_consumers,
+            ).start()
+            await producer(
+                queue, get_items_func, load_contexts_func, failed, max_in_flight
+            )
+            await pool.close()
+        return pool
+
+    async def commit_results(results):
         if isinstance(results, list):
-            db.add_all(results)
+            await writer.add_all([r for r in results if r is not None])
         else:
-            db.add(results)
-        await db.flush()
-        await db.commit()
+            await writer.add(results)
 
     stages = [
         (
             "Generate Questions",
+            "questions",
             get_next_unprocessed_paragraphs,
             generate_questions_stage,
+            None,
+        ),
+        (
+            "Filter Questions",
+            "filter",
+            get_next_unfiltered_questions,
+            lambda question: filter_questions_stage([question]),
+            None,
+        ),
+        (
+            "Generate Answers",
+            "answers",
+            get_next_unprocessed_questions,
+            generate_answers_stage,
+            load_answering_contexts,
+        ),
+        (
+            "Generate Ratings",
+            "ratings",
+            get_next_unprocessed_answers,
+            generate_ratings_stage,
+            load_rating_contexts,
         ),
-        ("Filter Questions", get_next_unfiltered_questions, filter_questions_stage),
-        ("Generate Answers", get_next_unprocessed_questions, generate_answers_stage),
-        ("Generate Ratings", get_next_unprocessed_answers, generate_ratings_stage),
     ]
 
-    for name, get_items_func, process_func in stages:
-        await run_stage(name, get_items_func, process_func, commit_results)
+    pools = []
+    for stage in stages:
+        pools.append(await run_stage(*stage, commit_results))
+        # the next stage claims what this one wrote, so it must be committed
+        await writer.drain()
+    await writer.close()
 
     logging.info("All stages completed")
+    log_utilization_report(pools)
+    return {pool.name: pool.report() for pool in pools}
 
 
 async def start_background_process_s2s(batch_size=128):
@@ -277,9 +465,11 @@ async def start_background_process_s2s(batch_size=128):
 
 async def main():
     await create_tables_if_not_exist()
+    await add_missing_columns()
 
     with open(DATASET_PATH, "r") as file:
         await load_csv_data_all(file)
+    await ensure_counters()
 
     await start_background_process_s2s(128)
 
@@ -0,0 +1,363 @@
+import asyncio
+import logging
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy import inspect as sa_inspect
+
+from fleecekmbackend.core.utils.llm import track_prompts
+from fleecekmbackend.db.ctl import async_session, create_tables_if_not_exist
+from fleecekmbackend.db.deadletter import not_dead_lettered, record_failure
+from fleecekmbackend.db.migrations import add_missing_columns
+from fleecekmbackend.db.counters import ensure_counters
+from fleecekmbackend.db.helpers import load_csv_data_all, row_from_object
+from fleecekmbackend.db.writer import BulkWriter
+from fleecekmbackend.db.models import Paragraph, Question, Answer
+from fleecekmbackend.services.dataset.questions import generate_questions_single_turn
+from fleecekmbackend.services.dataset.common import (
+    QuestionContext,
+    generate_fact_with_context,
+)
+from fleecekmbackend.core.metrics import PIPELINE_FAILURES
+from fleecekmbackend.services.generation.autoscale import (
+    ConsumerPool,
+    log_utilization_report,
+)
+from fleecekmbackend.services.generation.stage2stage import (
+    filter_questions_stage,
+    generate_answers_stage,
+    generate_ratings_stage,
+    load_answering_contexts,
+    load_rating_contexts,
+)
+from fleecekmbackend.core.config import (
+    DATASET_PATH,
+    LOGGING_LEVEL,
+    STREAM_QUEUE_SIZE,
+    STREAM_REPORT_INTERVAL,
+    STREAM_SEED_BATCH,
+    STAGE_CONSUMER_BOUNDS,
+)
+
+logging.basicConfig(
+    level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+
+class StreamStage:
+    """One step of the streaming pipeline: a bounded input queue drained by an
+    autoscaling consumer pool, each consumer passing its outputs to the next
+    stage.
+
+    A stage closes once every producer feeding it (the upstream stage and the
+    seeder that resumes leftovers from the db) has called ``producer_done``.
+    """
+
+    def __init__(
+        self,
+        name,
+        process,
+        min_workers,
+        max_workers,
+        queue_size=STREAM_QUEUE_SIZE,
+        stats=None,
+    ):
+        self.name = name
+        self.process = process
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.pool = ConsumerPool(
+            name, self.queue, self._consume, min_workers, max_workers
+        )
+        self.downstream = None
+        self._producers = 0
+        self._closed = asyncio.Event()
+        self.processed = 0
+        self.failed = 0
+        self._stats = stats if stats is not None else {}
+        self._stats.setdefault(f"{name}_processed", 0)
+        self._stats.setdefault(f"{name}_failed", 0)
+
+    def add_producer(self):
+        self._producers += 1
+
+    async def producer_done(self):
+        self._producers -= 1
+        if self._producers == 0:
+            self._closed.set()
+
+    async def put(self, item, context=None):
+        await self.queue.put((item, context))
+
+    async def _consume(self, entry):
+        item, context = entry
+        prompts = track_prompts()
+        try:
+            outputs = await self.process(item, context)
+        except Exception as e:
+            # the item keeps its unprocessed flag and is retried next run,
+            # until it has failed often enough to be dead-lettered
+            self.failed += 1
+            self._stats[f"{self.name}_failed"] += 1
+            PIPELINE_FAILURES.inc(stage=self.name)
+            logging.error(f"{self.name} failed for item {item.id}: {str(e)}")
+            await record_failure(
+                type(item), item.id, e, self.name, prompts.get("prompt")
+            )
+            return
+        self.processed += 1
+        self._stats[f"{self.name}_processed"] += 1
+        if self.downstream is not None:
+            for output, output_context in outputs:
+                await self.downstream.put(output, output_context)
+
+    async def run(self):
+        self.pool.start()
+        try:
+            await self._closed.wait()
+            await self.pool.close()
+        finally:
+            if self.downstream is not None:
+                await self.downstream.producer_done()
+
+    def stats(self):
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "queued": self.queue.qsize(),
+            "consumers": self.pool.size,
+            **self.pool.report(),
+        }
+
+
+async def _seed(
+    stage, model, conditions, load_contexts_func, skip_ids, batch_size, stop_event
+):
+    """Feed a stage the rows a previous run left between stages, by keyset.
+
+    Rows are read, not claimed, so only one streaming process may run against a
+    database at a time; a second one would seed and regenerate the same rows.
+    """
+    last_id = -1
+    try:
+        while stop_event is None or not stop_event.is_set():
+            async with async_session() as db:
+                result = await db.execute(
+                    select(model)
+                    .where(model.id > last_id, *conditions)
+                    .order_by(model.id)
+                    .limit(batch_size)
+                )
+                items = result.scalars().all()
+                if not items:
+                    break
+                last_id = items[-1].id
+                items = [item for item in items if item.id not in skip_ids]
+                contexts = {}
+                if items and load_contexts_func is not None:
+                    contexts = await load_contexts_func(db, [i.id for i in items])
+            for item in items:
+                await stage.put(item, contexts.get(item.id))
+    except Exception as e:
+        logging.error(f"Error seeding {stage.name}: {str(e)}")
+    finally:
+        await stage.producer_done()
+
+
+async def process_all_paragraphs_streaming(
+    seed_batch_size=STREAM_SEED_BATCH,
+    consumer_bounds=None,
+    queue_size=STREAM_QUEUE_SIZE,
+    stop_event=None,
+    stats=None,
+):
+    """Run all four stages at once; an item moves on as soon as it is done.
+
+    Stage outputs are handed to a BulkWriter as plain rows and flag updates, and
+    the objects themselves travel to the next stage in memory, so no stage waits
+    for a commit. On start, rows that an earlier run left part way are seeded
+    from the processed/filtered flags; rows this run creates are never seeded.
+
+    Single-process only: seeding does not claim rows (see ``_seed``).
+
+    Setting ``stop_event`` stops the seeders; whatever is already in the
+    pipeline is carried through every stage and committed before returning.
+    ``stats`` is kept updated with per-stage processed/failed counts.
+    """
+    stats = stats if stats is not None else {}
+    consumer_bounds = {**STAGE_CONSUMER_BOUNDS, **(consumer_bounds or {})}
+    writer = await BulkWriter().start()
+    # ids created by this run, in case the id allocator hands out ids below the
+    # snapshot taken for seeding
+    new_question_ids, new_answer_ids = set(), set()
+
+    async def generate_questions(paragraph, _):
+        questions = await generate_questions_single_turn(paragraph)
+        for question in questions:
+            new_question_ids.add(question.id)
+            await writer.insert(Question, row_from_object(question))
+        await writer.update(Paragraph, {"id": paragraph.id, "processed": True})
+        _, fact = generate_fact_with_context(paragraph)
+        # new questions have no answers to look up
+        return [
+            (q, QuestionContext(q, paragraph, fact, existing={})) for q in questions
+        ]
+
+    async def filter_question(question, context):
+        await filter_questions_stage([question])
+        row = {"id": question.id, "filtered": True, "rejected": bool(question.rejected)}
+        if question.rejected:
+            row["is_answerable_ic"] = question.is_answerable_ic
+            row["is_answerable_zs"] = question.is_answerable_zs
+        await writer.update(Question, row)
+        return [(question, context)]
+
+    async def generate_answers(question, context):
+        if context is None:
+            async with async_session() as db:
+                contexts = await load_answering_contexts(db, [question.id])
+            context = contexts[question.id]
+        answers = (await generate_answers_stage(question, context))[:-1]
+        done = [answer for answer in answers if answer is not None]
+        # answers that succeeded are kept, so the retry finds them by key
+        for answer in done:
+            if sa_inspect(answer).transient:  # not an answer found from an earlier run
+                new_answer_ids.add(answer.id)
+                await writer.insert(Answer, row_from_object(answer))
+        if len(done) < len(answers):
+            # logged by generate_answer
+            raise Exception(f"{len(answers) - len(done)} answers failed")
+        await writer.update(Question, {"id": question.id, "processed": True})
+        # new answers have no ratings to look up either
+        return [
+            (a, context.for_answer(a, {} if a.id in new_answer_ids else None))
+            for a in answers
+        ]
+
+    async def generate_ratings(answer, context):
+        ratings = (await generate_ratings_stage(answer, context))[:-1]
+        done = [rating for rating in ratings if rating is not None]
+        for rating in done:
+            if sa_inspect(rating).transient:
+                await writer.insert(type(rating), row_from_object(rating))
+        if len(done) < len(ratings):
+            raise Exception(f"{len(ratings) - len(done)} ratings failed")
+        await writer.update(Answer, {"id": answer.id, "processed": True})
+        return []
+
+    stages = [
+        StreamStage(name, process, *consumer_bounds[name], queue_size, stats)
+        for name, process in [
+            ("questions", generate_questions),
+            ("filter", filter_question),
+            ("answers", generate_answers),
+            ("ratings", generate_ratings),
+        ]
+    ]
+    for stage, next_stage in zip(stages, stages[1:]):
+        stage.downstream = next_stage
+        next_stage.add_producer()
+
+    # rows created after this snapshot belong to this run and arrive in memory
+    async with async_session() as db:
+        max_question_id = (await db.execute(select(func.max(Question.id)))).scalar()
+        max_answer_id = (await db.execute(select(func.max(Answer.id)))).scalar()
+    seeds = [
+        (
+            stages[0],
+            Paragraph,
+            [Paragraph.processed == False, not_dead_lettered(Paragraph)],
+            None,
+            set(),
+        ),
+        (
+            stages[1],
+            Question,
+            [
+                Question.filtered == False,
+                Question.id <= (max_question_id or -1),
+                not_dead_lettered(Question),
+            ],
+            None,
+            new_question_ids,
+        ),
+        (
+            stages[2],
+            Question,
+            [
+                Question.filtered == True,
+                Question.processed == False,
+                Question.id <= (max_question_id or -1),
+                not_dead_lettered(Question),
+            ],
+            load_answering_contexts,
+            new_question_ids,
+        ),
+        (
+            stages[3],
+            Answer,
+            [
+                Answer.processed == False,
+                Answer.id <= (max_answer_id or -1),
+                not_dead_lettered(Answer),
+            ],
+            load_rating_contexts,
+            new_answer_ids,
+        ),
+    ]
+    for stage, *_ in seeds:
+        stage.add_producer()
+
+    def report():
+        logging.info(
+            "Streaming pipeline: "
+            + ", ".join(
+                f"{stage.name} {stage.processed} done/{stage.failed} failed/"
+                f"{stage.queue.qsize()} queued/{stage.pool.size} consumers"
+                for stage in stages
+            )
+        )
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(STREAM_REPORT_INTERVAL)
+            report()
+
+    start_time = time.time()
+    reporter_task = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(
+            *[stage.run() for stage in stages],
+            *[_seed(*seed, seed_batch_size, stop_event) for seed in seeds],
+        )
+    finally:
+        reporter_task.cancel()
+        await writer.close()
+    report()
+    log_utilization_report([stage.pool for stage in stages])
+    logging.info(
+        f"Streaming pipeline completed in {time.time() - start_time:.2f} seconds"
+    )
+    return {stage.name: stage.stats() for stage in stages}
+
+
+async def start_background_process_streaming(stop_event=None, stats=None):
+    try:
+        await process_all_paragraphs_streaming(stop_event=stop_event, stats=stats)
+    except Exception as e:
+        logging.error("Error in background process:")
+        logging.error(str(e))
+
+
+async def main():
+    await create_tables_if_not_exist()
+    await add_missing_columns()
+
+    with open(DATASET_PATH, "r") as file:
+        await load_csv_data_all(file)
+    await ensure_counters()
+
+    await start_background_process_streaming()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
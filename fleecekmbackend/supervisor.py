@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from fleecekmbackend.core.config import (
+    LOGGING_LEVEL,
+    SUPERVISOR_DRAIN_TIMEOUT,
+    SUPERVISOR_MAX_RESTARTS,
+    SUPERVISOR_METRICS_INTERVAL,
+    SUPERVISOR_RESTART_WINDOW,
+    SUPERVISOR_WORKERS,
+)
+from fleecekmbackend.core.metrics import (
+    LLM_REQUESTS,
+    PIPELINE_ITEMS,
+    REGISTRY,
+    run_dump_path,
+)
+from fleecekmbackend.core.watchdog import LoopWatchdog
+from fleecekmbackend.services.generation.sharding import (
+    SHARD_MODES,
+    ShardTable,
+    get_unprocessed_id_bounds,
+    plan_shards,
+)
+
+logging.basicConfig(
+    level=LOGGING_LEVEL, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+MODES = ("e2e", "streaming")
+
+_stop_requested = False
+
+
+def _record_stop(signum, frame):
+    global _stop_requested
+    _stop_requested = True
+
+
+async def _report_metrics(index, stats, metrics_queue, started_at, interval, dump_path):
+    from fleecekmbackend.db.ctl import get_pool_stats
+
+    while True:
+        metrics_queue.put(
+            {
+                "worker": index,
+                "pid": os.getpid(),
+                "uptime": time.time() - started_at,
+                "db_pool": get_pool_stats()["primary"],
+                "llm_requests": LLM_REQUESTS.total(),
+                "pipeline_items": PIPELINE_ITEMS.total(),
+                **stats,
+            }
+        )
+        try:
+            REGISTRY.dump(dump_path)
+        except OSError as e:
+            logging.error(f"Error dumping metrics to {dump_path}: {str(e)}")
+        if interval is None:
+            return
+        await asyncio.sleep(interval)
+
+
+async def _worker_main(index, mode, metrics_queue, metrics_interval, shards, run_id):
+    # imported here so the supervisor process never opens db connections
+    from fleecekmbackend.db.counters import flush_counters
+    from fleecekmbackend.services.dataset.answerability import log_cascade_report
+    from fleecekmbackend.services.generation.end2end import (
+        start_background_process_e2e,
+    )
+    from fleecekmbackend.services.generation.streaming import (
+        start_background_process_streaming,
+    )
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    if _stop_requested:
+        # signalled while the worker was still importing
+        stop_event.set()
+
+    stats = {}
+    started_at = time.time()
+    dump_path = run_dump_path(f"worker-{index}", run_id)
+    reporter = asyncio.create_task(
+        _report_metrics(
+            index, stats, metrics_queue, started_at, metrics_interval, dump_path
+        )
+    )
+    watchdog = LoopWatchdog().start()
+    try:
+        if mode == "streaming":
+            await start_background_process_streaming(stop_event, stats)
+        else:
+            await start_background_process_e2e(stop_event, stats, shards, index)
+    finally:
+        reporter.cancel()
+        await flush_counters()
+        await watchdog.stop()
+        log_cascade_report()
+        await _report_metrics(index, stats, metrics_queue, started_at, None, dump_path)
+
+
+def run_worker(index, mode, metrics_queue, metrics_interval, shards=None, run_id=None):
+    """Entry point of one worker process. Exits 0 once there is no work left
+    or a requested drain has finished. Metrics are dumped to
+    ``METRICS_DIR/<run_id>/worker-<index>.prom`` with every report."""
+    signal.signal(signal.SIGTERM, _record_stop)
+    signal.signal(signal.SIGINT, _record_stop)
+    logging.basicConfig(
+        level=LOGGING_LEVEL,
+        format=f"%(asctime)s - worker-{index} - %(levelname)s - %(message)s",
+        force=True,
+    )
+    asyncio.run(
+        _worker_main(index, mode, metrics_queue, metrics_interval, shards, run_id)
+    )
+
+
+class Supervisor:
+    """Runs worker processes, restarts the ones that crash and aggregates the
+    metrics they report. SIGTERM/SIGINT drain the workers: they stop claiming
+    work, commit what is in flight and exit; stragglers are killed after
+    ``drain_timeout`` seconds.
+
+    With ``shard`` set to "modulo" or "range", e2e workers each get a fixed
+    slice of the unprocessed paragraph ids instead of claiming rows, and idle
+    workers take over half of what stragglers have left."""
+
+    def __init__(
+        self,
+        num_workers: int = SUPERVISOR_WORKERS,
+        mode: str = "e2e",
+        metrics_interval: float = SUPERVISOR_METRICS_INTERVAL,
+        drain_timeout: float = SUPERVISOR_DRAIN_TIMEOUT,
+        max_restarts: int = SUPERVISOR_MAX_RESTARTS,
+        restart_window: float = SUPERVISOR_RESTART_WINDOW,
+        shard: str = None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        if shard is not None and mode != "e2e":
+            raise ValueError("sharding is only supported in e2e mode")
+        if mode == "streaming" and num_workers > 1:
+            # streaming seeders read unprocessed rows without claiming them, so
+            # every worker would regenerate the same paragraphs
+            raise ValueError("streaming mode runs a single worker")
+        self.num_workers = num_workers
+        self.mode = mode
+        self.metrics_interval = metrics_interval
+        self.drain_timeout = drain_timeout
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.shard = shard
+        self.shards = None
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        # spawn, not fork: workers must not inherit event loops or connections
+        self.context = multiprocessing.get_context("spawn")
+        self.metrics_queue = self.context.Queue()
+        self.workers = {}  # slot -> Process
+        self.restarts = {}  # slot -> crash times within the window
+        self.metrics = {}  # slot -> last report
+        self.total_restarts = 0
+        self.stopping = False
+        self.drain_deadline = None
+
+    def _spawn(self, index):
+        process = self.context.Process(
+            target=run_worker,
+            args=(
+                index,
+                self.mode,
+                self.metrics_queue,
+                self.metrics_interval,
+                self.shards,
+                self.run_id,
+            ),
+            name=f"worker-{index}",
+        )
+        process.start()
+        self.workers[index] = process
+        logging.info(f"Started worker {index} (pid {process.pid})")
+
+    def _request_stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        self.drain_deadline = time.time() + self.drain_timeout
+        logging.info(
+            f"Received signal {signum}, draining {len(self.workers)} workers "
+            f"(up to {self.drain_timeout}s)"
+        )
+        for process in self.workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def _collect_metrics(self):
+        while True:
+            try:
+                report = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.metrics[report["worker"]] = report
+
+    def aggregate(self):
+        totals = {}
+        for report in self.metrics.values():
+            for key, value in report.items():
+                if key in ("worker", "pid", "uptime") or not isinstance(
+                    value, (int, float)
+                ):
+                    continue
+                totals[key] = totals.get(key, 0) + value
+        totals["workers_alive"] = sum(p.is_alive() for p in self.workers.values())
+        totals["restarts"] = self.total_restarts
+        return totals
+
+    def _check_workers(self):
+        for index, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.workers[index]
+            if process.exitcode == 0 or self.stopping:
+                logging.info(f"Worker {index} exited with code {process.exitcode}")
+                continue
+            now = time.time()
+            crashes = [
+                t for t in self.restarts.get(index, []) if now - t < self.restart_window
+            ] + [now]
+            self.restarts[index] = crashes
+            if len(crashes) > self.max_restarts:
+                logging.error(
+                    f"Worker {index} crashed {len(crashes)} times in "
+                    f"{self.restart_window}s, not restarting it"
+                )
+                continue
+            logging.warning(
+                f"Worker {index} crashed with code {process.exitcode}, restarting"
+            )
+            self.total_restarts += 1
+            self._spawn(index)
+
+    async def _prepare(self, startup):
+        from fleecekmbackend.db.ctl import async_session
+
+        await startup()
+        if self.shard is None:
+            return
+        async with async_session() as db:
+            min_id, max_id = await get_unprocessed_id_bounds(db)
+        if min_id is None:
+            return
+        shards = plan_shards(self.num_workers, self.shard, min_id, max_id)
+        self.shards = ShardTable(self.context, shards)
+        logging.info(
+            f"Sharding paragraph ids {min_id}..{max_id} {self.shard}-wise "
+            f"over {self.num_workers} workers"
+        )
+
+    def run(self):
+        from fleecekmbackend.main import startup
+
+        # done once here instead of in every worker
+        asyncio.run(self._prepare(startup))
+        if self.shard is not None and self.shards is None:
+            logging.info("No unprocessed paragraphs. Nothing to do.")
+            return self.aggregate()
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+        last_log = time.time()
+        while self.workers:
+            time.sleep(1)
+            self._collect_metrics()
+            self._check_workers()
+            if self.stopping and time.time() > self.drain_deadline:
+                for index, process in self.workers.items():
+                    logging.warning(f"Worker {index} did not drain in time, killing it")
+                    process.kill()
+            if time.time() - last_log >= self.metrics_interval:
+                logging.info(f"Workers: {self.aggregate()}")
+                last_log = time.time()
+
+        self._collect_metrics()
+        logging.info(f"All workers exited: {self.aggregate()}")
+        return self.aggregate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run generation worker processes.")
+    parser.add_argument("--workers", type=int, default=SUPERVISOR_WORKERS)
+    parser.add_argument("--mode", choices=MODES, default="e2e")
+    parser.add_argument(
+        "--shard",
+        choices=SHARD_MODES,
+        default=None,
+        help="split paragraph ids between workers instead of claiming rows",
+    )
+    args = parser.parse_args()
+    try:
+        supervisor = Supervisor(args.workers, args.mode, shard=args.shard)
+    except ValueError as e:
+        parser.error(str(e))
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
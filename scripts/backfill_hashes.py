@@ -0,0 +1,27 @@
+import argparse
+import asyncio
+import logging
+
+from fleecekmbackend.db.ctl import create_tables_if_not_exist
+from fleecekmbackend.db.migrations import add_missing_columns, backfill_content_hashes
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def main(batch_size):
+    await create_tables_if_not_exist()
+    added = await add_missing_columns()
+    if added:
+        logger.info(f"Added columns: {', '.join(added)}")
+    filled = await backfill_content_hashes(batch_size)
+    logger.info(f"Backfill completed: {filled}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fill the content hash columns for rows written before they existed."
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
@@ -0,0 +1,369 @@
+"""Benchmark the generation pipelines against a simulated LLM.
+
+Each pipeline runs in its own process, on a fresh SQLite database loaded with
+the same paragraph sample. LLM responses and latencies are derived from a hash
+of the prompt, so every run sees the same workload. Results are written as
+JSON named after the current commit; pass an earlier file to --compare to see
+the change.
+
+    python -m scripts.benchmark --limit 50 --latency 0.05
+    python -m scripts.benchmark --compare experiments/benchmarks/<earlier>.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# fleecekmbackend is imported inside the worker process only, after
+# DATABASE_URL points at that run's database
+
+SAMPLE_PATH = "experiments/data_samples/paragraph-questions-100.csv"
+OUTPUT_DIR = "experiments/benchmarks"
+PIPELINES = ("e2e", "e2e_pages", "s2s", "s2s_optimized", "streaming")
+# the page a prompt is about, as written by generate_fact_with_context
+PAGE_PATTERN = re.compile(r"In an article about '(.*?)', section")
+
+# sample column -> Paragraph column
+PARAGRAPH_COLUMNS = {
+    "id_paragraph": "id",
+    "page_name": "page_name",
+    "section_name": "section_name",
+    "subsection_name": "subsection_name",
+    "subsubsection_name": "subsubsection_name",
+    "text_paragraph": "text",
+    "section_hierarchy": "section_hierarchy",
+    "text_cleaned": "text_cleaned",
+    "word_count": "word_count",
+    "is_bad": "is_bad",
+    "within_page_order": "within_page_order",
+}
+
+# summary values compared by --compare, and whether higher is better
+COMPARED = {
+    "paragraphs_per_second": True,
+    "llm_calls_per_paragraph": False,
+    "db_round_trips_per_paragraph": False,
+    "peak_rss_mb": False,
+}
+
+
+class SimulatedLLM:
+    """Stands in for the gpublaze transport. Replies and latencies depend only
+    on the prompt and the seed."""
+
+    def __init__(self, latency, jitter, reject_rate, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.reject_rate = reject_rate
+        self.seed = seed
+        self.page_calls = 0  # calls whose prompt names a page
+        self.same_page_calls = 0  # ... the same page as the call before
+        self._last_page = None
+
+    def _track_page(self, prompt):
+        match = PAGE_PATTERN.search(prompt)
+        if match is None:
+            return
+        self.page_calls += 1
+        self.same_page_calls += match.group(1) == self._last_page
+        self._last_page = match.group(1)
+
+    def _uniform(self, prompt, salt=""):
+        digest = hashlib.md5(f"{self.seed}:{salt}:{prompt}".encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2**64
+
+    def _delay(self, prompt):
+        return self.latency + self.jitter * self._uniform(prompt, "latency")
+
+    def _reply(self, prompt, guided_choice):
+        if guided_choice:
+            rejected = self._uniform(prompt, "choice") < self.reject_rate
+            content = guided_choice[-1] if rejected else guided_choice[0]
+        elif "short answer questions" in prompt:
+            topic = hashlib.md5(prompt.encode()).hexdigest()[:8]
+            content = "\n".join(
+                f"{i}. What does passage {topic} say about item {i}?"
+                for i in range(1, 5)
+            )
+        elif "Rate the following answer" in prompt:
+            score = int(self._uniform(prompt, "score") * 6)
+            content = f"Answer: {score} \n Rationale: simulated judgment."
+        else:
+            content = "A simulated answer."
+        return {"choices": [{"message": {"content": content}}]}
+
+    def request(self, prompt, model, stop, *args, guided_choice=None, **kwargs):
+        self._track_page(prompt)
+        time.sleep(self._delay(prompt))
+        return self._reply(prompt, guided_choice or _positional_choice(args))
+
+    async def request_async(
+        self, prompt, model, stop, *args, guided_choice=None, **kwargs
+    ):
+        self._track_page(prompt)
+        await asyncio.sleep(self._delay(prompt))
+        return self._reply(prompt, guided_choice or _positional_choice(args))
+
+
+def _positional_choice(args):
+    # guided_choice is the 12th positional parameter of gpublaze_safe_request
+    return args[8] if len(args) > 8 else None
+
+
+async def _load_sample(sample_path, limit, paragraphs_per_page=1):
+    import numpy as np
+    import pandas as pd
+    from fleecekmbackend.db.ctl import create_tables, engine
+    from fleecekmbackend.db.counters import reconcile_counters
+    from fleecekmbackend.db.helpers import add_paragraph_hashes
+    from fleecekmbackend.db.models import Paragraph
+
+    df = pd.read_csv(sample_path).drop_duplicates("id_paragraph")
+    df = df[list(PARAGRAPH_COLUMNS)].rename(columns=PARAGRAPH_COLUMNS)
+    if limit:
+        df = df.head(limit)
+    if paragraphs_per_page > 1:
+        # the sample has one paragraph per page; merge runs of rows into pages.
+        # Ids are left as they are, so id order interleaves the pages.
+        position = np.arange(len(df))
+        df["page_name"] = df["page_name"].values[
+            position - position % paragraphs_per_page
+        ]
+        df["within_page_order"] = position % paragraphs_per_page
+    df = add_paragraph_hashes(df)
+    df["processed"] = False
+    df = df.astype(object).where(pd.notnull(df), None)
+
+    await create_tables()
+    async with engine.begin() as conn:
+        await conn.execute(Paragraph.__table__.insert(), df.to_dict("records"))
+    await reconcile_counters()
+    return len(df)
+
+
+async def _count_rows():
+    from sqlalchemy import func, select
+    from fleecekmbackend.db.ctl import async_session
+    from fleecekmbackend.db.models import (
+        Answer,
+        Paragraph,
+        Question,
+        Rating,
+        RejectedQuestion,
+    )
+
+    async with async_session() as db:
+        rows = {
+            model.__tablename__: (
+                await db.execute(select(func.count(model.id)))
+            ).scalar()
+            for model in (Question, RejectedQuestion, Answer, Rating)
+        }
+        rows["paragraph_processed"] = (
+            await db.execute(
+                select(func.count(Paragraph.id)).where(Paragraph.processed == True)
+            )
+        ).scalar()
+    return rows
+
+
+async def _run(pipeline, options):
+    from sqlalchemy import event
+    import fleecekmbackend.core.utils.llm as llm
+    from fleecekmbackend.core.metrics import LLM_REQUESTS
+    from fleecekmbackend.db.ctl import engine
+    from fleecekmbackend.services.dataset.answerability import cascade_report
+    from fleecekmbackend.services.generation import end2end, stage2stage, streaming
+
+    simulated = SimulatedLLM(
+        options["latency"], options["jitter"], options["reject_rate"], options["seed"]
+    )
+    llm.gpublaze_safe_request = simulated.request
+    llm.gpublaze_safe_request_async = simulated.request_async
+
+    paragraphs = await _load_sample(
+        options["sample"], options["limit"], options["paragraphs_per_page"]
+    )
+
+    round_trips = {"count": 0}
+
+    def count_round_trip(*args):
+        round_trips["count"] += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_round_trip)
+    calls_before = LLM_REQUESTS.total()
+
+    runners = {
+        "e2e": lambda: end2end.process_all_pages_e2e_parallel(1),
+        "e2e_pages": lambda: end2end.process_pages_e2e(),
+        "s2s": lambda: stage2stage.process_all_paragraphs_s2s(options["batch_size"]),
+        "s2s_optimized": lambda: stage2stage.process_all_paragraphs_s2s_optimized(
+            options["batch_size"]
+        ),
+        "streaming": lambda: streaming.process_all_paragraphs_streaming(),
+    }
+    start_time = time.perf_counter()
+    await runners[pipeline]()
+    seconds = time.perf_counter() - start_time
+
+    event.remove(engine.sync_engine, "before_cursor_execute", count_round_trip)
+    llm_calls = LLM_REQUESTS.total() - calls_before
+    rows = await _count_rows()
+    done = rows["paragraph_processed"] or 1
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss_unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "paragraphs": paragraphs,
+        "seconds": seconds,
+        "paragraphs_per_second": rows["paragraph_processed"] / seconds,
+        "llm_calls": llm_calls,
+        "llm_calls_per_paragraph": llm_calls / done,
+        "db_round_trips": round_trips["count"],
+        "db_round_trips_per_paragraph": round_trips["count"] / done,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit,
+        # how often a prompt is about the page of the prompt before it, so a
+        # server-side prefix cache could reuse it
+        "same_page_call_share": simulated.same_page_calls
+        / max(simulated.page_calls, 1),
+        "rows": rows,
+        # what decided the answerability checks; see log_cascade_report
+        "answerability": cascade_report(),
+    }
+
+
+def run_pipeline(pipeline, options, results):
+    """Process entry point: one pipeline on its own database."""
+    directory = tempfile.mkdtemp(prefix=f"benchmark-{pipeline}-")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{directory}/benchmark.db"
+    # modules configure logging on import; set the level once instead
+    logging.basicConfig(level=options["log_level"], force=True)
+    try:
+        results.put((pipeline, asyncio.run(_run(pipeline, options))))
+    except Exception as e:
+        logging.error(f"Benchmark of {pipeline} failed: {str(e)}")
+        results.put((pipeline, {"error": str(e)}))
+
+
+def _wait_for_result(process, pipeline, results):
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                return pipeline, {"error": f"exited with code {process.exitcode}"}
+
+
+def _git(*args):
+    try:
+        return subprocess.check_output(["git", *args], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline):
+    lines = []
+    for pipeline, result in current["results"].items():
+        previous = baseline.get("results", {}).get(pipeline)
+        if not previous or "error" in result or "error" in previous:
+            continue
+        for key, higher_is_better in COMPARED.items():
+            old, new = previous[key], result[key]
+            change = (new - old) / old * 100 if old else 0.0
+            worse = change < 0 if higher_is_better else change > 0
+            flag = " (regression)" if worse and abs(change) >= 5 else ""
+            lines.append(
+                f"{pipeline:>14} {key:<30} {old:>10.2f} -> {new:>10.2f} "
+                f"({change:+.1f}%){flag}"
+            )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the generation pipelines against a simulated LLM."
+    )
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=PIPELINES)
+    parser.add_argument("--sample", default=SAMPLE_PATH)
+    parser.add_argument("--limit", type=int, default=None, help="paragraphs to load")
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument(
+        "--paragraphs-per-page",
+        type=int,
+        default=1,
+        help="group the sample's paragraphs into pages of this size",
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="seconds")
+    parser.add_argument("--reject-rate", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--compare", default=None, help="earlier result file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    options = {
+        "sample": args.sample,
+        "limit": args.limit,
+        "batch_size": args.batch_size,
+        "paragraphs_per_page": args.paragraphs_per_page,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "reject_rate": args.reject_rate,
+        "seed": args.seed,
+        "log_level": logging.INFO if args.verbose else logging.WARNING,
+    }
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    report = {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "options": {k: v for k, v in options.items() if k != "log_level"},
+        "results": {},
+    }
+    for pipeline in args.pipelines:
+        process = context.Process(
+            target=run_pipeline, args=(pipeline, options, results)
+        )
+        process.start()
+        name, result = _wait_for_result(process, pipeline, results)
+        process.join()
+        report["results"][name] = result
+        if "error" in result:
+            print(f"{name}: failed: {result['error']}")
+            continue
+        print(
+            f"{name}: {result['paragraphs_per_second']:.2f} paragraphs/s, "
+            f"{result['llm_calls_per_paragraph']:.1f} LLM calls/paragraph, "
+            f"{result['db_round_trips_per_paragraph']:.1f} db round trips/paragraph, "
+            f"{result['peak_rss_mb']:.0f} MB peak RSS, "
+            f"{result['same_page_call_share']:.0%} of calls on the previous call's page"
+        )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{(report['commit'] or 'unknown')[:10]}"
+    path = os.path.join(args.output_dir, f"{name}.json")
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {path}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print(compare(report, json.load(file)))
+
+
+if __name__ == "__main__":
+    main()
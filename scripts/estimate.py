@@ -0,0 +1,519 @@
+"""Estimate the tokens, cost and wall time of processing every unprocessed
+paragraph before launching a run.
+
+Prompts are built from the templates the pipelines send. Paragraph lengths
+come from one GROUP BY over the paragraph table, computed by the database and
+bucketed into a histogram, so the estimate takes seconds even over millions of
+rows. A sample of recent rows is tokenized to convert characters into tokens,
+and to measure how long questions, answers and ratings turn out.
+
+    python -m scripts.estimate
+    python -m scripts.estimate --workers 32 --tokenizer cl100k_base
+"""
+
+import argparse
+import asyncio
+import glob
+import logging
+import math
+import os
+import re
+from types import SimpleNamespace
+
+import numpy as np
+from sqlalchemy import and_, case, func, select
+
+from fleecekmbackend.core.config import (
+    ANSWER_TARGETS,
+    ESTIMATE_ACCEPTANCE_RATE,
+    ESTIMATE_CALL_SECONDS,
+    ESTIMATE_CONTEXT_WINDOW,
+    ESTIMATE_DEFAULT_TOKENS,
+    ESTIMATE_LENGTH_BUCKET,
+    ESTIMATE_SAMPLE_ROWS,
+    ESTIMATE_THROUGHPUT_WINDOW,
+    ESTIMATE_TOKEN_PRICES,
+    METRICS_DIR,
+    MODEL,
+    NUMQUESTIONS,
+    PROMPT_PREFIX,
+    PROMPT_SUFFIX,
+    RATING_TARGETS,
+    SUPERVISOR_WORKERS,
+)
+from fleecekmbackend.core.utils.llm import MAX_TOKEN, generate_prompts_from_template
+from fleecekmbackend.db.ctl import read_session
+from fleecekmbackend.db.models import (
+    Answer,
+    Paragraph,
+    Question,
+    Rating,
+    RejectedQuestion,
+)
+from fleecekmbackend.db.timeseries import get_recent_counts
+from fleecekmbackend.services.dataset.answers import (
+    ANSWER_CONTEXT_TEMPLATE,
+    ANSWER_TEMPLATE,
+)
+from fleecekmbackend.services.dataset.common import generate_fact_with_context
+from fleecekmbackend.services.dataset.questions import (
+    ANSWERABLE_IC_TEMPLATE,
+    ANSWERABLE_ZS_TEMPLATE,
+    QUESTIONS_TEMPLATE,
+)
+from fleecekmbackend.services.dataset.ratings import RATING_TEMPLATE
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# the e2e pipeline waits for each round before starting the next: question
+# generation, answerability checks, answers, ratings. Calls within a round run
+# concurrently, so a paragraph takes about this many call latencies.
+SEQUENTIAL_ROUNDS = 4
+CHARS_PER_TOKEN = 4  # used when no tokenizer is installed
+CHECKS_PATTERN = re.compile(
+    r'answerability_checks_total\{setting="(\w+)",decided_by="(\w+)"\} (\S+)'
+)
+
+
+def load_tokenizer(name: str = "auto"):
+    """(label, count tokens function) for a Hugging Face tokenizer name, a
+    tiktoken encoding or "chars". "auto" tries the model's own tokenizer, then
+    tiktoken's cl100k_base, then falls back to characters."""
+    if name == "auto" or "/" in name:
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(MODEL if name == "auto" else name)
+            return tokenizer.name_or_path, lambda text: len(
+                tokenizer.encode(text, add_special_tokens=False)
+            )
+        except Exception as e:
+            if name != "auto":
+                raise
+            logger.info(f"Model tokenizer unavailable ({str(e)}), trying tiktoken")
+    if name != "chars":
+        try:
+            import tiktoken
+
+            encoding = tiktoken.get_encoding("cl100k_base" if name == "auto" else name)
+            return encoding.name, lambda text: len(
+                encoding.encode(text, disallowed_special=())
+            )
+        except Exception as e:
+            if name != "auto":
+                raise
+            logger.warning(
+                f"No tokenizer available ({str(e)}), "
+                f"assuming {CHARS_PER_TOKEN} characters per token"
+            )
+    return "chars", lambda text: math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _fact_overheads():
+    """Characters generate_fact_with_context adds around the paragraph fields,
+    for each shape of section hierarchy it distinguishes."""
+    overheads = {}
+    for shape, subsection, subsubsection in (
+        ("subsubsection", "x", "x"),
+        ("subsection", "x", None),
+        ("section", None, None),
+    ):
+        paragraph = SimpleNamespace(
+            page_name="x",
+            section_name="x",
+            subsection_name=subsection,
+            subsubsection_name=subsubsection,
+            text_cleaned="x",
+        )
+        _, fact = generate_fact_with_context(paragraph)
+        fields = sum(value is not None for value in vars(paragraph).values())
+        overheads[shape] = len(fact) - fields
+    return overheads
+
+
+def fact_length(dialect_name: str):
+    """SQL expression for the length of a paragraph's fact as built by
+    generate_fact_with_context."""
+    # MySQL's LENGTH counts bytes
+    length = func.char_length if dialect_name == "mysql" else func.length
+
+    def chars(column):
+        return func.coalesce(length(column), 0)
+
+    def present(column):
+        return and_(column.isnot(None), column != "")
+
+    overheads = _fact_overheads()
+    subsection, subsubsection = Paragraph.subsection_name, Paragraph.subsubsection_name
+    return (
+        case(
+            (
+                and_(present(subsection), present(subsubsection)),
+                overheads["subsubsection"] + chars(subsection) + chars(subsubsection),
+            ),
+            (present(subsection), overheads["subsection"] + chars(subsection)),
+            else_=overheads["section"],
+        )
+        + chars(Paragraph.page_name)
+        + chars(Paragraph.section_name)
+        + chars(Paragraph.text_cleaned)
+    )
+
+
+async def get_fact_length_histogram(db, bucket_chars: int = ESTIMATE_LENGTH_BUCKET):
+    """(bucket lower bounds, paragraphs, total characters) of the facts of the
+    unprocessed paragraphs, as numpy arrays."""
+    chars = fact_length(db.bind.dialect.name)
+    bucket = (chars - chars % bucket_chars) / bucket_chars
+    result = await db.execute(
+        select(bucket, func.count(), func.sum(chars))
+        .where(Paragraph.processed == False)
+        .group_by(bucket)
+    )
+    rows = np.array(result.all(), dtype=float).reshape(-1, 3)
+    rows = rows[np.argsort(rows[:, 0])]
+    return rows[:, 0] * bucket_chars, rows[:, 1], rows[:, 2]
+
+
+async def _sample(db, column, order_by, *where, n=ESTIMATE_SAMPLE_ROWS):
+    result = await db.execute(
+        select(column).where(*where).order_by(order_by.desc()).limit(n)
+    )
+    return [value for value in result.scalars().all() if value]
+
+
+async def measure_outputs(db, count_tokens, n: int = ESTIMATE_SAMPLE_ROWS):
+    """Tokens per fact character, average tokens of generated texts, and
+    questions generated and accepted per paragraph, from recent rows."""
+    facts = await db.execute(
+        select(Paragraph).where(Paragraph.processed == False).limit(n)
+    )
+    facts = [generate_fact_with_context(p)[1] for p in facts.scalars().all()]
+    fact_chars = sum(len(fact) for fact in facts)
+    tokens_per_char = (
+        sum(count_tokens(fact) for fact in facts) / fact_chars
+        if fact_chars
+        else 1 / CHARS_PER_TOKEN
+    )
+
+    texts = {
+        "question": await _sample(db, Question.text, Question.id, n=n),
+        "answer_ic": await _sample(
+            db, Answer.text, Answer.id, Answer.setting == "ic", n=n
+        ),
+        "answer_zs": await _sample(
+            db, Answer.text, Answer.id, Answer.setting == "zs", n=n
+        ),
+        "rating": await _sample(db, Rating.text, Rating.id, n=n),
+    }
+    tokens = {
+        kind: (
+            float(np.mean([count_tokens(text) for text in sample]))
+            if sample
+            else float(ESTIMATE_DEFAULT_TOKENS[kind])
+        )
+        for kind, sample in texts.items()
+    }
+
+    # ids first: MySQL does not allow LIMIT in an IN subquery
+    paragraph_ids = await _sample(
+        db,
+        Paragraph.id,
+        Paragraph.processed_at,
+        Paragraph.processed_at.isnot(None),
+        n=n,
+    )
+    accepted = rejected = 0
+    if paragraph_ids:
+        accepted = await db.scalar(
+            select(func.count()).where(Question.paragraph_id.in_(paragraph_ids))
+        )
+        rejected = await db.scalar(
+            select(func.count()).where(RejectedQuestion.paragraph_id.in_(paragraph_ids))
+        )
+    generated = accepted + rejected
+    return {
+        "tokens_per_fact_char": tokens_per_char,
+        "tokens": tokens,
+        "measured": {kind: len(sample) for kind, sample in texts.items()},
+        "paragraphs_measured": len(paragraph_ids),
+        "questions_per_paragraph": (
+            generated / len(paragraph_ids) if generated else NUMQUESTIONS
+        ),
+        "acceptance_rate": (
+            accepted / generated if generated else ESTIMATE_ACCEPTANCE_RATE
+        ),
+    }
+
+
+def template_tokens(count_tokens):
+    """Tokens of each call's prompt with every variable left empty."""
+
+    def render(template, **variables):
+        prompt, _ = generate_prompts_from_template(
+            template,
+            {
+                "PROMPT_PREFIX": PROMPT_PREFIX,
+                "PROMPT_SUFFIX": PROMPT_SUFFIX,
+                **variables,
+            },
+        )
+        return count_tokens(prompt)
+
+    def guided(template, **variables):
+        # llm_safe_request joins prefix, prompt and suffix with spaces
+        prompt = template.format(**variables)
+        return count_tokens(f"{PROMPT_PREFIX} {prompt} {PROMPT_SUFFIX}")
+
+    return {
+        "questions": render(
+            QUESTIONS_TEMPLATE, NUM_QUESTIONS=NUMQUESTIONS, PARAGRAPH=""
+        ),
+        "answerable_ic": guided(ANSWERABLE_IC_TEMPLATE, QUESTION="", FACT=""),
+        "answerable_zs": guided(ANSWERABLE_ZS_TEMPLATE, QUESTION=""),
+        "answer_ic": render(
+            ANSWER_TEMPLATE,
+            CONTEXT_PROMPT=ANSWER_CONTEXT_TEMPLATE.format(FACT=""),
+            QUESTION="",
+        ),
+        "answer_zs": render(ANSWER_TEMPLATE, CONTEXT_PROMPT="", QUESTION=""),
+        "rating": render(RATING_TEMPLATE, REFERENCE="", QUESTION="", ANSWER=""),
+        # what the rating parser expects in front of the rationale
+        "rating_reply": count_tokens("Answer: 3 \n Rationale: "),
+        "question_numbering": count_tokens("1. \n"),
+    }
+
+
+def estimate_calls(paragraphs, fact_tokens, measured, templates):
+    """Calls and tokens per call type. ``fact_tokens`` is the total over all
+    paragraphs; everything else is a per-call average."""
+    tokens = measured["tokens"]
+    generated = measured["questions_per_paragraph"]
+    accepted = generated * measured["acceptance_rate"]
+    # every answer target answers each accepted question, every judge rates
+    # each answer
+    answered = accepted * len(ANSWER_TARGETS)
+    # with a trained cascade, only the checks its classifier is unsure of
+    escalated = measured.get("answerability_escalated", {})
+    question, answer = (
+        tokens["question"],
+        (tokens["answer_ic"] + tokens["answer_zs"]) / 2,
+    )
+    # call type -> (calls per paragraph, prompt tokens besides the fact,
+    #               whether the fact is in the prompt, completion tokens)
+    calls = {
+        "questions": (
+            1,
+            templates["questions"],
+            True,
+            generated * (question + templates["question_numbering"]),
+        ),
+        "answerable_ic": (
+            generated * escalated.get("ic", 1.0),
+            templates["answerable_ic"] + question,
+            True,
+            1,
+        ),
+        "answerable_zs": (
+            generated * escalated.get("zs", 1.0),
+            templates["answerable_zs"] + question,
+            False,
+            1,
+        ),
+        "answer_ic": (
+            answered,
+            templates["answer_ic"] + question,
+            True,
+            tokens["answer_ic"],
+        ),
+        "answer_zs": (
+            answered,
+            templates["answer_zs"] + question,
+            False,
+            tokens["answer_zs"],
+        ),
+        "rating": (
+            2 * answered * len(RATING_TARGETS),
+            templates["rating"] + question + answer,
+            True,
+            templates["rating_reply"] + tokens["rating"],
+        ),
+    }
+    return {
+        name: {
+            "calls": per_paragraph * paragraphs,
+            "prompt_tokens": per_paragraph
+            * (paragraphs * prompt + (fact_tokens if with_fact else 0)),
+            "completion_tokens": per_paragraph * paragraphs * completion,
+        }
+        for name, (per_paragraph, prompt, with_fact, completion) in calls.items()
+    }
+
+
+def _latest_run_dumps(metrics_dir):
+    dumps = glob.glob(os.path.join(metrics_dir, "*", "*.prom"))
+    if not dumps:
+        return []
+    run_dir = os.path.dirname(max(dumps, key=os.path.getmtime))
+    return glob.glob(os.path.join(run_dir, "*.prom"))
+
+
+def read_dumped_latency(metrics_dir: str = METRICS_DIR):
+    """Mean LLM call latency over the worker dumps of the latest run, or None."""
+    total = count = 0.0
+    for path in _latest_run_dumps(metrics_dir):
+        with open(path) as file:
+            for line in file:
+                name, _, value = line.rpartition(" ")
+                if name.startswith("llm_request_seconds_sum"):
+                    total += float(value)
+                elif name.startswith("llm_request_seconds_count"):
+                    count += float(value)
+    return total / count if count else None
+
+
+def read_dumped_escalation(metrics_dir: str = METRICS_DIR):
+    """Share of the answerability checks of each setting that the latest run
+    sent to the LLM rather than deciding with the cascade's classifier."""
+    checks = {}
+    for path in _latest_run_dumps(metrics_dir):
+        with open(path) as file:
+            for line in file:
+                match = CHECKS_PATTERN.match(line)
+                if match:
+                    setting, decided_by, value = match.groups()
+                    row = checks.setdefault(setting, {"all": 0.0, "llm": 0.0})
+                    row["all"] += float(value)
+                    row["llm"] += float(value) * (decided_by != "classifier")
+    return {setting: row["llm"] / row["all"] for setting, row in checks.items()}
+
+
+async def measure_throughput(db, window: int = ESTIMATE_THROUGHPUT_WINDOW):
+    """Paragraphs and LLM calls per second over the last ``window`` seconds,
+    inferred from the rows written."""
+    counts = await get_recent_counts(db, window)
+    calls = (
+        counts["paragraphs_processed"]
+        + 2 * (counts["questions_generated"] + counts["questions_rejected"])
+        + counts["answers_generated"]
+        + counts["ratings_generated"]
+    )
+    return counts["paragraphs_processed"] / window, calls / window
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "n/a"
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    return (
+        f"{days}d {hours}h {seconds // 60}m" if days else f"{hours}h {seconds // 60}m"
+    )
+
+
+async def estimate(args):
+    label, count_tokens = load_tokenizer(args.tokenizer)
+    async with read_session() as db:
+        lower_bounds, counts, char_sums = await get_fact_length_histogram(db)
+        measured = await measure_outputs(db, count_tokens)
+        paragraph_rate, call_rate = await measure_throughput(db)
+    measured["answerability_escalated"] = read_dumped_escalation()
+
+    paragraphs = int(counts.sum())
+    if not paragraphs:
+        print("No unprocessed paragraphs.")
+        return
+    ratio = measured["tokens_per_fact_char"]
+    fact_tokens = float(char_sums.sum()) * ratio
+    templates = template_tokens(count_tokens)
+    calls = estimate_calls(paragraphs, fact_tokens, measured, templates)
+
+    print(f"Unprocessed paragraphs: {paragraphs}  (tokenizer: {label})")
+    cumulative = np.cumsum(counts) / paragraphs
+    p50, p95 = (
+        (lower_bounds[np.searchsorted(cumulative, q)] + ESTIMATE_LENGTH_BUCKET) * ratio
+        for q in (0.5, 0.95)
+    )
+    longest = (lower_bounds[-1] + ESTIMATE_LENGTH_BUCKET) * ratio
+    print(
+        f"Fact tokens per paragraph: {fact_tokens / paragraphs:.0f} mean, "
+        f"<{p50:.0f} p50, <{p95:.0f} p95, <{longest:.0f} max"
+    )
+    # the rating prompt is the longest: fact, question, answer and rubric
+    budget = ESTIMATE_CONTEXT_WINDOW - MAX_TOKEN - templates["rating"]
+    budget -= measured["tokens"]["question"] + measured["tokens"]["answer_ic"]
+    overflowing = int(counts[lower_bounds * ratio > budget].sum())
+    if overflowing:
+        print(
+            f"Paragraphs whose rating prompt may not fit in "
+            f"{ESTIMATE_CONTEXT_WINDOW} tokens: {overflowing}"
+        )
+    print(
+        f"Per paragraph: {measured['questions_per_paragraph']:.2f} questions "
+        f"generated, {measured['acceptance_rate']:.0%} accepted "
+        f"(from {measured['paragraphs_measured']} processed paragraphs)"
+    )
+
+    print(f"\n{'call':<14}{'calls':>14}{'prompt tokens':>18}{'completion tokens':>20}")
+    for name, row in calls.items():
+        print(
+            f"{name:<14}{row['calls']:>14,.0f}{row['prompt_tokens']:>18,.0f}"
+            f"{row['completion_tokens']:>20,.0f}"
+        )
+    total = {
+        key: sum(row[key] for row in calls.values())
+        for key in ("calls", "prompt_tokens", "completion_tokens")
+    }
+    print(
+        f"{'total':<14}{total['calls']:>14,.0f}{total['prompt_tokens']:>18,.0f}"
+        f"{total['completion_tokens']:>20,.0f}"
+    )
+    cost = (
+        total["prompt_tokens"] * args.prompt_price
+        + total["completion_tokens"] * args.completion_price
+    ) / 1e6
+    print(
+        f"\nCost at ${args.prompt_price}/${args.completion_price} per million "
+        f"prompt/completion tokens: ${cost:,.2f}"
+    )
+
+    latency = args.seconds_per_call or read_dumped_latency()
+    source = "measured" if latency else "assumed"
+    latency = latency or ESTIMATE_CALL_SECONDS
+    configured = math.ceil(paragraphs / args.workers) * SEQUENTIAL_ROUNDS * latency
+    print(
+        f"Wall time with {args.workers} workers at {latency:.2f}s per call "
+        f"({source}): {_duration(configured)}"
+    )
+    if call_rate:
+        print(
+            f"Wall time at the rate of the last {ESTIMATE_THROUGHPUT_WINDOW}s "
+            f"({paragraph_rate * 60:.1f} paragraphs/min, {call_rate:.1f} calls/s): "
+            f"{_duration(total['calls'] / call_rate)}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate tokens, cost and wall time of the unprocessed paragraphs."
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default="auto",
+        help='Hugging Face tokenizer name, tiktoken encoding, "chars" or "auto"',
+    )
+    parser.add_argument("--workers", type=int, default=SUPERVISOR_WORKERS)
+    parser.add_argument(
+        "--seconds-per-call",
+        type=float,
+        default=None,
+        help="LLM call latency; read from the latest metric dumps by default",
+    )
+    parser.add_argument("--prompt-price", type=float, default=ESTIMATE_TOKEN_PRICES[0])
+    parser.add_argument(
+        "--completion-price", type=float, default=ESTIMATE_TOKEN_PRICES[1]
+    )
+    asyncio.run(estimate(parser.parse_args()))
@@ -9,11 +9,22 @@ if [ ! -f $PID_FILE ]; then
     exit 1
 fi
 
-# Kill each process listed in the PID file
+# Ask each process listed in the PID file to drain: workers stop claiming work
+# and commit what they have in flight before exiting
 while read -r pid; do
     if [ -n "$pid" ]; then
-        kill -9 $pid
-        echo "Killed process with PID: $pid"
+        kill -TERM $pid
+        echo "Sent SIGTERM to process with PID: $pid"
+    fi
+done < $PID_FILE
+
+# Wait for the processes to finish draining
+while read -r pid; do
+    if [ -n "$pid" ]; then
+        while kill -0 $pid 2>/dev/null; do
+            sleep 1
+        done
+        echo "Process with PID $pid exited"
     fi
 done < $PID_FILE
 
@@ -22,4 +33,4 @@ rm -f $PID_FILE
 
 rm -f ./logs/*.log
 
-echo "All background tasks killed and PID file removed."
+echo "All background tasks stopped and PID file removed."
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import logging
+
+from fleecekmbackend.core.config import MODEL, RECOMPUTE_BATCH_SIZE
+from fleecekmbackend.db.counters import flush_counters
+from fleecekmbackend.db.ctl import async_session, create_tables_if_not_exist
+from fleecekmbackend.db.migrations import add_missing_columns, backfill_author_kinds
+from fleecekmbackend.db.models import Author
+from fleecekmbackend.services.generation.recompute import (
+    CALLS_PER_ROW,
+    RECOMPUTABLE,
+    count_rows_by_author,
+    find_superseded_authors,
+    recompute,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _one_line(value, width):
+    value = " ".join((value or "").split())
+    return value if len(value) <= width else value[: width - 3] + "..."
+
+
+async def main(args):
+    await create_tables_if_not_exist()
+    await add_missing_columns()
+    await backfill_author_kinds()
+    async with async_session() as db:
+        if args.authors:
+            authors = [await db.get(Author, author_id) for author_id in args.authors]
+            for author_id, author in zip(args.authors, authors):
+                if author is None or author.kind != args.kind:
+                    raise SystemExit(f"Author {author_id} does not write {args.kind}s")
+        else:
+            authors = await find_superseded_authors(
+                db, args.kind, args.model, args.from_model, args.include_done
+            )
+        counts = await count_rows_by_author(db, args.kind, [a.id for a in authors])
+
+    if not authors:
+        print(f"No superseded {args.kind} authors.")
+        return
+    print(f"Superseded {args.kind} authors (current model: {args.model}):")
+    for author in authors:
+        done = f", superseded by {author.superseded_by}" if author.superseded_by else ""
+        print(
+            f"  {author.id}: {counts.get(author.id, 0)} rows, {author.model}{done}\n"
+            f"      {_one_line(author.prompt, 160)}"
+        )
+    rows = sum(counts.values())
+    print(
+        f"{rows} rows to recompute, up to {rows * CALLS_PER_ROW[args.kind]} LLM calls"
+    )
+    if not args.run:
+        print("Pass --run to recompute them.")
+        return
+
+    results = await recompute(
+        args.kind,
+        [author.id for author in authors],
+        args.model,
+        args.service,
+        args.batch_size,
+    )
+    await flush_counters()
+    for author_id, stats in results.items():
+        logger.info(f"Author {author_id}: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Regenerate the answers or ratings written by superseded prompt templates or models."
+    )
+    parser.add_argument("--kind", choices=tuple(RECOMPUTABLE), required=True)
+    parser.add_argument("--model", default=MODEL, help="model to recompute with")
+    parser.add_argument("--service", default="gpublaze")
+    parser.add_argument(
+        "--from-model",
+        default=None,
+        help="recompute every author of this model instead of older templates",
+    )
+    parser.add_argument(
+        "--authors", type=int, nargs="+", default=None, help="only these authors"
+    )
+    parser.add_argument("--include-done", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=RECOMPUTE_BATCH_SIZE)
+    parser.add_argument("--run", action="store_true", help="without it, only list")
+    args = parser.parse_args()
+    asyncio.run(main(args))
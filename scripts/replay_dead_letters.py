@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import logging
+
+from fleecekmbackend.db.ctl import async_session, create_tables_if_not_exist
+from fleecekmbackend.db.deadletter import clear_dead_letters, get_dead_letters
+from fleecekmbackend.db.migrations import add_missing_columns
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ITEM_TYPES = ("paragraph", "question", "answer")
+
+
+def _one_line(value, width):
+    value = " ".join((value or "").split())
+    return value if len(value) <= width else value[: width - 3] + "..."
+
+
+async def main(args):
+    await create_tables_if_not_exist()
+    await add_missing_columns()
+    async with async_session() as db:
+        dead = await get_dead_letters(db, args.item_type, args.ids)
+        if not dead:
+            print("No dead-lettered items.")
+        for row in dead:
+            print(
+                f"{row.item_type} {row.item_id}: {row.attempts} failures, last "
+                f"{row.last_failed_at:%Y-%m-%d %H:%M:%S} in {row.stage}, "
+                f"{row.error_class}: {_one_line(row.error, 120)}"
+            )
+            if args.show_prompts and row.last_prompt:
+                print(f"    prompt: {_one_line(row.last_prompt, 240)}")
+        if args.list:
+            return
+        if not args.all and not args.ids:
+            logger.info("Pass --ids or --all to replay, or --list to only list.")
+            return
+        cleared = await clear_dead_letters(db, args.item_type, args.ids)
+        await db.commit()
+    # failure counts of items below the limit are reset as well
+    logger.info(
+        f"Cleared {cleared} dead-letter rows; their items will be claimed again"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="List dead-lettered items, or replay them by clearing their failures."
+    )
+    parser.add_argument("--item-type", choices=ITEM_TYPES, default=None)
+    parser.add_argument("--ids", type=int, nargs="+", default=None)
+    parser.add_argument("--all", action="store_true", help="replay every item")
+    parser.add_argument("--list", action="store_true", help="only list the items")
+    parser.add_argument("--show-prompts", action="store_true")
+    args = parser.parse_args()
+    if args.ids and args.item_type is None:
+        parser.error("--ids needs --item-type")
+    asyncio.run(main(args))
@@ -8,20 +8,24 @@ LOGS_DIR=./logs
 # Create the logs directory if it doesn't exist
 mkdir -p $LOGS_DIR
 
-# Number of instances
+# Number of worker processes
 NUM_INSTANCES=64
 
-BACKGROUND_TASK_SCRIPT="fleecekmbackend/main.py"
+# Pipeline run by each worker: e2e, or streaming with NUM_INSTANCES=1 (its
+# seeders do not claim rows, so several workers would repeat the same work)
+MODE=e2e
 
-for ((i=1; i<=NUM_INSTANCES; i++))
-do
-    UNIQUE_HASH=$(openssl rand -hex 12)
+# Set to modulo or range to give each e2e worker a fixed slice of paragraph ids
+# instead of claiming rows with SELECT ... FOR UPDATE SKIP LOCKED
+SHARD=
 
-    LOG_FILE="$LOGS_DIR/background_task_$UNIQUE_HASH.log"
-    
-    poetry run python $BACKGROUND_TASK_SCRIPT > $LOG_FILE 2>&1 & 
+UNIQUE_HASH=$(openssl rand -hex 12)
 
-    echo $! >> "/tmp/background_task_pids.txt"
-done
+LOG_FILE="$LOGS_DIR/background_task_$UNIQUE_HASH.log"
 
-echo "Started $NUM_INSTANCES instances of the background task."
+# The supervisor does the startup work once, then runs and restarts the workers
+poetry run python -m fleecekmbackend.supervisor --workers $NUM_INSTANCES --mode $MODE ${SHARD:+--shard $SHARD} > $LOG_FILE 2>&1 &
+
+echo $! >> "/tmp/background_task_pids.txt"
+
+echo "Started a supervisor with $NUM_INSTANCES workers."
@@ -0,0 +1,3 @@
+#!/bin/bash
+export PATH="$PATH:$HOME/.local/bin"
+poetry run python fleecekmbackend/services/generation/streaming.py
\ No newline at end of file
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+
+from fleecekmbackend.core.config import (
+    ANSWERABILITY_FEATURES,
+    ANSWERABILITY_MIN_AGREEMENT,
+    ANSWERABILITY_MODEL_PATH,
+)
+from fleecekmbackend.db.ctl import async_session, create_tables_if_not_exist
+from fleecekmbackend.db.migrations import add_missing_columns
+from fleecekmbackend.services.dataset.answerability import (
+    AnswerabilityClassifier,
+    load_labelled_checks,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIN_EXAMPLES = 200
+
+
+def _previous_labels_until(path):
+    try:
+        return AnswerabilityClassifier.load(path).labels_until
+    except FileNotFoundError:
+        return None
+
+
+async def main(args):
+    await create_tables_if_not_exist()
+    await add_missing_columns()
+    # once the cascade runs, new rows carry the classifier's own verdicts;
+    # keep training on the LLM's labels unless told otherwise
+    labels_until = args.labels_until
+    if labels_until is None and not args.all_labels:
+        labels_until = _previous_labels_until(args.output)
+    if labels_until is None:
+        labels_until = datetime.now()
+    async with async_session() as db:
+        checks = await load_labelled_checks(db, labels_until)
+    logger.info(f"{len(checks)} labelled questions created until {labels_until}")
+    if len(checks) < MIN_EXAMPLES:
+        raise SystemExit(f"Need at least {MIN_EXAMPLES} labelled questions to train")
+
+    classifier = AnswerabilityClassifier(args.features)
+    classifier.labels_until = labels_until
+    for setting, label_index in (("ic", 2), ("zs", 3)):
+        examples = [
+            (text, fact if setting == "ic" else "") for text, fact, *_ in checks
+        ]
+        labels = [check[label_index] for check in checks]
+        evaluation = classifier.train(setting, examples, labels, args.min_agreement)
+        agreement = evaluation["agreement"]
+        print(
+            f"{setting}: {evaluation['examples']} examples, "
+            f"{evaluation['answerable']:.1%} answerable; held out "
+            f"{evaluation['held_out']}: {evaluation['accuracy']:.1%} accuracy, "
+            f"{evaluation['coverage']:.1%} decided without the LLM"
+            + (f" at {agreement:.1%} agreement" if agreement is not None else "")
+            + f" (accept >= {evaluation['accept_threshold']:.3f}, "
+            f"reject <= {evaluation['reject_threshold']:.3f})"
+        )
+    if args.dry_run:
+        return
+    classifier.save(args.output)
+    logger.info(f"Saved the answerability classifier to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train the answerability classifier of the cascade on the questions the LLM accepted and rejected."
+    )
+    parser.add_argument("--output", default=ANSWERABILITY_MODEL_PATH)
+    parser.add_argument("--features", type=int, default=ANSWERABILITY_FEATURES)
+    parser.add_argument(
+        "--min-agreement",
+        type=float,
+        default=ANSWERABILITY_MIN_AGREEMENT,
+        help="held-out agreement with the LLM the confidence thresholds must keep",
+    )
+    parser.add_argument(
+        "--labels-until",
+        type=datetime.fromisoformat,
+        default=None,
+        help="only questions created until then (default: the cutoff of the classifier being replaced)",
+    )
+    parser.add_argument(
+        "--all-labels",
+        action="store_true",
+        help="train on every question, including ones the classifier checked",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="evaluate, don't save")
+    args = parser.parse_args()
+    asyncio.run(main(args))